@@ -10,11 +10,7 @@ from ramanbox.raman.constants import Label
 from fit_visualization import FittingVisualizer
 
 def make_df(sample_list):
-    df = pd.DataFrame()
-    for sample in sample_list:
-        df = df.append(sample.to_pandas(), ignore_index=True)
-
-    return df
+    return pd.concat([sample.to_pandas() for sample in sample_list], ignore_index=True)
 
 def normalize_X(X):
     X = copy.copy(X)
@@ -48,8 +48,8 @@ class LabelController:
         return file_list, sample_list
 
     def save_sample(self):
-        print(f"sample saved to {self.output_filepath}")
-        self.current_sample.save_dataset(self.output_filepath)
+        n_labels = self.current_sample.save_labels(self.output_filepath)
+        print(f"sample saved to {self.output_filepath} ({n_labels} labels written)")
 
     def skip_to_next_unlabeld_spectrum(self):
         while self.current_spectrum.label != Label.UNCAT:
@@ -0,0 +1,284 @@
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from typing import Optional
+from ramanbox.raman.constants import PositionType
+from ramanbox.raman.processing import DataSpecProcessor, DefaultSpotParser, SpectrumProcessor
+from ramanbox.raman.sample import Sample
+from ramanbox.raman.spectral_cube import SpectralCube
+from ramanbox.raman.spot import Spot
+from ramanbox.raman.whittaker import SOLVERS
+
+
+def make_synthetic_sample(n_spectra: int = 10000, n_points: int = 1024, spectra_per_spot: int = 1,
+                          seed: int = 0) -> Sample:
+    """
+    Builds a corrected sample of synthetic spectra on a raster, for benchmarking input and output. Each raw
+    spectrum is a sloped background plus a few gaussian peaks with poisson counting noise, the corrected
+    spectrum is the raw spectrum minus the background.
+    :param n_spectra: number of spectra
+    :type n_spectra: int
+    :param n_points: number of points per spectrum
+    :type n_points: int
+    :param spectra_per_spot: number of spectra in each spot
+    :type spectra_per_spot: int
+    :param seed: random seed
+    :type seed: int
+    :return: the sample
+    :rtype: Sample
+    """
+    rng = np.random.default_rng(seed)
+    wavenumbers = np.linspace(200, 1800, n_points)
+    n_spots = -(-n_spectra // spectra_per_spot)
+    row_size = int(np.ceil(np.sqrt(n_spots)))
+    x = np.linspace(0, 1, n_points)
+    background = 500 + 300 * x * rng.uniform(0.5, 1.5, (n_spectra, 1))
+    peaks = np.zeros((n_spectra, n_points))
+    for center in rng.uniform(0.05, 0.95, 6):
+        peaks += rng.uniform(50, 2000, (n_spectra, 1)) * np.exp(-0.5 * ((x - center) / 0.004) ** 2)
+    raw = rng.poisson(background + peaks).astype(float)
+    corrected = raw - background
+    cube = SpectralCube(raw, wavenumbers, DataSpecProcessor(785, None, wavenumbers), 785, PositionType.WAVENUMBER,
+                        corrected=corrected, labels=rng.integers(0, 4, n_spectra),
+                        spot_index=np.arange(n_spectra) // spectra_per_spot,
+                        spot_positions=[(spot % row_size, spot // row_size) for spot in range(n_spots)])
+    filepaths = [f'synthetic_{spot}.txt' for spot in range(n_spots)]
+    return Sample(Spot.list_from_cube(cube, None, filepaths), name='synthetic')
+
+
+def _time(function, repeat: int) -> float:
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_netcdf_load(n_spectra: int = 10000, spectra_per_spot: int = 10, repeat: int = 3,
+                          directory: Optional[str] = None) -> pd.DataFrame:
+    """
+    Times Sample.build_from_netcdf on a synthetic sample saved in the legacy layout (one variable per spot)
+    and in the current layout, eagerly, lazily and lazily followed by reading every spectrum.
+    The best of repeat runs is reported.
+    :param n_spectra: number of spectra in the synthetic sample
+    :type n_spectra: int
+    :param spectra_per_spot: number of spectra in each spot, sets the number of variables in the legacy file
+    :type spectra_per_spot: int
+    :param repeat: number of runs for each case
+    :type repeat: int
+    :param directory: directory the files are written to, if None a temporary directory is used
+    :type directory: Optional[str]
+    :return: one row per case with the file size and the load time in seconds
+    :rtype: pd.DataFrame
+    """
+    sample = make_synthetic_sample(n_spectra, spectra_per_spot=spectra_per_spot)
+    with tempfile.TemporaryDirectory(dir=directory) as tmp_dir:
+        rows = []
+        for layout_version in (1, 2):
+            filename = os.path.join(tmp_dir, f'synthetic_v{layout_version}.nc')
+            sample.save_dataset(filename, layout_version=layout_version)
+
+            def load_all(lazy):
+                loaded = Sample.build_from_netcdf(filename, lazy=lazy)
+                loaded.cube.data()
+                loaded.close()
+
+            cases = {'eager': lambda: Sample.build_from_netcdf(filename),
+                     'lazy open': lambda: Sample.build_from_netcdf(filename, lazy=True).close(),
+                     'lazy open + read all': lambda: load_all(True)}
+            for case, function in cases.items():
+                if layout_version == 1 and case != 'eager':
+                    continue  # legacy files are always read eagerly
+                rows.append({'layout_version': layout_version,
+                             'case': case,
+                             'n_spectra': n_spectra,
+                             'file_mb': os.path.getsize(filename) / 2 ** 20,
+                             'seconds': _time(function, repeat)})
+    return pd.DataFrame(rows)
+
+
+def benchmark_whittaker_solvers(n_points: int = 1024, n_spectra: int = 100, lambda_: float = 200,
+                                repeat: int = 3) -> pd.DataFrame:
+    """
+    Times the Whittaker solvers (see ramanbox.raman.whittaker.SOLVERS) on the raw spectra of a synthetic
+    sample: smooth called on one spectrum at a time, smooth_batch on all of them, and the airPLS baseline
+    correction of all of them (SpectrumProcessor.correct_baseline_batch). The best of repeat runs is reported,
+    with the largest difference from the sparse solver's result.
+    :param n_points: number of points per spectrum
+    :type n_points: int
+    :param n_spectra: number of spectra
+    :type n_spectra: int
+    :param lambda_: smoothing parameter
+    :type lambda_: float
+    :param repeat: number of runs for each case
+    :type repeat: int
+    :return: one row per solver and case with the time in seconds, milliseconds per spectrum and max_abs_diff
+    :rtype: pd.DataFrame
+    """
+    spectra = make_synthetic_sample(n_spectra, n_points).cube.raw
+    weights = np.ones_like(spectra)
+    rows = []
+    reference = {}
+    for name, solver in SOLVERS.items():
+        processor = SpectrumProcessor(785, solver)
+        cases = {'smooth': lambda: np.array([solver.smooth(x, w, lambda_) for x, w in zip(spectra, weights)]),
+                 'smooth_batch': lambda: solver.smooth_batch(spectra, weights, lambda_),
+                 'airPLS batch': lambda: processor.correct_baseline_batch(spectra, lambda_=lambda_)}
+        for case, function in cases.items():
+            result = function()
+            reference.setdefault(case, result)
+            seconds = _time(function, repeat)
+            rows.append({'solver': name,
+                         'case': case,
+                         'n_spectra': n_spectra,
+                         'n_points': n_points,
+                         'seconds': seconds,
+                         'ms_per_spectrum': 1e3 * seconds / n_spectra,
+                         'max_abs_diff': np.abs(result - reference[case]).max()})
+    return pd.DataFrame(rows)
+
+
+def write_spot_file(filename: str, positions: np.array, spectra: np.array) -> None:
+    """
+    Writes spectra in the text format read by DefaultSpotParser: a header, blank lines and then one
+    'position\tintensity\t' line per point, the spectra one after the other
+    :param filename: filepath of the .txt file
+    :type filename: str
+    :param positions: positions (wavelengths) with shape (n_points,)
+    :type positions: np.array
+    :param spectra: intensities with shape (n_spectra, n_points)
+    :type spectra: np.array
+    :return: None
+    :rtype: None
+    """
+    header = ['Date and Time:                Wed Feb 26 23:17:06.291 2020',
+              'Exposure Time (sec):          1.000',
+              'Laser Power (mW):             10',
+              f'Grid Size:                    {len(spectra)}x1']
+    with open(filename, 'w') as outfile:
+        outfile.write('\n'.join(header) + '\n\n\n\n')
+        for spectrum in spectra:
+            outfile.writelines(f'{position:.5f}\t{intensity:.0f}\t\n' for position, intensity in zip(positions,
+                                                                                                    spectrum))
+
+
+def benchmark_spot_parsing(n_spectra: int = 1000, repeat: int = 3, directory: Optional[str] = None) -> pd.DataFrame:
+    """
+    Times DefaultSpotParser on a synthetic spot file, with the line by line get_file_spectra (fast=False), with
+    get_file_spectra_fast and, for the data section alone, with _parse_data_lines. The best of repeat runs is
+    reported, with the largest difference from the spectra get_file_spectra reads.
+    :param n_spectra: number of spectra in the file
+    :type n_spectra: int
+    :param repeat: number of runs for each case
+    :type repeat: int
+    :param directory: directory the file is written to, if None a temporary directory is used
+    :type directory: Optional[str]
+    :return: one row per case with the file size, the parse time in seconds, milliseconds per spectrum,
+    megabytes per second and max_abs_diff
+    :rtype: pd.DataFrame
+    """
+    n_points = 1024  # the spectrum_length DefaultSpotParser assumes
+    spectra = make_synthetic_sample(n_spectra, n_points).cube.raw
+    with tempfile.TemporaryDirectory(dir=directory) as tmp_dir:
+        filename = os.path.join(tmp_dir, 'synthetic.txt')
+        write_spot_file(filename, np.linspace(797, 1000, n_points), spectra)
+        file_mb = os.path.getsize(filename) / 2 ** 20
+        with open(filename) as infile:
+            DefaultSpotParser.get_metadata(infile)
+            data_text = infile.read()
+
+        cases = {'get_file_spectra': lambda: np.array(DefaultSpotParser(filename, fast=False).spectra),
+                 'get_file_spectra_fast': lambda: DefaultSpotParser(filename).spectra,
+                 '_parse_data_lines': lambda: DefaultSpotParser._parse_data_lines(data_text).reshape(-1, n_points, 2)}
+        rows = []
+        reference = None
+        for case, function in cases.items():
+            result = function()
+            if reference is None:
+                reference = result
+            seconds = _time(function, repeat)
+            rows.append({'case': case,
+                         'n_spectra': n_spectra,
+                         'file_mb': file_mb,
+                         'seconds': seconds,
+                         'ms_per_spectrum': 1e3 * seconds / n_spectra,
+                         'mb_per_s': file_mb / seconds,
+                         'max_abs_diff': np.abs(result - reference).max()})
+    return pd.DataFrame(rows)
+
+
+SAVE_SETTINGS = {'default': {},
+                 'zlib 4': {'compression': 'zlib', 'compression_level': 4},
+                 'zlib 4, no shuffle': {'compression': 'zlib', 'compression_level': 4, 'shuffle': False},
+                 'zlib 4, float32': {'compression': 'zlib', 'compression_level': 4, 'dtype': 'float32'},
+                 'zlib 4, int32': {'compression': 'zlib', 'compression_level': 4, 'dtype': 'int32'},
+                 'zlib 4, int16': {'compression': 'zlib', 'compression_level': 4, 'dtype': 'int16'},
+                 'zlib 4, float32, 512 per chunk': {'compression': 'zlib', 'compression_level': 4,
+                                                    'dtype': 'float32', 'chunk_spectra': 512},
+                 'zstd 3, float32': {'compression': 'zstd', 'compression_level': 3, 'dtype': 'float32'},
+                 'zarr, blosc_zstd 3, float32': {'backend': 'zarr', 'compression': 'blosc_zstd',
+                                                 'compression_level': 3, 'dtype': 'float32'}}
+
+
+def _disk_size(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+
+
+def benchmark_save_options(sample: Optional[Sample] = None, settings: Optional[dict] = None, repeat: int = 1,
+                           directory: Optional[str] = None) -> pd.DataFrame:
+    """
+    Saves a sample with each set of Sample.save_dataset options and reports the size on disk, the write time,
+    the read time (eager build_from_netcdf) and the largest error of the spectra read back.
+    The best of repeat runs is reported.
+    :param sample: the sample to save, if None a 10k spectrum sample from make_synthetic_sample is used
+    :type sample: Optional[Sample]
+    :param settings: save_dataset keyword arguments keyed by a setting name, if None SAVE_SETTINGS is used
+    (settings needing a missing optional package, e.g. zarr, are skipped)
+    :type settings: Optional[dict]
+    :param repeat: number of runs for each setting
+    :type repeat: int
+    :param directory: directory the files are written to, if None a temporary directory is used
+    :type directory: Optional[str]
+    :return: one row per setting with file_mb, ratio (to the first setting), write_s, read_s and max_abs_error
+    :rtype: pd.DataFrame
+    """
+    if sample is None:
+        sample = make_synthetic_sample(spectra_per_spot=10)
+    if settings is None:
+        settings = SAVE_SETTINGS
+    cube = sample.cube
+    cube.correct()
+    reference = np.stack((cube.raw, cube.corrected), axis=1)
+    rows = []
+    with tempfile.TemporaryDirectory(dir=directory) as tmp_dir:
+        for index, (setting, options) in enumerate(settings.items()):
+            extension = '.zarr' if options.get('backend') == 'zarr' else '.nc'
+            filename = os.path.join(tmp_dir, f'setting_{index}{extension}')
+            try:
+                write_s = _time(lambda: sample.save_dataset(filename, **options), repeat)
+            except ImportError as error:
+                print(f'skipping {setting}: {error}')
+                continue
+            loaded = []
+            read_s = _time(lambda: loaded.append(Sample.build_from_netcdf(filename)), repeat)
+            loaded_cube = loaded[-1].cube
+            error = np.abs(np.stack((loaded_cube.raw, loaded_cube.corrected), axis=1) - reference).max()
+            rows.append({'setting': setting,
+                         'file_mb': _disk_size(filename) / 2 ** 20,
+                         'write_s': write_s,
+                         'read_s': read_s,
+                         'max_abs_error': error})
+    report = pd.DataFrame(rows)
+    if len(report):
+        report.insert(2, 'ratio', report['file_mb'] / report['file_mb'].iloc[0])
+    return report
+
+
+if __name__ == '__main__':
+    print(benchmark_netcdf_load().to_string(index=False))
+    print(benchmark_save_options().to_string(index=False))
@@ -0,0 +1,247 @@
+import argparse
+import os
+import time
+from collections import deque
+from pathlib import Path
+import numpy as np
+from typing import Dict, Optional, Tuple
+from ramanbox.pipeline.manifest import MANIFEST_NAME, BuildManifest
+from ramanbox.pipeline.pipelines import _ConversionPool, _conversion_params, _convert_file, _parser_class, _print_row
+from ramanbox.raman.parallel import resolve_n_jobs
+from ramanbox.raman.processing import ABCSpecProcessor
+from ramanbox.raman.sample_builder import SampleBuilder
+
+
+class IngestDaemon:
+    """
+    A long running service converting raster .txt files as they appear in a watched folder. The folder is
+    polled every poll_interval seconds, a file is converted once its size and mtime have not changed for
+    settle_time seconds (so files still being written are left alone), and converted files are recorded in
+    the same BuildManifest as raw_raster_to_unlabeled_netcdf, so a restarted daemon does not redo them.
+    Queue depth, throughput and latency counters are available from stats. A worker process that dies does
+    not stop the service, the pool is restarted and the files it was converting are rerun.
+    """
+    def __init__(self, input_dir: str, output_dir: str, processor: Optional[ABCSpecProcessor] = None,
+                 poll_interval: float = 1.0, settle_time: float = 2.0, n_jobs: Optional[int] = 1,
+                 backend: str = 'netcdf', save_options: Optional[Dict] = None, cache_dir: Optional[str] = None,
+                 status_interval: float = 60.0, n_latencies: int = 1000) -> None:
+        """
+        Initilization function
+        :param input_dir: directory searched (recursively) for .txt files
+        :type input_dir: str
+        :param output_dir: directory the samples are saved to
+        :type output_dir: str
+        :param processor: processor used to correct the spectra, if None a SpectrumProcessor is used
+        :type processor: Optional[ABCSpecProcessor]
+        :param poll_interval: seconds between scans of input_dir
+        :type poll_interval: float
+        :param settle_time: seconds a file's size and mtime must stay the same before it is converted
+        :type settle_time: float
+        :param n_jobs: number of worker processes, with 1 files are converted in the polling process
+        :type n_jobs: Optional[int]
+        :param backend: output backend, see Sample.save_dataset
+        :type backend: str
+        :param save_options: encoding options passed to Sample.save_dataset
+        :type save_options: Optional[Dict]
+        :param cache_dir: directory of a ParseCache, if None files are always parsed
+        :type cache_dir: Optional[str]
+        :param status_interval: seconds between status lines printed by run, 0 to disable them
+        :type status_interval: float
+        :param n_latencies: number of recent conversions the latency statistics are computed from
+        :type n_latencies: int
+        """
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.n_jobs = n_jobs
+        self.status_interval = status_interval
+        os.makedirs(output_dir, exist_ok=True)
+        if save_options is None:
+            save_options = {}
+        self.manifest = BuildManifest(os.path.join(output_dir, MANIFEST_NAME))
+        self.params = _conversion_params(SampleBuilder, processor, backend, save_options)
+        self.args = (output_dir, SampleBuilder, _parser_class(cache_dir), processor, backend, save_options, True)
+
+        self.waiting: Dict[str, Tuple[Tuple[int, int], float]] = {}  # file -> ((size, mtime_ns), last change)
+        self.failed: Dict[str, Tuple[int, int]] = {}  # failed files are retried once they change
+        self.n_converted = 0
+        self.n_failed = 0
+        self.n_spectra = 0
+        self.latencies = deque(maxlen=n_latencies)  # seconds from the last write of a file to its output
+        self.started = time.monotonic()
+        self._pool: Optional[_ConversionPool] = None
+        self._stop = False
+
+    def scan(self) -> None:
+        """
+        Adds new and changed .txt files to the waiting queue and restarts the settle clock of files that
+        are still being written
+        :return: None
+        :rtype: None
+        """
+        now = time.monotonic()
+        converting = set(self._pool.files) if self._pool is not None else set()
+        for file in Path(self.input_dir).rglob('*.txt'):
+            key = str(file)
+            if key in converting:
+                continue
+            try:
+                stat = file.stat()
+            except FileNotFoundError:  # removed since it was listed
+                self.waiting.pop(key, None)
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if key in self.waiting:
+                if self.waiting[key][0] != signature:
+                    self.waiting[key] = (signature, now)
+            elif self.failed.get(key) != signature and not self.manifest.is_current(key, self.params):
+                self.waiting[key] = (signature, now)
+
+    def submit_ready(self) -> int:
+        """
+        Converts (or submits to the worker pool) every waiting file that has settled. While the pool reruns
+        the files of a dead worker, settled files are left waiting.
+        :return: number of files started
+        :rtype: int
+        """
+        if self._pool is not None and not self._pool.can_submit(float('inf')):
+            return 0
+        now = time.monotonic()
+        ready = [key for key, ((size, _), changed) in self.waiting.items()
+                 if size > 0 and now - changed >= self.settle_time]
+        for key in ready:
+            self.waiting.pop(key)
+            if self._pool is None:
+                self._finish(_convert_file(key, *self.args))
+            else:
+                self._pool.submit(key)
+        return len(ready)
+
+    def collect(self) -> int:
+        """
+        Records the conversions the worker pool has finished
+        :return: number of files collected
+        :rtype: int
+        """
+        if self._pool is None:
+            return 0
+        rows = self._pool.collect(timeout=0)
+        for row in rows:
+            self._finish(row)
+        return len(rows)
+
+    def _finish(self, row: Dict) -> None:
+        _print_row(row)
+        fingerprint = row.pop('fingerprint', None)
+        if row['error'] is None:
+            self.manifest.record(row['file'], fingerprint, self.params, row['output'], n_spectra=row['n_spectra'])
+            self.n_converted += 1
+            self.n_spectra += row['n_spectra']
+            self.latencies.append(time.time() - fingerprint['mtime_ns'] / 1e9)
+            self.failed.pop(row['file'], None)
+        else:
+            self.n_failed += 1
+            try:
+                stat = os.stat(row['file'])
+                self.failed[row['file']] = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                pass
+
+    def poll(self) -> None:
+        """
+        One iteration of the service: collect finished conversions, scan the folder and start settled files
+        :return: None
+        :rtype: None
+        """
+        self.collect()
+        self.scan()
+        self.submit_ready()
+
+    def stats(self) -> Dict:
+        """
+        Counters of the service
+        :return: dictionary with waiting (files settling), in_flight (files being converted), queue_depth
+        (both), converted, failed, spectra, files_per_s and spectra_per_s since the start, and the median,
+        95th percentile and maximum latency in seconds (from the last write of a file to its output being
+        saved) over the recent conversions
+        :rtype: Dict
+        """
+        elapsed = time.monotonic() - self.started
+        in_flight = len(self._pool) if self._pool is not None else 0
+        latencies = np.array(self.latencies)
+        percentiles = np.percentile(latencies, [50, 95, 100]).tolist() if len(latencies) else [np.nan] * 3
+        return {'waiting': len(self.waiting),
+                'in_flight': in_flight,
+                'queue_depth': len(self.waiting) + in_flight,
+                'converted': self.n_converted,
+                'failed': self.n_failed,
+                'spectra': self.n_spectra,
+                'files_per_s': self.n_converted / elapsed,
+                'spectra_per_s': self.n_spectra / elapsed,
+                'latency_p50_s': percentiles[0],
+                'latency_p95_s': percentiles[1],
+                'latency_max_s': percentiles[2]}
+
+    def print_status(self) -> None:
+        stats = self.stats()
+        print(f"queue depth {stats['queue_depth']} ({stats['waiting']} settling, {stats['in_flight']} converting), "
+              f"{stats['converted']} converted, {stats['failed']} failed, {stats['spectra_per_s']:.0f} spectra/s, "
+              f"latency p50 {stats['latency_p50_s']:.1f} s p95 {stats['latency_p95_s']:.1f} s")
+
+    def stop(self) -> None:
+        """
+        Asks run to return after the current iteration (e.g. from another thread)
+        :return: None
+        :rtype: None
+        """
+        self._stop = True
+
+    def run(self, max_seconds: Optional[float] = None) -> Dict:
+        """
+        Polls the input folder until stop is called, max_seconds have passed or the process is interrupted
+        (Ctrl-C). Conversions that were started are finished before returning.
+        :param max_seconds: run time limit, None to run until stopped
+        :type max_seconds: Optional[float]
+        :return: the final stats
+        :rtype: Dict
+        """
+        print(f'watching {self.input_dir} for .txt files, writing to {self.output_dir}')
+        self._stop = False
+        deadline = None if max_seconds is None else time.monotonic() + max_seconds
+        last_status = time.monotonic()
+        if resolve_n_jobs(self.n_jobs) > 1:
+            self._pool = _ConversionPool(resolve_n_jobs(self.n_jobs), self.args)
+        try:
+            while not self._stop and (deadline is None or time.monotonic() < deadline):
+                self.poll()
+                if self.status_interval and time.monotonic() - last_status >= self.status_interval:
+                    self.print_status()
+                    last_status = time.monotonic()
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print('stopping, waiting for the conversions in progress')
+        finally:
+            if self._pool is not None:
+                with self._pool as pool:
+                    while len(pool):
+                        for row in pool.collect():
+                            self._finish(row)
+                self._pool = None
+        self.print_status()
+        return self.stats()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert raster .txt files as they appear in a folder')
+    parser.add_argument('input_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--settle-time', type=float, default=2.0)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--backend', default='netcdf')
+    parser.add_argument('--cache-dir', default=None)
+    options = parser.parse_args()
+    IngestDaemon(options.input_dir, options.output_dir, poll_interval=options.poll_interval,
+                 settle_time=options.settle_time, n_jobs=options.jobs, backend=options.backend,
+                 cache_dir=options.cache_dir).run()
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, Tuple
+
+MANIFEST_NAME = '.ramanbox_manifest.json'  # default manifest filename, written to the output directory
+
+
+def _input_files(filepath: str):
+    """
+    The files an input is made of, itself or, for a folder input (a sample of spot files), its .txt files
+    """
+    if os.path.isdir(filepath):
+        return sorted(Path(filepath).glob('*.txt'))
+    return [Path(filepath)]
+
+
+def file_digest(filepath: str, block_size: int = 2 ** 20) -> str:
+    """
+    sha256 of the contents of a file, or of the names and contents of the .txt files of a folder
+    :param filepath: filepath to the file or folder
+    :type filepath: str
+    :param block_size: number of bytes read at a time
+    :type block_size: int
+    :return: hex digest
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    is_folder = os.path.isdir(filepath)
+    for path in _input_files(filepath):
+        if is_folder:
+            digest.update(path.name.encode() + b'\0')
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(block_size), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def input_stat(filepath: str) -> Tuple[int, int]:
+    """
+    Size and mtime of an input. For a folder: the total size of its .txt files and the latest mtime of the
+    folder and those files, so adding, removing or editing a file changes it.
+    :param filepath: filepath to the file or folder
+    :type filepath: str
+    :return: size in bytes and mtime in ns
+    :rtype: Tuple[int, int]
+    """
+    stat = os.stat(filepath)
+    if not os.path.isdir(filepath):
+        return stat.st_size, stat.st_mtime_ns
+    stats = [path.stat() for path in _input_files(filepath)]
+    return (sum(file_stat.st_size for file_stat in stats),
+            max([stat.st_mtime_ns] + [file_stat.st_mtime_ns for file_stat in stats]))
+
+
+def atomic_replace(tmp_path: str, path: str) -> None:
+    """
+    Moves a finished output (file or directory) into place. A file replaces the old output in one step, an
+    old directory is moved aside first and deleted once the new one is in place.
+    :param tmp_path: the finished output, on the same filesystem as path
+    :type tmp_path: str
+    :param path: final path of the output
+    :type path: str
+    :return: None
+    :rtype: None
+    """
+    if not os.path.isdir(path):
+        os.replace(tmp_path, path)
+        return
+    old_path = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.old')
+    os.replace(path, os.path.join(old_path, 'output'))
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+class BuildManifest:
+    """
+    A json record of the inputs a conversion has already turned into outputs. Each entry holds the input's
+    size, mtime and sha256, the processing parameters and the output path, so a rerun can skip inputs that
+    are unchanged and were converted with the same parameters. The manifest is rewritten atomically after
+    every recorded input, so an interrupted run resumes from the last finished file.
+    """
+    def __init__(self, manifest_path: str) -> None:
+        """
+        Initilization function, an existing manifest is loaded
+        :param manifest_path: filepath of the json manifest
+        :type manifest_path: str
+        """
+        self.manifest_path = Path(manifest_path)
+        self.entries: Dict[str, Dict] = {}
+        try:
+            with open(self.manifest_path) as infile:
+                self.entries = json.load(infile)['entries']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):  # unreadable manifest, everything is converted again
+            print(f'ignoring unreadable manifest {self.manifest_path}')
+
+    @staticmethod
+    def fingerprint(filepath: str) -> Dict:
+        """
+        Size, mtime and content hash of an input (a file or a folder of spot files), see input_stat
+        :param filepath: filepath to the input
+        :type filepath: str
+        :return: dictionary with size, mtime_ns and sha256
+        :rtype: Dict
+        """
+        size, mtime_ns = input_stat(filepath)
+        return {'size': size, 'mtime_ns': mtime_ns, 'sha256': file_digest(filepath)}
+
+    def is_current(self, filepath: str, params: Dict) -> bool:
+        """
+        Checks if an input was converted with params and has not changed since. The file is only hashed if
+        its size matches but its mtime differs (e.g. it was copied or touched).
+        :param filepath: filepath to the input
+        :type filepath: str
+        :param params: json serializable processing parameters
+        :type params: Dict
+        :return: True if the recorded output can be reused
+        :rtype: bool
+        """
+        entry = self.entries.get(str(filepath))
+        if entry is None or entry['params'] != params or not os.path.exists(entry['output']):
+            return False
+        size, mtime_ns = input_stat(filepath)
+        if size != entry['size']:
+            return False
+        if mtime_ns == entry['mtime_ns']:
+            return True
+        if file_digest(filepath) != entry['sha256']:
+            return False
+        entry['mtime_ns'] = mtime_ns  # same contents, skip the hash next time
+        return True
+
+    def record(self, filepath: str, fingerprint: Dict, params: Dict, output: str, **info) -> None:
+        """
+        Records a converted input and saves the manifest
+        :param filepath: filepath to the input
+        :type filepath: str
+        :param fingerprint: fingerprint of the input taken before it was converted
+        :type fingerprint: Dict
+        :param params: json serializable processing parameters
+        :type params: Dict
+        :param output: filepath of the output
+        :type output: str
+        :param info: other json serializable values stored with the entry (e.g. n_spectra)
+        :return: None
+        :rtype: None
+        """
+        self.entries[str(filepath)] = {**fingerprint, 'params': params, 'output': str(output), **info}
+        self.save()
+
+    def save(self) -> None:
+        """
+        Writes the manifest under a temporary name and renames it, so it is never left partially written
+        :return: None
+        :rtype: None
+        """
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.manifest_path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump({'entries': self.entries}, outfile, indent=1)
+            os.replace(tmp_path, self.manifest_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
@@ -1,25 +1,479 @@
+import json
 import os
+import shutil
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from pathlib import Path
+import pandas as pd
 from ramanbox.raman.sample_builder import SampleBuilder
-from ramanbox.raman.sample import Sample
+from ramanbox.raman.sample import LAYOUT_VERSION, Sample
+from ramanbox.raman.processing import ABCSpecProcessor, DefaultSpotParser
+from ramanbox.raman.parse_cache import ParseCache
+from ramanbox.raman.parallel import resolve_n_jobs
+from ramanbox.pipeline.manifest import MANIFEST_NAME, BuildManifest, atomic_replace
+from ramanbox.pipeline.profiling import FileProfiler, print_profile, profile_frame, save_profile
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
+OUTPUT_EXTENSIONS = {'netcdf': '.nc', 'zarr': '.zarr'}
 
-def raw_raster_to_unlabeled_netcdf(input_dir: str, output_dir: str) -> None:
-    _raw_raster_to_unlabeled_netcdf(input_dir, output_dir, SampleBuilder)
 
+def raw_raster_to_unlabeled_netcdf(input_dir: str, output_dir: str,
+                                   processor: Optional[ABCSpecProcessor] = None,
+                                   cache_dir: Optional[str] = None, backend: str = 'netcdf',
+                                   save_options: Optional[Dict] = None, n_jobs: Optional[int] = 1,
+                                   max_in_flight: Optional[int] = None, incremental: bool = False,
+                                   profile: Optional[str] = None) -> pd.DataFrame:
+    return _raw_raster_to_unlabeled_netcdf(input_dir, output_dir, SampleBuilder, processor, cache_dir, backend,
+                                           save_options, n_jobs, max_in_flight, incremental, profile)
 
-def raw_sample_to_unlabeled_netcdf(input_dir: str, output_dir: str) -> None:
-    _raw_raster_to_unlabeled_netcdf(input_dir, output_dir, Sample.build_sample)
 
+def raw_sample_to_unlabeled_netcdf(input_dir: str, output_dir: str,
+                                   processor: Optional[ABCSpecProcessor] = None,
+                                   cache_dir: Optional[str] = None, backend: str = 'netcdf',
+                                   save_options: Optional[Dict] = None, n_jobs: Optional[int] = 1,
+                                   max_in_flight: Optional[int] = None, incremental: bool = False,
+                                   profile: Optional[str] = None) -> pd.DataFrame:
+    """
+    Same as raw_raster_to_unlabeled_netcdf, but every folder under input_dir holding .txt spot files is one
+    sample (see Sample.build_sample), saved as <folder name>.nc
+    """
+    return _raw_raster_to_unlabeled_netcdf(input_dir, output_dir, FolderSampleBuilder, processor, cache_dir, backend,
+                                           save_options, n_jobs, max_in_flight, incremental, profile)
 
-def _raw_raster_to_unlabeled_netcdf(input_dir: str, output_dir: str, sample_builder) -> None:
-    file_list = Path(input_dir).rglob('*.txt')
 
-    for file in file_list:
-        print(f'loading {file}')
-        tmp_sb = sample_builder(file)
-        tmp_sample = tmp_sb.build_sample()
-        new_filename = tmp_sample.name + '.nc'
-        output_file = os.path.join(output_dir, new_filename)
-        tmp_sample.save_dataset(output_file)
-        print(f"wrote output file {new_filename} to {output_dir}")
+REPORT_COLUMNS = ['file', 'output', 'n_spectra', 'seconds', 'skipped', 'error']
+
+
+class FolderSampleBuilder:
+    """
+    Builds the sample of a folder of spot files with Sample.build_sample, behind the same interface as
+    SampleBuilder so the conversion pipelines can use either. The spot files are parsed by build_sample, so
+    a profile counts parsing in the build stage.
+    """
+    def __init__(self, folder_path: str, parser_class=DefaultSpotParser,
+                 processor: Optional[ABCSpecProcessor] = None, lazy: bool = False) -> None:
+        self.folder_path = folder_path
+        self.parser_class = parser_class
+        self.processor = processor
+        self.lazy = lazy
+
+    @staticmethod
+    def find_inputs(input_dir: str) -> List[Path]:
+        """
+        The folders under input_dir (including itself) that hold .txt spot files
+        :param input_dir: directory searched recursively
+        :type input_dir: str
+        :return: sorted folder paths
+        :rtype: List[Path]
+        """
+        return sorted({file.parent for file in Path(input_dir).rglob('*.txt')})
+
+    @property
+    def name(self) -> str:
+        return Path(self.folder_path).name
+
+    def build_sample(self) -> Sample:
+        return Sample.build_sample(str(self.folder_path), self.parser_class, name=self.name,
+                                   processor=self.processor, lazy=self.lazy)
+
+
+def _parser_class(cache_dir: Optional[str] = None):
+    if cache_dir is None:
+        return DefaultSpotParser
+    return partial(DefaultSpotParser, cache=ParseCache(cache_dir))  # parsed files are reused, see ParseCache
+
+
+def _conversion_params(sample_builder, processor: Optional[ABCSpecProcessor], backend: str,
+                       save_options: Dict, block_size: Optional[int] = None) -> Dict:
+    """
+    The parameters an output depends on, as stored in the build manifest. Processors are identified by their
+    class and, if they have one (e.g. ProcessingPipeline), their to_config. The block_size of streamed
+    conversions is recorded too, as cosmic rays are found within each block.
+    """
+    params = {'builder': f'{sample_builder.__module__}.{sample_builder.__qualname__}',
+              'processor': None,
+              'backend': backend,
+              'save_options': save_options,
+              'layout_version': LAYOUT_VERSION}
+    if block_size is not None:
+        params['block_size'] = block_size
+    if processor is not None:
+        params['processor'] = {'class': type(processor).__name__,
+                               'config': processor.to_config() if hasattr(processor, 'to_config') else None}
+    return json.loads(json.dumps(params))  # compare as stored, e.g. tuples become lists
+
+
+def _save_atomically(sample: Sample, output_file: str, backend: str, save_options: Dict) -> None:
+    """
+    Saves a sample under a temporary name next to output_file and moves it into place once it is complete,
+    so a crash never leaves a truncated output
+    """
+    _write_atomically(lambda tmp_file: sample.save_dataset(tmp_file, backend=backend, **save_options), output_file)
+
+
+def _write_atomically(write: Callable[[str], Any], output_file: str) -> Any:
+    """
+    Calls write with a temporary filename next to output_file and moves the file into place once write
+    returns, see _save_atomically
+    :return: what write returns
+    """
+    directory, filename = os.path.split(output_file)
+    tmp_file = os.path.join(directory, f'.{filename}.{os.getpid()}.tmp')
+    try:
+        result = write(tmp_file)
+        atomic_replace(tmp_file, output_file)
+        return result
+    except BaseException:
+        if os.path.isdir(tmp_file):
+            shutil.rmtree(tmp_file, ignore_errors=True)
+        elif os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+        raise
+
+
+def _convert_file(file: Path, output_dir: str, sample_builder, parser_class, processor: Optional[ABCSpecProcessor],
+                  backend: str, save_options: Dict, fingerprint: bool = False, profile: bool = False,
+                  block_size: Optional[int] = None) -> Dict:
+    """
+    Builds and saves the sample of a single file, this is the unit of work sent to worker processes.
+    Errors are caught and returned, so one bad file does not stop the run. If block_size is given the file
+    is streamed instead (see _stream_file).
+    :return: row of the conversion report, with the input's BuildManifest.fingerprint (taken before it is
+    read) under 'fingerprint' if fingerprint is True and the FileProfiler rows of the parse, build, correct
+    and write stages under 'profile' if profile is True
+    :rtype: Dict
+    """
+    if block_size is not None:
+        return _stream_file(file, output_dir, sample_builder, parser_class, processor, save_options, fingerprint,
+                            profile, block_size)
+    start = time.perf_counter()
+    row = {'file': str(file), 'output': None, 'n_spectra': 0, 'seconds': 0.0, 'skipped': False, 'error': None}
+    profiler = FileProfiler(file, enabled=profile)
+    try:
+        if fingerprint:
+            row['fingerprint'] = BuildManifest.fingerprint(file)
+        with profiler.stage('parse'):
+            tmp_sb = sample_builder(file, parser_class=parser_class, processor=processor, lazy=True)
+        with profiler.stage('build'):
+            tmp_sample = tmp_sb.build_sample()
+            profiler.n_spectra = tmp_sample.cube.n_spectra
+        # the processor the cube corrects with, e.g. the shared SpectrumProcessor a FolderSampleBuilder's spots use
+        with profiler.stage('correct', tmp_sample.cube.processor):
+            tmp_sample.materialize()  # the whole raster is corrected in one batch, as build_sample does
+        output_file = os.path.join(output_dir, tmp_sample.name + OUTPUT_EXTENSIONS[backend])
+        with profiler.stage('write'):
+            _save_atomically(tmp_sample, output_file, backend, save_options)
+        row.update(output=output_file, n_spectra=tmp_sample.cube.n_spectra)
+    except Exception as error:
+        row['error'] = f'{type(error).__name__}: {error}'
+    row['seconds'] = time.perf_counter() - start
+    if profile:
+        row['profile'] = profiler.rows
+    return row
+
+
+def _stream_file(file: Path, output_dir: str, sample_builder, parser_class, processor: Optional[ABCSpecProcessor],
+                 save_options: Dict, fingerprint: bool, profile: bool, block_size: int) -> Dict:
+    """
+    Same as _convert_file, but the spectra are parsed, corrected and appended to the netcdf file block_size at
+    a time (see SampleBuilder.iter_spots and Sample.save_spots), so peak memory does not grow with the size
+    of the raster. As the blocks are interleaved, their parse, correct and write time is profiled as a
+    single 'stream' stage.
+    """
+    start = time.perf_counter()
+    row = {'file': str(file), 'output': None, 'n_spectra': 0, 'seconds': 0.0, 'skipped': False, 'error': None}
+    profiler = FileProfiler(file, enabled=profile)
+    try:
+        if fingerprint:
+            row['fingerprint'] = BuildManifest.fingerprint(file)
+        with profiler.stage('parse'):  # the metadata, the spectra are parsed block by block
+            tmp_sb = sample_builder(file, parser_class=parser_class, processor=processor, stream=True)
+        output_file = os.path.join(output_dir, tmp_sb.name + OUTPUT_EXTENSIONS['netcdf'])
+        with profiler.stage('stream', tmp_sb.processor):
+            n_spots = _write_atomically(lambda tmp_file: Sample.save_spots(tmp_sb.iter_spots(block_size), tmp_file,
+                                                                           name=tmp_sb.name, **save_options),
+                                        output_file)
+        profiler.n_spectra = n_spots  # one spectrum per spot
+        row.update(output=output_file, n_spectra=n_spots)
+    except Exception as error:
+        row['error'] = f'{type(error).__name__}: {error}'
+    row['seconds'] = time.perf_counter() - start
+    if profile:
+        row['profile'] = profiler.rows
+    return row
+
+
+def _print_row(row: Dict) -> None:
+    if row['error'] is None:
+        print(f"wrote output file {os.path.basename(row['output'])} ({row['n_spectra']} spectra, "
+              f"{row['seconds']:.2f} s)")
+    else:
+        print(f"failed {row['file']}: {row['error']}")
+
+
+def _raw_raster_to_unlabeled_netcdf(input_dir: str, output_dir: str, sample_builder,
+                                    processor: Optional[ABCSpecProcessor] = None,
+                                    cache_dir: Optional[str] = None, backend: str = 'netcdf',
+                                    save_options: Optional[Dict] = None, n_jobs: Optional[int] = 1,
+                                    max_in_flight: Optional[int] = None, incremental: bool = False,
+                                    profile: Optional[str] = None, block_size: Optional[int] = None) -> pd.DataFrame:
+    """
+    Builds a sample from every .txt file under input_dir (every folder of spot files for a
+    FolderSampleBuilder, see its find_inputs) and saves it to output_dir. With n_jobs != 1 the
+    files are converted by a pool of worker processes, at most max_in_flight files are queued or being
+    converted at a time. A file that fails is reported and skipped, the run carries on with the other files.
+    If a worker process dies the pool is restarted and the files it was converting are rerun one at a time,
+    only a file that kills a worker on its own is reported as failed.
+    Outputs are written under a temporary name and renamed when complete.
+    :param save_options: encoding options passed to Sample.save_dataset, e.g.
+    {'compression': 'zlib', 'compression_level': 4, 'dtype': 'float32'}
+    :type save_options: Optional[Dict]
+    :param n_jobs: number of worker processes (-1 for all cores), see ramanbox.raman.parallel.resolve_n_jobs
+    :type n_jobs: Optional[int]
+    :param max_in_flight: bound on the files submitted to the pool and not yet collected, if None twice the
+    number of workers
+    :type max_in_flight: Optional[int]
+    :param incremental: if True converted files are recorded in a BuildManifest (a hidden MANIFEST_NAME file)
+    in output_dir, and files that are unchanged since they were converted with the same parameters are
+    skipped, so an interrupted or repeated run only converts new, changed or failed files. Off by default,
+    every file is then converted and nothing is written besides the outputs.
+    :type incremental: bool
+    :param profile: filepath of a profiling report (.json, otherwise csv). If given, the wall time, CPU time,
+    peak RSS and airPLS iterations of the parse, build, correct and write stages of every converted file are
+    written there (see ramanbox.pipeline.profiling) and summarized in a printed table
+    :type profile: Optional[str]
+    :param block_size: if given, each file is streamed to a netcdf file this many spectra at a time instead of
+    being built in memory (see stream_raster_to_unlabeled_netcdf)
+    :type block_size: Optional[int]
+    :return: one row per file with file, output, n_spectra, seconds, skipped and error (None if converted)
+    :rtype: pd.DataFrame
+    """
+    if save_options is None:
+        save_options = {}
+    if hasattr(sample_builder, 'find_inputs'):
+        file_list = sample_builder.find_inputs(input_dir)
+    else:
+        file_list = sorted(Path(input_dir).rglob('*.txt'))
+    parser_class = _parser_class(cache_dir)
+    args = (output_dir, sample_builder, parser_class, processor, backend, save_options, incremental,
+            profile is not None, block_size)
+
+    start = time.perf_counter()
+    rows = []
+    manifest = None
+    if incremental:
+        manifest = BuildManifest(os.path.join(output_dir, MANIFEST_NAME))
+        params = _conversion_params(sample_builder, processor, backend, save_options, block_size)
+        pending = []
+        for file in file_list:
+            if manifest.is_current(file, params):
+                entry = manifest.entries[str(file)]
+                rows.append({'file': str(file), 'output': entry['output'], 'n_spectra': entry.get('n_spectra', 0),
+                             'seconds': 0.0, 'skipped': True, 'error': None})
+            else:
+                pending.append(file)
+        if rows:
+            print(f'skipping {len(rows)} files that are up to date')
+        file_list = pending
+
+    profile_rows = []
+
+    def finish(row: Dict) -> None:
+        _print_row(row)
+        fingerprint = row.pop('fingerprint', None)
+        profile_rows.extend(row.pop('profile', []))
+        if manifest is not None and row['error'] is None:
+            manifest.record(row['file'], fingerprint, params, row['output'], n_spectra=row['n_spectra'])
+        rows.append(row)
+
+    n_workers = resolve_n_jobs(n_jobs)
+    if n_workers == 1:
+        for file in file_list:
+            print(f'loading {file}')
+            finish(_convert_file(file, *args))
+    else:
+        if max_in_flight is None:
+            max_in_flight = 2 * n_workers
+        with _ConversionPool(n_workers, args) as pool:
+            for file in file_list:
+                while not pool.can_submit(max_in_flight):
+                    for row in pool.collect():
+                        finish(row)
+                print(f'queued {file}')
+                pool.submit(file)
+            while len(pool):
+                for row in pool.collect():
+                    finish(row)
+
+    if manifest is not None:
+        manifest.save()
+    report = pd.DataFrame(rows, columns=REPORT_COLUMNS)
+    _print_summary(report, time.perf_counter() - start)
+    if profile is not None:
+        profile_report = profile_frame(profile_rows)
+        save_profile(profile_report, profile)
+        print_profile(profile_report)
+        print(f'wrote profile of {profile_report["file"].nunique()} files to {profile}')
+    return report
+
+
+def _failed_row(file: Path, error: str) -> Dict:
+    return {'file': str(file), 'output': None, 'n_spectra': 0, 'seconds': 0.0, 'skipped': False, 'error': error}
+
+
+class _ConversionPool:
+    """
+    Runs _convert_file on a process pool that survives its workers dying (out of memory, a crash in a native
+    library). The pool is rebuilt when it breaks, and the files that were being converted are rerun one at a
+    time, so only a file that kills a worker on its own is reported as failed and the others are converted.
+    """
+    def __init__(self, n_workers: int, args: Tuple) -> None:
+        """
+        Initilization function
+        :param n_workers: number of worker processes
+        :type n_workers: int
+        :param args: the arguments of _convert_file after the file
+        :type args: Tuple
+        """
+        self.n_workers = n_workers
+        self.args = args
+        self.pool = ProcessPoolExecutor(max_workers=n_workers)
+        self.in_flight: Dict[Future, str] = {}
+        self.suspects = deque()  # files in flight when a worker died, rerun one at a time
+        self.isolated = False  # True while a suspect runs on its own
+        self.finished: List[Dict] = []  # rows harvested from a broken pool, returned by the next collect
+
+    def __enter__(self) -> "_ConversionPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.pool.shutdown(wait=True)
+
+    def __len__(self) -> int:
+        return len(self.in_flight) + len(self.suspects) + len(self.finished)
+
+    @property
+    def files(self) -> List[str]:
+        """
+        The files being converted, waiting to be rerun or whose rows have not been collected yet
+        """
+        return list(self.in_flight.values()) + list(self.suspects) + [row['file'] for row in self.finished]
+
+    def can_submit(self, max_in_flight: float) -> bool:
+        """
+        True if fewer than max_in_flight files are running and no files are being rerun after a crash
+        """
+        return not self.suspects and not self.isolated and len(self.in_flight) < max_in_flight
+
+    def submit(self, file: str) -> None:
+        """
+        Starts the conversion of a file. If a worker died since the last collect, the pool is restarted and
+        the file waits with the other suspects, to be run one at a time
+        """
+        try:
+            future = self.pool.submit(_convert_file, file, *self.args)
+        except BrokenProcessPool:
+            self.finished.extend(self._restart())
+            self.suspects.append(str(file))
+            return
+        self.in_flight[future] = str(file)
+
+    def collect(self, timeout: Optional[float] = None) -> List[Dict]:
+        """
+        Waits until at least one conversion finishes (or timeout seconds have passed)
+        :param timeout: seconds to wait, None to wait for a conversion to finish, 0 to only poll
+        :type timeout: Optional[float]
+        :return: report rows of the conversions that finished
+        :rtype: List[Dict]
+        """
+        self._submit_suspect()
+        rows, self.finished = self.finished, []
+        if not self.in_flight:
+            return rows
+        done, _ = wait(self.in_flight, timeout=0 if rows else timeout, return_when=FIRST_COMPLETED)
+        broken = False
+        for future in done:
+            file = self.in_flight.pop(future)
+            try:
+                rows.append(future.result())
+            except BrokenProcessPool:
+                broken = True
+                if self.isolated:  # it ran on its own, so it killed the worker
+                    rows.append(_failed_row(file, 'BrokenProcessPool: the worker process died converting this file'))
+                else:
+                    self.suspects.append(file)
+            except Exception as error:
+                rows.append(_failed_row(file, f'{type(error).__name__}: {error}'))
+        if broken:
+            rows.extend(self._restart())
+        if not self.in_flight:
+            self.isolated = False
+        self._submit_suspect()
+        return rows
+
+    def _restart(self) -> List[Dict]:
+        """
+        Replaces the broken pool, the files it was converting become suspects
+        :return: report rows of the conversions that had finished before the pool broke
+        :rtype: List[Dict]
+        """
+        rows = []
+        for future, file in self.in_flight.items():
+            if future.done() and future.exception() is None:
+                rows.append(future.result())
+            else:
+                self.suspects.append(file)
+        self.in_flight.clear()
+        self.isolated = False
+        self.pool.shutdown(wait=False)
+        self.pool = ProcessPoolExecutor(max_workers=self.n_workers)
+        print(f'a worker process died, restarted the pool ({len(self.suspects)} files to rerun one at a time)')
+        return rows
+
+    def _submit_suspect(self) -> None:
+        if self.suspects and not self.in_flight:
+            self.submit(self.suspects.popleft())
+            self.isolated = bool(self.in_flight)
+
+
+def _print_summary(report: pd.DataFrame, seconds: float) -> None:
+    converted = report[report['error'].isna() & ~report['skipped']]
+    failed = report[report['error'].notna()]
+    print(f"converted {len(converted)} of {len(report)} files ({converted['n_spectra'].sum()} spectra) "
+          f"in {seconds:.1f} s: {len(converted) / seconds:.2f} files/s, "
+          f"{converted['n_spectra'].sum() / seconds:.0f} spectra/s, {report['skipped'].sum()} up to date")
+    if len(failed):
+        print(f"{len(failed)} files failed:")
+        for _, row in failed.iterrows():
+            print(f"  {row['file']}: {row['error']}")
+
+
+def stream_raster_to_unlabeled_netcdf(input_dir: str, output_dir: str, block_size: int = 64,
+                                      processor: Optional[ABCSpecProcessor] = None,
+                                      cache_dir: Optional[str] = None, save_options: Optional[Dict] = None,
+                                      n_jobs: Optional[int] = 1, max_in_flight: Optional[int] = None,
+                                      incremental: bool = False, profile: Optional[str] = None) -> pd.DataFrame:
+    """
+    Same as raw_raster_to_unlabeled_netcdf, but each file is parsed, corrected and written block by block,
+    so peak memory does not grow with the size of the raster. Cosmic rays are found within each block.
+    Outputs are written under a temporary name and renamed when complete, and with incremental=True they
+    are recorded in the same BuildManifest as raw_raster_to_unlabeled_netcdf.
+    :param input_dir: directory searched (recursively) for .txt files
+    :type input_dir: str
+    :param output_dir: directory the netcdf files are written to
+    :type output_dir: str
+    :param block_size: number of spectra held in memory at a time
+    :type block_size: int
+    :param processor: processor used to correct the spectra, if None a SpectrumProcessor is used
+    :type processor: Optional[ABCSpecProcessor]
+    :param save_options: encoding options passed to Sample.save_spots, the integer dtypes are not supported
+    as they need the range of the whole sample
+    :type save_options: Optional[Dict]
+    :return: one row per file, see raw_raster_to_unlabeled_netcdf for this and the other parameters
+    :rtype: pd.DataFrame
+    """
+    return _raw_raster_to_unlabeled_netcdf(input_dir, output_dir, SampleBuilder, processor, cache_dir, 'netcdf',
+                                           save_options, n_jobs, max_in_flight, incremental, profile, block_size)
@@ -0,0 +1,189 @@
+import sys
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+PROFILE_STAGES = ['parse', 'build', 'correct', 'write']  # the stages of a file conversion, in order
+AIRPLS_COUNTERS = ['airpls_spectra', 'airpls_iterations', 'airpls_max_reached']
+PROFILE_COLUMNS = ['file', 'stage', 'wall_s', 'cpu_s', 'peak_rss_mb', 'n_spectra'] + AIRPLS_COUNTERS
+
+
+def _reset_peak_rss() -> bool:
+    """
+    Resets the peak resident set size of the process (Linux only)
+    :return: True if it was reset
+    :rtype: bool
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as outfile:
+            outfile.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb() -> float:
+    """
+    Peak resident set size of the process in MiB, since the last _reset_peak_rss where that is supported
+    :return: peak RSS, NaN if it cannot be measured
+    :rtype: float
+    """
+    try:
+        with open('/proc/self/status') as infile:
+            for line in infile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return np.nan
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KiB elsewhere
+
+
+def _airpls_counters(processor) -> Optional[Dict[str, int]]:
+    if processor is None or not hasattr(processor, 'airpls_iterations'):
+        return None
+    return {counter: getattr(processor, counter) for counter in AIRPLS_COUNTERS}
+
+
+class FileProfiler:
+    """
+    Records wall time, CPU time and peak resident memory of each stage of the conversion of one file. The
+    peak is reset at the start of every stage on Linux, elsewhere it is the peak of the process so far.
+    A disabled profiler records nothing, so the conversion code is the same with and without profiling.
+    """
+    def __init__(self, file: str, enabled: bool = True) -> None:
+        """
+        Initilization function
+        :param file: the file being converted
+        :type file: str
+        :param enabled: if False stage does not measure anything
+        :type enabled: bool
+        """
+        self.file = str(file)
+        self.enabled = enabled
+        self.n_spectra = 0
+        self._rows: List[Dict] = []
+
+    @contextmanager
+    def stage(self, name: str, processor=None) -> Iterator[None]:
+        """
+        Profiles the block run under it, e.g. with profiler.stage('parse'): ...
+        :param name: name of the stage
+        :type name: str
+        :param processor: processor whose airPLS counters (see SpectrumProcessor) are recorded over the stage
+        :return: None
+        """
+        if not self.enabled:
+            yield
+            return
+        before = _airpls_counters(processor)
+        _reset_peak_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            row = {'file': self.file, 'stage': name,
+                   'wall_s': time.perf_counter() - wall,
+                   'cpu_s': time.process_time() - cpu,
+                   'peak_rss_mb': _peak_rss_mb()}
+            after = _airpls_counters(processor)
+            if before is not None:
+                row.update((counter, after[counter] - before[counter]) for counter in AIRPLS_COUNTERS)
+            self._rows.append(row)
+
+    @property
+    def rows(self) -> List[Dict]:
+        """
+        The recorded stages, each with the number of spectra in the file
+        :return: one dictionary per stage with the PROFILE_COLUMNS
+        :rtype: List[Dict]
+        """
+        return [{**row, 'n_spectra': self.n_spectra} for row in self._rows]
+
+
+def profile_frame(rows: List[Dict]) -> pd.DataFrame:
+    """
+    :param rows: stage rows of any number of files, see FileProfiler.rows
+    :type rows: List[Dict]
+    :return: one row per file and stage with the PROFILE_COLUMNS
+    :rtype: pd.DataFrame
+    """
+    return pd.DataFrame(rows, columns=PROFILE_COLUMNS)
+
+
+def save_profile(profile: pd.DataFrame, filename: str) -> None:
+    """
+    Writes a profile to a .json file (a list of row records) or otherwise to a csv file
+    :param profile: the profile, see profile_frame
+    :type profile: pd.DataFrame
+    :param filename: filepath of the report
+    :type filename: str
+    :return: None
+    :rtype: None
+    """
+    if str(filename).endswith('.json'):
+        profile.to_json(filename, orient='records', indent=1)
+    else:
+        profile.to_csv(filename, index=False)
+
+
+def summarize_profile(profile: pd.DataFrame) -> pd.DataFrame:
+    """
+    Totals of every stage over the files of a profile
+    :param profile: the profile, see profile_frame
+    :type profile: pd.DataFrame
+    :return: one row per stage with files, spectra, wall_s, cpu_s, ms_per_spectrum, cpu_fraction (CPU time
+    over wall time, low values point at I/O), max_peak_rss_mb, fraction of the total wall time and
+    airpls_iterations_per_spectrum
+    :rtype: pd.DataFrame
+    """
+    grouped = profile.groupby('stage', sort=False)
+    summary = pd.DataFrame({'files': grouped['file'].count(),
+                            'spectra': grouped['n_spectra'].sum(),
+                            'wall_s': grouped['wall_s'].sum(),
+                            'cpu_s': grouped['cpu_s'].sum(),
+                            'max_peak_rss_mb': grouped['peak_rss_mb'].max(),
+                            'airpls_spectra': grouped['airpls_spectra'].sum(min_count=1),
+                            'airpls_iterations': grouped['airpls_iterations'].sum(min_count=1)})
+    summary = summary.reindex([stage for stage in PROFILE_STAGES if stage in summary.index] +
+                              [stage for stage in summary.index if stage not in PROFILE_STAGES])
+    summary['ms_per_spectrum'] = 1e3 * summary['wall_s'] / summary['spectra'].replace(0, np.nan)
+    summary['cpu_fraction'] = summary['cpu_s'] / summary['wall_s']
+    summary['fraction'] = summary['wall_s'] / summary['wall_s'].sum()
+    summary['airpls_iterations_per_spectrum'] = summary['airpls_iterations'] / summary['airpls_spectra']
+    return summary[['files', 'spectra', 'wall_s', 'cpu_s', 'ms_per_spectrum', 'cpu_fraction', 'max_peak_rss_mb',
+                    'fraction', 'airpls_iterations_per_spectrum']]
+
+
+def print_profile(profile: pd.DataFrame, n_slowest: int = 5) -> None:
+    """
+    Prints the per stage totals and the files that took the longest per spectrum
+    :param profile: the profile, see profile_frame
+    :type profile: pd.DataFrame
+    :param n_slowest: number of files listed
+    :type n_slowest: int
+    :return: None
+    :rtype: None
+    """
+    if profile.empty:
+        print('no files were profiled')
+        return
+    print(summarize_profile(profile).to_string(float_format=lambda value: f'{value:.3f}'))
+    per_file = profile.pivot_table(index='file', columns='stage', values='wall_s', aggfunc='sum')
+    per_file = per_file[[stage for stage in PROFILE_STAGES if stage in per_file.columns] +
+                        [stage for stage in per_file.columns if stage not in PROFILE_STAGES]]
+    per_file['total_s'] = per_file.sum(axis=1)
+    n_spectra = profile.groupby('file')['n_spectra'].first()
+    per_file['ms_per_spectrum'] = 1e3 * per_file['total_s'] / n_spectra.replace(0, np.nan)
+    slowest = per_file.sort_values('ms_per_spectrum', ascending=False).head(n_slowest)
+    print('slowest files per spectrum:')
+    print(slowest.to_string(float_format=lambda value: f'{value:.3f}'))
@@ -1,9 +1,14 @@
 # import ramanbox.raman.builders
 # import ramanbox.raman.constants
+# import ramanbox.raman.parallel
+# import ramanbox.raman.parse_cache
 # import ramanbox.raman.processing
+# import ramanbox.raman.processing_pipeline
 # import ramanbox.raman.sample
 # import ramanbox.raman.sample_builder
+# import ramanbox.raman.spectral_cube
 # import ramanbox.raman.spectrum
 # import ramanbox.raman.spot
+# import ramanbox.raman.whittaker
 
 
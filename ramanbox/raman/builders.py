@@ -1,12 +1,36 @@
-from ramanbox.raman.processing import SpectrumProcessor, DefaultSpotParser
-from ramanbox.raman.spot import Spot
-from ramanbox.raman.spectrum import Spectrum
+from ramanbox.raman.processing import ABCSpecProcessor, SpectrumProcessor, DefaultSpotParser, SpotParser
+from ramanbox.raman.spot import Spot, shared_raw_positions
+from ramanbox.raman.spectral_cube import SpectralCube
+import numpy as np
+from typing import Optional
 
 
 class SpotBuilder:
-    def __init__(self, filepath: str, parser_class=DefaultSpotParser):
+    def __init__(self, filepath: str, parser_class=DefaultSpotParser, processor: Optional[ABCSpecProcessor] = None,
+                 lazy: bool = False, parser: Optional[SpotParser] = None):
+        """
+        :param filepath: filepath to the spot .txt file
+        :type filepath: str
+        :param parser_class: a class needed for parsing the data
+        :type parser_class: SpotParser
+        :param processor: processor used to correct the spectra (e.g. a ProcessingPipeline), if None a
+        SpectrumProcessor for the parser's laser wavelength is used
+        :type processor: Optional[ABCSpecProcessor]
+        :param lazy: if True the spectra are not corrected until they are accessed or materialized
+        :type lazy: bool
+        :param parser: an already constructed parser for filepath (e.g. sent back by a worker process),
+        if None parser_class parses the file
+        :type parser: Optional[SpotParser]
+        """
         self.filepath = filepath
-        self.parser = parser_class(filepath)
+        self.lazy = lazy
+        if parser is None:
+            parser = parser_class(filepath)
+        self.parser = parser
+        if processor is None:
+            processor = SpectrumProcessor.shared(self.parser.laser_wavelength)
+        self.processor = processor
+        self.cosmic_rays_removed = 0  # spikes replaced in the spectra this builder corrected (not lazy ones)
 
     def get_position(self):  # maybe encoded in filepath at some point
         """
@@ -17,22 +41,29 @@ class SpotBuilder:
         """
         return 0, 0
 
-    def build_spot(self) -> Spot:
+    def build_spot(self, corrected: Optional[np.array] = None) -> Spot:
         """
         This builds a spot from a filepath
+        :param corrected: the spectra already corrected by the processor (e.g. in a worker process),
+        with shape (n_spectra, n_points)
+        :type corrected: Optional[np.array]
         :return: A spot created from a .txt file
         :rtype: Spot
+        :raises SpotConsistencyError: if the spectra of the file don't share a position axis
         """
-        metadata = self.parser.metadata
-        spectra = self.parser.spectra
-        spectrum_list = []
-        for spectrum in spectra:
-            new_spectrum = Spectrum(spectrum, SpectrumProcessor(self.parser.laser_wavelength),
-                                    self.parser.laser_wavelength)
-            spectrum_list.append(new_spectrum)
-
-        new_spot = Spot(spectrum_list=spectrum_list, position=self.get_position(),
-                        metadata=metadata, filepath=self.filepath)
+        spectra = np.asarray(self.parser.spectra).reshape(-1, self.parser.spectrum_length, 2)
+        # the spectra of the file share one position axis, a file whose axes differ raises SpotConsistencyError
+        raw_positions = shared_raw_positions(spectra, self.parser.laser_wavelength)
+        cube = SpectralCube(spectra[:, :, 1], raw_positions, self.processor, self.parser.laser_wavelength,
+                            corrected=corrected, spot_positions=[self.get_position()])
+        new_spot = Spot.from_cube(cube, 0, metadata=self.parser.metadata, filepath=self.filepath)
+        if not self.lazy:
+            # all spectra of the spot are corrected together, so cosmic rays are found using the neighbouring spectra
+            before = self._spikes_counted()
+            new_spot.materialize()
+            self.cosmic_rays_removed += self._spikes_counted() - before
 
         return new_spot
 
+    def _spikes_counted(self) -> int:
+        return getattr(self.processor, 'cosmic_rays_removed', 0)
@@ -0,0 +1,165 @@
+import copy
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import repeat
+import numpy as np
+from typing import Dict, Iterator, List, Optional, Tuple
+from ramanbox.raman.processing import ABCSpecProcessor, SpectrumProcessor, SpotParser
+
+
+def resolve_n_jobs(n_jobs: Optional[int]) -> int:
+    """
+    Turns an n_jobs argument into a number of worker processes (None -> 1, negative -> all cores)
+    :param n_jobs: requested number of jobs
+    :type n_jobs: Optional[int]
+    :return: number of worker processes
+    :rtype: int
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    assert n_jobs > 0, 'n_jobs must be positive, negative (count back from the number of cores) or None'
+    return n_jobs
+
+
+@contextmanager
+def process_executor(n_jobs: Optional[int] = 1, executor: Optional[Executor] = None) -> Iterator[Optional[Executor]]:
+    """
+    Context manager yielding the executor to run work on. A passed executor is used as is and left open,
+    otherwise a process pool with n_jobs workers is created and shut down afterwards. Yields None if the
+    work should run serially in this process.
+    :param n_jobs: number of worker processes
+    :type n_jobs: Optional[int]
+    :param executor: an existing executor to use instead of creating one
+    :type executor: Optional[Executor]
+    :return: the executor or None
+    :rtype: Iterator[Optional[Executor]]
+    """
+    if executor is not None:
+        yield executor
+        return
+
+    n_workers = resolve_n_jobs(n_jobs)
+    if n_workers == 1:
+        yield None
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        yield pool
+
+
+def _worker_copy(processor: ABCSpecProcessor) -> ABCSpecProcessor:
+    """
+    A copy of the processor with its stats reset, whatever a worker counts on it is sent back and merged
+    into the original (the copy also keeps thread pool workers from counting on the shared original)
+    """
+    processor = copy.deepcopy(processor)
+    processor.reset_stats()
+    return processor
+
+
+def parse_spot_file(filepath: str, parser_class, processor: Optional[ABCSpecProcessor], correct: bool = True,
+                    in_worker: bool = False) -> Tuple[SpotParser, Optional[np.array], Dict]:
+    """
+    Parses a spot file and corrects all of its spectra in a single batch. This is the unit of work sent
+    to worker processes, only the parser (metadata and raw arrays), the corrected array and the stats are
+    sent back.
+    :param filepath: filepath to the .txt file
+    :type filepath: str
+    :param parser_class: a class needed for parsing the data
+    :type parser_class: SpotParser
+    :param processor: processor used to correct the spectra, if None a SpectrumProcessor is used
+    :type processor: Optional[ABCSpecProcessor]
+    :param correct: if False the spectra are only parsed
+    :type correct: bool
+    :param in_worker: if True the spectra are corrected by a copy of the processor and the stats it counted
+    are returned, to be merged into the processor of the parent process (see ABCSpecProcessor.merge_stats)
+    :type in_worker: bool
+    :return: the parser, the corrected spectra with shape (n_spectra, n_points) (None if not corrected) and
+    the stats of the copy (empty if in_worker is False, the stats are then counted on processor itself)
+    :rtype: Tuple[SpotParser, Optional[np.array], Dict]
+    """
+    parser = parser_class(filepath)
+    if not correct:
+        return parser, None, {}
+    if processor is None:
+        processor = SpectrumProcessor.shared(parser.laser_wavelength)
+    if in_worker:
+        processor = _worker_copy(processor)
+    corrected = processor.correct_spectrum_batch(np.array([spectrum[:, 1] for spectrum in parser.spectra]))
+    return parser, corrected, processor.stats() if in_worker else {}
+
+
+def map_spot_files(file_list: List[str], parser_class, processor: Optional[ABCSpecProcessor], correct: bool = True,
+                   n_jobs: Optional[int] = 1,
+                   executor: Optional[Executor] = None) -> List[Tuple[SpotParser, Optional[np.array]]]:
+    """
+    Runs parse_spot_file on every file, in parallel if n_jobs or executor is given.
+    The results are in the same order as file_list. The stats the workers collect are merged into processor
+    (or into the shared SpectrumProcessor of each file's laser wavelength), see ABCSpecProcessor.merge_stats.
+    :param file_list: filepaths to the .txt files
+    :type file_list: List[str]
+    :param parser_class: a class needed for parsing the data
+    :type parser_class: SpotParser
+    :param processor: processor used to correct the spectra, if None a SpectrumProcessor is used
+    :type processor: Optional[ABCSpecProcessor]
+    :param correct: if False the spectra are only parsed
+    :type correct: bool
+    :param n_jobs: number of worker processes
+    :type n_jobs: Optional[int]
+    :param executor: an existing executor to use instead of creating one
+    :type executor: Optional[Executor]
+    :return: list of (parser, corrected spectra) pairs
+    :rtype: List[Tuple[SpotParser, Optional[np.array]]]
+    """
+    with process_executor(n_jobs, executor) as pool:
+        if pool is None:
+            return [parse_spot_file(file, parser_class, processor, correct)[:2] for file in file_list]
+        results = []
+        for parser, corrected, stats in pool.map(parse_spot_file, file_list, repeat(parser_class),
+                                                 repeat(processor), repeat(correct), repeat(True)):
+            if stats:
+                (processor or SpectrumProcessor.shared(parser.laser_wavelength)).merge_stats(stats)
+            results.append((parser, corrected))
+        return results
+
+
+def _correct_chunk(processor: ABCSpecProcessor, spectra: np.array,
+                   reference: Optional[np.array]) -> Tuple[np.array, Dict]:
+    processor = _worker_copy(processor)
+    return processor.correct_spectrum_batch(spectra, reference), processor.stats()
+
+
+def correct_spectra(processor: ABCSpecProcessor, spectra: np.array, n_jobs: Optional[int] = 1,
+                    executor: Optional[Executor] = None) -> np.array:
+    """
+    Corrects a 2d array of spectra, split into one contiguous chunk per worker process. The processor's
+    cosmic_ray_reference is computed over all of the spectra here and sent with every chunk, so the result
+    is the same as correcting them in a single batch, whatever the number of chunks. The stats the workers
+    collect (e.g. ProcessingPipeline timings) are merged into processor.
+    :param processor: processor used to correct the spectra
+    :type processor: ABCSpecProcessor
+    :param spectra: uncorrected spectra with shape (n_spectra, n_points)
+    :type spectra: np.array
+    :param n_jobs: number of worker processes
+    :type n_jobs: Optional[int]
+    :param executor: an existing executor to use instead of creating one
+    :type executor: Optional[Executor]
+    :return: corrected spectra, in the same order
+    :rtype: np.array
+    """
+    with process_executor(n_jobs, executor) as pool:
+        if pool is None:
+            return processor.correct_spectrum_batch(spectra)
+        n_chunks = resolve_n_jobs(n_jobs)
+        if n_chunks == 1:  # an executor was passed without n_jobs, split the work for every core
+            n_chunks = os.cpu_count() or 1
+        chunks = [chunk for chunk in np.array_split(spectra, n_chunks) if len(chunk)]
+        reference = processor.cosmic_ray_reference(spectra)
+        corrected = []
+        for chunk, stats in pool.map(_correct_chunk, repeat(processor), chunks, repeat(reference)):
+            processor.merge_stats(stats)
+            corrected.append(chunk)
+        return np.concatenate(corrected)
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+
+class ParseCache:
+    """
+    An on disk cache of parsed spot files. Each entry holds the raw spectra as a .npy file, which is
+    memory mapped when it is read back, and the metadata as a .json file. Entries are keyed by a hash of
+    the file contents and the parser settings, so an edited file or a different parser misses the cache.
+    When the cache grows past max_bytes the least recently used entries are deleted.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = 2 ** 30) -> None:
+        """
+        Initilization function
+        :param cache_dir: directory the entries are stored in, created if it does not exist
+        :type cache_dir: str
+        :param max_bytes: size the cache is trimmed to after every write
+        :type max_bytes: int
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(filepath: str, settings: Dict, block_size: int = 2 ** 20) -> str:
+        """
+        Hashes the contents of a file together with the settings used to parse it
+        :param filepath: filepath to the .txt file
+        :type filepath: str
+        :param settings: json serializable parser settings
+        :type settings: Dict
+        :param block_size: number of bytes read at a time
+        :type block_size: int
+        :return: hex digest used as the cache key
+        :rtype: str
+        """
+        digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+        with open(filepath, 'rb') as infile:
+            for block in iter(lambda: infile.read(block_size), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _paths(self, key: str) -> Tuple[Path, Path]:
+        return self.cache_dir / (key + '.npy'), self.cache_dir / (key + '.json')
+
+    def get(self, key: str) -> Optional[Tuple[Dict, np.array]]:
+        """
+        Looks up an entry. The spectra are memory mapped copy-on-write, so they can be modified
+        in memory without touching the cache.
+        :param key: cache key, see key
+        :type key: str
+        :return: metadata and spectra, or None if the entry is not cached
+        :rtype: Optional[Tuple[Dict, np.array]]
+        """
+        data_path, metadata_path = self._paths(key)
+        try:
+            with open(metadata_path) as infile:
+                metadata = json.load(infile)
+            spectra = np.load(data_path, mmap_mode='c')
+            os.utime(data_path)  # mark as recently used for eviction
+        except (OSError, ValueError):  # missing, evicted by another process or partially written
+            return None
+        return metadata, spectra
+
+    def put(self, key: str, metadata: Dict, spectra: np.array) -> None:
+        """
+        Stores an entry and evicts old entries if the cache is over max_bytes. Files are written under a
+        temporary name and then renamed, so readers never see a partial entry.
+        :param key: cache key, see key
+        :type key: str
+        :param metadata: metadata dictionary of the spot file
+        :type metadata: Dict
+        :param spectra: parsed spectra
+        :type spectra: np.array
+        :return: None
+        :rtype: None
+        """
+        data_path, metadata_path = self._paths(key)
+        for path, write in ((metadata_path, lambda f: f.write(json.dumps(metadata).encode())),
+                            (data_path, lambda f: np.save(f, np.asarray(spectra)))):
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as outfile:
+                    write(outfile)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        self.evict()
+
+    def size(self) -> int:
+        """
+        Total size of the cached entries
+        :return: size in bytes
+        :rtype: int
+        """
+        return sum(path.stat().st_size for path in self.cache_dir.glob('*.npy')) + \
+            sum(path.stat().st_size for path in self.cache_dir.glob('*.json'))
+
+    def evict(self, max_bytes: Optional[int] = None) -> int:
+        """
+        Deletes the least recently used entries until the cache fits in max_bytes
+        :param max_bytes: size to trim the cache to, if None self.max_bytes is used
+        :type max_bytes: Optional[int]
+        :return: the number of entries deleted
+        :rtype: int
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = []
+        total = 0
+        for data_path in self.cache_dir.glob('*.npy'):
+            metadata_path = data_path.with_suffix('.json')
+            try:
+                stat = data_path.stat()
+                size = stat.st_size + (metadata_path.stat().st_size if metadata_path.exists() else 0)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, size, data_path, metadata_path))
+            total += size
+
+        n_deleted = 0
+        for _, size, data_path, metadata_path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= max_bytes:
+                break
+            for path in (data_path, metadata_path):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+            total -= size
+            n_deleted += 1
+        return n_deleted
+
+    def clear(self) -> int:
+        """
+        Deletes every entry
+        :return: the number of entries deleted
+        :rtype: int
+        """
+        return self.evict(max_bytes=-1)
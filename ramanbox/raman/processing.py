@@ -1,12 +1,74 @@
 from abc import ABC
 from abc import abstractmethod
+import io
+import re
 import numpy as np
+import pandas as pd
+from scipy.ndimage import median_filter, minimum_filter
 
-# smoothing imports
-from scipy.sparse import csc_matrix, eye, diags
-from scipy.sparse.linalg import spsolve
-from typing import Tuple, Dict, List
+from typing import Any, Tuple, Dict, Iterator, List, Optional, Union
 from ramanbox.raman.constants import PositionType
+from ramanbox.raman.parse_cache import ParseCache
+from ramanbox.raman.whittaker import WhittakerSolver, get_solver
+
+
+_trapezoid = getattr(np, 'trapezoid', None) or np.trapz  # np.trapz was renamed in numpy 2.0
+
+
+_HEADER_LINE = re.compile(r'\s*([^:]*?)\s*:\s*(.*?)\s*$')  # key up to the first colon, value stripped
+_NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+_GRID_SIZE = re.compile(r'(\d+)\s*[xX*]\s*(\d+)')
+
+# typed header values, name -> (key pattern, unit group -> scale to the unit in the name)
+HEADER_VALUES = {
+    'exposure_time_s': (re.compile(r'exposure\s*time\s*(?:\((\w+)\))?', re.I),
+                        {'sec': 1, 's': 1, 'ms': 1e-3, 'min': 60}),
+    'laser_power_mw': (re.compile(r'laser\s*power\s*(?:\((\w+)\))?', re.I), {'mw': 1, 'w': 1e3}),
+}
+
+
+def parse_header_values(metadata: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Converts the header values that later stages need as numbers. Keys that are missing or
+    can't be parsed are left out, as are values in a unit not listed in HEADER_VALUES (a message is
+    printed, the raw string stays in the metadata). A key without a unit is taken to be in the unit of the name.
+    :param metadata: metadata dictionary read by DefaultSpotParser.get_metadata
+    :type metadata: Dict[str, str]
+    :return: dictionary with exposure_time_s (float), laser_power_mw (float) and grid_size (Tuple[int, int])
+    :rtype: Dict[str, Any]
+    """
+    values = {}
+    for key, value in metadata.items():
+        for name, (pattern, units) in HEADER_VALUES.items():
+            key_match = pattern.fullmatch(key)
+            number = _NUMBER.search(value) if key_match else None
+            if not number:
+                continue
+            unit = (key_match.group(1) or '').lower()
+            if unit and unit not in units:
+                print(f'ignoring header value {key}: {value}, unknown unit {key_match.group(1)}')
+                continue
+            values[name] = float(number.group()) * units.get(unit, 1)
+        if key.lower() == 'grid size':
+            grid = _GRID_SIZE.search(value)
+            if grid:
+                values['grid_size'] = (int(grid.group(1)), int(grid.group(2)))
+    return values
+
+
+def _robust_zscore(residuals: np.array) -> np.array:
+    """
+    Scales every row by its median absolute deviation, so that normally distributed noise has a
+    standard deviation of about one
+    :param residuals: 2d array of residuals
+    :type residuals: np.array
+    :return: robust z-scores with the same shape as residuals
+    :rtype: np.array
+    """
+    median = np.median(residuals, axis=1, keepdims=True)
+    mad = np.median(np.abs(residuals - median), axis=1, keepdims=True)
+    mad[mad == 0] = np.finfo(float).eps
+    return 0.6745 * (residuals - median) / mad
 
 
 class ABCSpecProcessor(ABC):
@@ -34,6 +96,59 @@ class ABCSpecProcessor(ABC):
         """
         pass
 
+    def correct_spectrum_batch(self, spectra: np.array, reference: Optional[np.array] = None) -> np.array:
+        """
+        Correct every spectrum (row) of a 2d array. Processors that can work on many spectra at once
+        should override this, the default just calls correct_spectrum on each row.
+        :param spectra: the spectra to apply modifications to, with shape (n_spectra, n_points)
+        :type spectra: np.array
+        :param reference: the cosmic_ray_reference of the whole spot or raster the spectra belong to, if None
+        it is computed from spectra
+        :type reference: Optional[np.array]
+        :return: the corrected spectra
+        :rtype: np.array
+        """
+        return np.array([self.correct_spectrum(spectrum) for spectrum in spectra])
+
+    def cosmic_ray_reference(self, spectra: np.array) -> Optional[np.array]:
+        """
+        The reference that steps comparing spectra with each other (cosmic ray removal) use. Computing it once
+        over a whole spot or raster and passing it to correct_spectrum_batch makes the correction of a chunk
+        (or of a few rows) the same as correcting every spectrum in one batch.
+        :param spectra: every spectrum of the spot or raster, with shape (n_spectra, n_points)
+        :type spectra: np.array
+        :return: the reference, None if the processor doesn't compare spectra
+        :rtype: Optional[np.array]
+        """
+        return None
+
+    def stats(self) -> Dict:
+        """
+        The counters the processor collects while correcting (e.g. SpectrumProcessor.cosmic_rays_removed).
+        Work done on a copy of the processor (in a worker process) is added back with merge_stats.
+        :return: the counters, in the form merge_stats takes
+        :rtype: Dict
+        """
+        return {}
+
+    def reset_stats(self) -> None:
+        """
+        Sets the counters returned by stats back to zero
+        :return: None
+        :rtype: None
+        """
+        pass
+
+    def merge_stats(self, stats: Dict) -> None:
+        """
+        Adds the stats of a copy of this processor to its counters
+        :param stats: the stats of the copy
+        :type stats: Dict
+        :return: None
+        :rtype: None
+        """
+        pass
+
 class DataSpecProcessor(ABCSpecProcessor):
     def __init__(self, laser_wavelength: float, corrected_data: np.array, wavenumbers: np.array):
         """
@@ -81,13 +196,49 @@ class SpectrumProcessor(ABCSpecProcessor):  # eventually build ABC
     """
     This is a spectrum processor used for processing data from a .txt file
     """
-    def __init__(self, laser_wavelength: float) -> None:
+    def __init__(self, laser_wavelength: float, solver: Union[str, WhittakerSolver] = 'sparse') -> None:
         """
         Initilization function
         :param laser_wavelength: the laser wavelength
         :type laser_wavelength: float
+        :param solver: the solver used for Whittaker smoothing, either 'sparse' (general sparse solver),
+        'banded' (banded Cholesky with cached penalty bands) or a WhittakerSolver instance
+        :type solver: Union[str, WhittakerSolver]
         """
         self.laser_wavelength = laser_wavelength
+        self.solver = get_solver(solver)
+        self.cosmic_rays_removed = 0  # running count of spikes replaced by correct_spectrum_batch
+        self.airpls_spectra = 0  # running count of baselines fitted by _airPLS and _airPLS_batch
+        self.airpls_iterations = 0  # running sum of the iterations each of those baselines took
+        self.airpls_max_reached = 0  # running count of baselines that stopped at itermax
+
+    _shared: Dict[float, "SpectrumProcessor"] = {}
+    COUNTERS = ('cosmic_rays_removed', 'airpls_spectra', 'airpls_iterations', 'airpls_max_reached')
+
+    @classmethod
+    def shared(cls, laser_wavelength: float) -> "SpectrumProcessor":
+        """
+        Returns the default processor for a laser wavelength, one instance is shared by every caller
+        (this is what the builders use when no processor is passed)
+        :param laser_wavelength: the laser wavelength
+        :type laser_wavelength: float
+        :return: the shared processor
+        :rtype: SpectrumProcessor
+        """
+        if laser_wavelength not in cls._shared:
+            cls._shared[laser_wavelength] = cls(laser_wavelength)
+        return cls._shared[laser_wavelength]
+
+    def stats(self) -> Dict:
+        return {counter: getattr(self, counter) for counter in self.COUNTERS}
+
+    def reset_stats(self) -> None:
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+
+    def merge_stats(self, stats: Dict) -> None:
+        for counter in self.COUNTERS:
+            setattr(self, counter, getattr(self, counter) + stats.get(counter, 0))
 
     def get_wavenumber(self, positions: np.array, input_type: PositionType) -> np.array:
         """
@@ -116,16 +267,90 @@ class SpectrumProcessor(ABCSpecProcessor):  # eventually build ABC
         baseline = self._airPLS(spectrum_array, lambda_=200, itermax=30)
         return spectrum_array - baseline
 
+    def correct_baseline_batch(self, spectra: np.array, lambda_: float = 200, porder: int = 1,
+                               itermax: int = 30) -> np.array:
+        """
+        This corrects the baseline of every spectrum in a 2d array at once. With the default parameters
+        the result matches calling correct_baseline on each row.
+        :param spectra: uncorrected spectra with shape (n_spectra, n_points)
+        :type spectra: np.array
+        :param lambda_: airPLS smoothing parameter, the larger it is the smoother the baseline
+        :type lambda_: float
+        :param porder: order of the differences in the airPLS penalty
+        :type porder: int
+        :param itermax: maximum number of airPLS iterations
+        :type itermax: int
+        :return: baseline corrected spectra with shape (n_spectra, n_points)
+        :rtype: np.array
+        """
+        spectra = np.atleast_2d(np.asarray(spectra, dtype=float))
+        baselines = self._airPLS_batch(spectra, lambda_=lambda_, porder=porder, itermax=itermax)
+        return spectra - baselines
+
     def remove_cosmic_rays(self, spectrum_array: np.array) -> np.array:
         """
-        NOT CURRENTLY IMPLEMENTED
-        Removes cosmic rays from the spectrum
+        Removes cosmic rays from the spectrum. Only neighbouring points are used to find the spikes,
+        use remove_cosmic_rays_batch to also compare against neighbouring spectra.
         :param spectrum_array: uncorrected spectrum
         :type spectrum_array: np.array
         :return: spectrum with cosmic rays removed
         :rtype: np.array
         """
-        return spectrum_array  # TODO: actually implement
+        cleaned, _ = self.remove_cosmic_rays_batch(spectrum_array)
+        return cleaned[0]
+
+    def cosmic_ray_reference(self, spectra: np.array) -> Optional[np.array]:
+        """
+        The median of the spectra at each position, see ABCSpecProcessor.cosmic_ray_reference
+        :param spectra: every spectrum of the spot or raster, with shape (n_spectra, n_points)
+        :type spectra: np.array
+        :return: the median spectrum, None with fewer than three spectra
+        :rtype: Optional[np.array]
+        """
+        spectra = np.atleast_2d(np.asarray(spectra, dtype=float))
+        if spectra.shape[0] < 3:
+            return None
+        return np.median(spectra, axis=0)
+
+    def remove_cosmic_rays_batch(self, spectra: np.array, threshold: float = 8.0, window: int = 5,
+                                 reference: Optional[np.array] = None) -> Tuple[np.array, int]:
+        """
+        Finds and replaces cosmic ray spikes in every spectrum (row) of a 2d array at once.
+
+        A point is a spike if it sticks out of a running median over its neighbouring points by more
+        than threshold robust standard deviations (median absolute deviation) of that spectrum, and if
+        it is narrow: most of its height above the local minimum is lost to the running median, which
+        is not the case for Raman peaks spanning several points. With three or more spectra the point
+        must also stick out above the median of all the spectra at that position, so real peaks that
+        show up in the neighbouring spectra are left alone. Spikes and the points next to them are
+        replaced by the running median. Pass the cosmic_ray_reference of the whole spot or raster to get
+        the same result for a part of it as for all of it.
+        :param spectra: uncorrected spectra with shape (n_spectra, n_points)
+        :type spectra: np.array
+        :param threshold: number of robust standard deviations a spike has to stick out
+        :type threshold: float
+        :param window: number of neighbouring points used for the running median
+        :type window: int
+        :param reference: median of all the spectra at each position, if None the median of spectra
+        :type reference: Optional[np.array]
+        :return: spectra with cosmic rays removed and the number of spikes that were replaced
+        :rtype: Tuple[np.array, int]
+        """
+        spectra = np.atleast_2d(np.asarray(spectra, dtype=float))
+        filtered = median_filter(spectra, size=(1, window), mode='nearest')
+        residuals = spectra - filtered
+        heights = spectra - minimum_filter(spectra, size=(1, 2 * window + 1), mode='nearest')
+        spikes = (_robust_zscore(residuals) > threshold) & (residuals > 0.5 * heights)
+        if reference is None:
+            reference = self.cosmic_ray_reference(spectra)
+        if reference is not None:
+            spikes &= _robust_zscore(spectra - reference) > threshold
+
+        spike_count = int(spikes[:, 0].sum() + (spikes[:, 1:] & ~spikes[:, :-1]).sum())
+        replace = spikes.copy()
+        replace[:, 1:] |= spikes[:, :-1]  # the shoulders of a spike are replaced as well
+        replace[:, :-1] |= spikes[:, 1:]
+        return np.where(replace, filtered, spectra), spike_count
 
     def smooth_spectrum(self, spectrum_array: np.array) -> np.array:
         """
@@ -137,6 +362,21 @@ class SpectrumProcessor(ABCSpecProcessor):  # eventually build ABC
         """
         return self._ws_wrapper(spectrum_array, 10)
 
+    def smooth_spectrum_batch(self, spectra: np.array, lambda_: float = 10, porder: int = 1) -> np.array:
+        """
+        This smooths every spectrum (row) of a 2d array at once using ws smoothing
+        :param spectra: unsmoothed spectra with shape (n_spectra, n_points)
+        :type spectra: np.array
+        :param lambda_: smoothing parameter, the larger it is the smoother the result
+        :type lambda_: float
+        :param porder: order of the differences in the smoothing penalty
+        :type porder: int
+        :return: smoothed spectra
+        :rtype: np.array
+        """
+        spectra = np.atleast_2d(np.asarray(spectra, dtype=float))
+        return self._WhittakerSmooth_batch(spectra, np.ones(spectra.shape), lambda_, porder)
+
     def normalize(self, spectrum_array:np.array) -> np.array:
         """
         Normalizes the area under the spectrum to a value of 1
@@ -145,7 +385,18 @@ class SpectrumProcessor(ABCSpecProcessor):  # eventually build ABC
         :return: normalized spectrum
         :rtype: np.array
         """
-        return spectrum_array/np.trapz(spectrum_array)
+        return spectrum_array/_trapezoid(spectrum_array)
+
+    def normalize_batch(self, spectra: np.array) -> np.array:
+        """
+        Normalizes the area under every spectrum (row) of a 2d array to a value of 1
+        :param spectra: spectra to normalize with shape (n_spectra, n_points)
+        :type spectra: np.array
+        :return: normalized spectra
+        :rtype: np.array
+        """
+        spectra = np.atleast_2d(np.asarray(spectra, dtype=float))
+        return spectra / _trapezoid(spectra, axis=1)[:, None]
 
     def correct_spectrum(self, spectrum_array:np.array) -> np.array:
         """
@@ -159,6 +410,22 @@ class SpectrumProcessor(ABCSpecProcessor):  # eventually build ABC
         # note for now do not normalize spectra
         return self.smooth_spectrum(self.correct_baseline(self.remove_cosmic_rays(spectrum_array)))
 
+    def correct_spectrum_batch(self, spectra: np.array, reference: Optional[np.array] = None) -> np.array:
+        """
+        Apply all of the available correction functions to every spectrum (row) of a 2d array at once.
+        Cosmic rays are found using the neighbouring spectra as well, the number of spikes replaced is
+        added to self.cosmic_rays_removed.
+        :param spectra: uncorrected spectra with shape (n_spectra, n_points)
+        :type spectra: np.array
+        :param reference: the cosmic_ray_reference of the whole spot or raster, if None the median of spectra
+        :type reference: Optional[np.array]
+        :return: corrected spectra
+        :rtype: np.array
+        """
+        cleaned, spike_count = self.remove_cosmic_rays_batch(spectra, reference=reference)
+        self.cosmic_rays_removed += spike_count
+        return self.smooth_spectrum_batch(self.correct_baseline_batch(cleaned))
+
     def _ws_wrapper(self, x: np.array, lambda_=5, porder=1) -> np.array:
         """
         Helper function used to wrap the ws smoothing function
@@ -188,16 +455,22 @@ class SpectrumProcessor(ABCSpecProcessor):  # eventually build ABC
         output
             the fitted background vector
         '''
-        X = np.matrix(x)
-        m = X.size
-        i = np.arange(0, m)
-        E = eye(m, format='csc')
-        D = E[1:] - E[:-1]  # numpy.diff() does not work with sparse matrix. This is a workaround.
-        W = diags(w, 0, shape=(m, m))
-        A = csc_matrix(W + (lambda_ * D.T * D))
-        B = csc_matrix(W * X.T)
-        background = spsolve(A, B)
-        return np.array(background)
+        return self.solver.smooth(x, w, lambda_, differences)
+
+    def _WhittakerSmooth_batch(self, X, W, lambda_, differences=1):
+        '''
+        Penalized least squares smoothing of every row of X at once
+
+        input
+            X: input data with shape (n_spectra, n_points)
+            W: weights with the same shape as X
+            lambda_: parameter that can be adjusted by user. The larger lambda is,  the smoother the resulting background
+            differences: integer indicating the order of the difference of penalties
+
+        output
+            the fitted background of every row with the same shape as X
+        '''
+        return self.solver.smooth_batch(X, W, lambda_, differences)
 
     def _airPLS(self, x, lambda_=100, porder=1, itermax=10):
         '''
@@ -213,12 +486,16 @@ class SpectrumProcessor(ABCSpecProcessor):  # eventually build ABC
         '''
         m = x.shape[0]
         w = np.ones(m)
+        self.airpls_spectra += 1
         for i in range(1, itermax + 1):
             z = self._WhittakerSmooth(x, w, lambda_, porder)
+            self.airpls_iterations += 1
             d = x - z
             dssn = np.abs(d[d < 0].sum())
             if (dssn < 0.001 * (abs(x)).sum() or i == itermax):
-                if (i == itermax): print('WARING max iteration reached! at i = %d' % (i))
+                if (i == itermax):
+                    print('WARING max iteration reached! at i = %d' % (i))
+                    self.airpls_max_reached += 1
                 break
             w[d >= 0] = 0  # d>0 means that this point is part of a peak, so its weight is set to 0 in order to ignore it
             w[d < 0] = np.exp(i * np.abs(d[d < 0]) / dssn)
@@ -226,6 +503,52 @@ class SpectrumProcessor(ABCSpecProcessor):  # eventually build ABC
             w[-1] = w[0]
         return z
 
+    def _airPLS_batch(self, X, lambda_=100, porder=1, itermax=10):
+        '''
+        Adaptive iteratively reweighted penalized least squares for baseline fitting of every row of X
+
+        input
+            X: input data with shape (n_spectra, n_points)
+            lambda_: parameter that can be adjusted by user. The larger lambda is,  the smoother the resulting background, z
+            porder: adaptive iteratively reweighted penalized least squares for baseline fitting
+            itermax: maximum number of iterations for each row
+
+        output
+            the fitted background of every row with the same shape as X
+
+        Every row goes through the same iterations as _airPLS. Rows that have converged are dropped
+        from the system, so each iteration only solves for the rows that are still active.
+        '''
+        n, m = X.shape
+        Z = np.zeros((n, m))
+        w = np.ones((n, m))
+        active = np.arange(n)
+        x_abs_sum = np.abs(X).sum(axis=1)
+        self.airpls_spectra += n
+        for i in range(1, itermax + 1):
+            x = X[active]
+            z = self._WhittakerSmooth_batch(x, w, lambda_, porder)
+            self.airpls_iterations += len(active)
+            Z[active] = z
+            d = x - z
+            negative = np.minimum(d, 0)
+            dssn = np.abs(negative.sum(axis=1))
+            converged = dssn < 0.001 * x_abs_sum[active]
+            if i == itermax:
+                if not converged.all():
+                    print('WARING max iteration reached! at i = %d for %d spectra' % (i, (~converged).sum()))
+                    self.airpls_max_reached += int((~converged).sum())
+                break
+            keep = ~converged
+            active, d, negative, dssn = active[keep], d[keep], negative[keep], dssn[keep]
+            if active.size == 0:
+                break
+            # d>0 means that this point is part of a peak, so its weight is set to 0 in order to ignore it
+            w = np.where(d < 0, np.exp(i * np.abs(negative) / dssn[:, None]), 0)
+            w[:, 0] = np.exp(i * np.where(d < 0, d, -np.inf).max(axis=1) / dssn)
+            w[:, -1] = w[:, 0]
+        return Z
+
 
 class SpotParser(ABC):
     """
@@ -276,10 +599,34 @@ class DefaultSpotParser(SpotParser):
     to work with the RamanSpot Class
     """
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, fast: bool = True, load: bool = True, cache: Optional[ParseCache] = None):
+        """
+        If the file ends part way through a spectrum (e.g. an interrupted acquisition) that spectrum is dropped
+        and a message is printed.
+        :param filepath: A filepath to a text file containing Raman data
+        :type filepath: str
+        :param fast: if True the data section is parsed in bulk by get_file_spectra_fast, otherwise line by line
+        by get_file_spectra. Both give the same spectra.
+        :type fast: bool
+        :param load: if False only the metadata is read and self.spectra is None, the spectra can then be
+        streamed with iter_spectra or iter_spectra_blocks
+        :type load: bool
+        :param cache: if given, parsed files are stored in and read back from this cache, so unchanged
+        files are only parsed once (use functools.partial to pass it as a parser_class)
+        :type cache: Optional[ParseCache]
+        """
         self._spectrum_length = 1024
         self._laser_wavelength = 785
-        self.metadata, self.spectra = self.get_metadata_and_spectrum(filepath)
+        self.fast = fast
+        self.filepath = filepath
+        self.cache = cache
+        if load:
+            self.metadata, self.spectra = self.get_metadata_and_spectrum(filepath)
+        else:
+            with open(filepath) as infile:
+                self.metadata = self.get_metadata(infile)
+            self.spectra = None
+        self.header_values = parse_header_values(self.metadata)  # typed values, e.g. exposure_time_s
 
     @property
     def spectrum_length(self):
@@ -321,42 +668,48 @@ class DefaultSpotParser(SpotParser):
         :param filepath: A filepath to a text file containing Raman data
         :return: metadata in a dictionary and a list of different spectra in a datalist
         """
+        if self.cache is not None:
+            key = self.cache.key(filepath, self.cache_settings())
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
         with open(filepath) as infile:  # opens file and then stores
             metadata = self.get_metadata(infile)
-            datalist = self.get_file_spectra(infile)
+            if self.fast:
+                datalist = self.get_file_spectra_fast(infile)
+            else:
+                datalist = self.get_file_spectra(infile)
+        if self.cache is not None:
+            self.cache.put(key, metadata, datalist)
         return metadata, datalist
 
+    def cache_settings(self) -> Dict:
+        """
+        The settings that change the output of the parser, hashed into the ParseCache key
+        :return: json serializable settings
+        :rtype: Dict
+        """
+        return {'parser': type(self).__name__, 'fast': self.fast, 'spectrum_length': self.spectrum_length,
+                'partial_spectrum': 'dropped'}
+
     @staticmethod
     def get_metadata(file_iterator):
         """
-        Takes a file_iterator and parses out the metadata
+        Takes a file_iterator and parses out the metadata. Each header line is split at its first colon,
+        keys and values are stripped of surrounding whitespace and a line without a colon is kept as a key
+        with an empty value. The header ends at the first blank line.
         :param file_iterator: A fileiterator to iterate through (has side effects)
         :return: A dictionary containing the metadata
         """
         metadata_values = {}  # creates dictionary to return
         for line in file_iterator:
-            if (line == "\n"):  # determines when metadata ends and spectra data begins
-                return metadata_values
-            data_name = []
-            data_values = []
-            colon_encountered = False
-            iterline = iter(line)
-            for c in iterline:
-                if not colon_encountered and c == ":":
-                    colon_encountered = True
-                    c = next(iterline)
-                    while c == " ":
-                        c = next(iterline)  # iterates through all whitespace between key and date
-                if not colon_encountered:  # if you are iterating through the key
-                    data_name.append(c)
-                    continue
-                else:
-                    if c == "\n":  # skip newline characters
-                        continue
-                    data_values.append(c)
-                    continue
-
-            metadata_values["".join(data_name)] = "".join(data_values)  # adds name and value to a dictionary
+            if not line.strip():  # determines when metadata ends and spectra data begins
+                break
+            match = _HEADER_LINE.match(line)
+            if match:
+                metadata_values[match.group(1)] = match.group(2)
+            else:
+                metadata_values[line.strip()] = ''
         return metadata_values
 
     def get_file_spectra(self, file_iterator):
@@ -367,22 +720,18 @@ class DefaultSpotParser(SpotParser):
         """
         i = 0
         data_list = []
-        data_array = np.zeros((1024, 2), dtype=float)  # this is for storing the data
 
         for line in file_iterator:
-            if i ==0:  
-                data_list.append(data_array)
             if (line == "\n"):  # skips new line characters at the begining of the file
                 continue
             splt_line = line.split("	")
             if (len(splt_line) != 3):  # skips nondata
                 print(line)
                 continue
-                # if you go through one whole dataset  if(len(wavelength_list)!=0 and wavelength<wavelength_list[-1]):
-                # #if the wavelengths go back to the start point, restart things
-            if i >= self.spectrum_length:
-                #data_list.append(data_array)
-                data_array = np.zeros((1024, 2), dtype=float)  # clears data array for next round
+            if not data_list or i >= self.spectrum_length:
+                # if you go through one whole dataset, start the next spectrum
+                data_array = np.zeros((self.spectrum_length, 2), dtype=float)  # this is for storing the data
+                data_list.append(data_array)
                 i = 0
             wavelength = float(splt_line[0])
             intensity = float(splt_line[1])
@@ -390,5 +739,105 @@ class DefaultSpotParser(SpotParser):
             data_array[i, 1] = intensity
 
             i += 1
+        if data_list and i < self.spectrum_length:
+            data_list.pop()
+            self._report_partial_spectrum(i)
         return data_list
 
+    def get_file_spectra_fast(self, file_iterator) -> np.array:
+        """
+        Parses the data section in bulk. The same lines as in get_file_spectra are kept (lines made of
+        exactly three tab separated fields), but the lines are found with vectorized numpy operations and
+        the numbers are read by the pandas C tokenizer in a single call.
+        :param file_iterator: A file iterator where the metadata has been skipped
+        :return: array of spectra with shape (n_spectra, spectrum_length, 2), a last spectrum the file ends part
+        way through is dropped
+        :rtype: np.array
+        """
+        data = self._complete_spectra(self._parse_data_lines(file_iterator.read()))
+        return data.reshape(-1, self.spectrum_length, 2)
+
+    def iter_spectra_blocks(self, block_size: int = 64, chunk_chars: int = 2 ** 22) -> Iterator[np.array]:
+        """
+        Streams the spectra of the file in blocks, so that only about one block is held in memory at a time
+        :param block_size: number of spectra per block
+        :type block_size: int
+        :param chunk_chars: number of characters read from the file at a time
+        :type chunk_chars: int
+        :return: iterator of arrays with shape (block_size, spectrum_length, 2), the last block holds the
+        remaining spectra (a last spectrum the file ends part way through is dropped)
+        :rtype: Iterator[np.array]
+        """
+        rows_per_block = block_size * self.spectrum_length
+        pending = np.zeros((0, 2), dtype=float)
+        with open(self.filepath) as infile:
+            self.get_metadata(infile)
+            remainder = ''
+            while True:
+                chunk = infile.read(chunk_chars)
+                if not chunk:
+                    break
+                chunk = remainder + chunk
+                cut = chunk.rfind('\n') + 1  # only parse complete lines
+                remainder = chunk[cut:]
+                pending = np.concatenate((pending, self._parse_data_lines(chunk[:cut])))
+                while len(pending) >= rows_per_block:
+                    yield pending[:rows_per_block].reshape(block_size, self.spectrum_length, 2)
+                    pending = pending[rows_per_block:]
+            pending = self._complete_spectra(np.concatenate((pending, self._parse_data_lines(remainder))))
+
+        if len(pending):
+            yield pending.reshape(-1, self.spectrum_length, 2)
+
+    def iter_spectra(self, block_size: int = 64) -> Iterator[np.array]:
+        """
+        Streams the spectra of the file one at a time, see iter_spectra_blocks
+        :param block_size: number of spectra parsed at a time
+        :type block_size: int
+        :return: iterator of arrays with shape (spectrum_length, 2)
+        :rtype: Iterator[np.array]
+        """
+        for block in self.iter_spectra_blocks(block_size):
+            yield from block
+
+    def _complete_spectra(self, data: np.array) -> np.array:
+        """
+        Drops the data lines of a last spectrum the file ends part way through
+        :param data: positions and intensities with shape (n_data_lines, 2), see _parse_data_lines
+        :type data: np.array
+        :return: the data lines of the complete spectra
+        :rtype: np.array
+        """
+        n_partial = len(data) % self.spectrum_length
+        if n_partial:
+            self._report_partial_spectrum(n_partial)
+            data = data[:len(data) - n_partial]
+        return data
+
+    def _report_partial_spectrum(self, n_points: int) -> None:
+        print(f'dropping the last spectrum of {self.filepath}, the file ends after {n_points} of its '
+              f'{self.spectrum_length} points')
+
+    @staticmethod
+    def _parse_data_lines(text: str) -> np.array:
+        """
+        Parses the data lines (lines made of exactly three tab separated fields) out of a piece of the
+        data section. The lines are found with vectorized numpy operations and the numbers are read by the
+        pandas C tokenizer in a single call.
+        :param text: complete lines of the data section
+        :type text: str
+        :return: array with shape (n_data_lines, 2) of positions and intensities
+        :rtype: np.array
+        """
+        text = np.frombuffer(text.encode(), dtype=np.uint8)
+        line_ends = np.append(np.flatnonzero(text == ord('\n')), len(text))
+        line_starts = np.append(0, line_ends[:-1] + 1)
+        tabs = np.flatnonzero(text == ord('\t'))
+        is_data = np.searchsorted(tabs, line_ends) - np.searchsorted(tabs, line_starts) == 2
+        if not is_data.any():
+            return np.zeros((0, 2), dtype=float)
+        if not np.all(is_data | (line_ends == line_starts)):  # skips nondata, blank lines are skipped by pandas
+            # keep every character (including the newline) of the data lines
+            text = text[np.repeat(is_data, line_ends - line_starts + 1)[:len(text)]]
+        return pd.read_csv(io.BytesIO(text.tobytes()), sep='\t', header=None, names=[0, 1, 2], usecols=[0, 1],
+                           dtype=float, float_precision='high').to_numpy()
@@ -0,0 +1,325 @@
+from abc import ABC
+from abc import abstractmethod
+import time
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Optional, Union
+from ramanbox.raman.constants import PositionType
+from ramanbox.raman.processing import ABCSpecProcessor, SpectrumProcessor
+from ramanbox.raman.whittaker import WhittakerSolver
+
+
+class ProcessingStage(ABC):
+    """
+    A single step of a ProcessingPipeline. A stage holds its parameters and applies itself to a
+    2d array of spectra using the numerical routines of a SpectrumProcessor.
+    """
+    name = ''
+
+    def __init__(self, **params) -> None:
+        self.params = params
+
+    @abstractmethod
+    def apply(self, spectra: np.array, processor: SpectrumProcessor, reference: Optional[np.array] = None) -> np.array:
+        """
+        Apply the stage to every spectrum (row) of a 2d array
+        :param spectra: spectra with shape (n_spectra, n_points)
+        :type spectra: np.array
+        :param processor: processor providing the numerical routines
+        :type processor: SpectrumProcessor
+        :param reference: for stages comparing spectra with each other, the reference computed over the whole
+        spot or raster (see ProcessingPipeline.cosmic_ray_reference), if None it is computed from spectra
+        :type reference: Optional[np.array]
+        :return: processed spectra
+        :rtype: np.array
+        """
+        pass
+
+    def to_dict(self) -> Dict:
+        """
+        Returns the declarative form of the stage, see ProcessingPipeline.from_config
+        :return: dictionary with the stage name under 'stage' and the stage parameters
+        :rtype: Dict
+        """
+        return {'stage': self.name, **self.params}
+
+    def __repr__(self) -> str:
+        params = ', '.join(f'{key}={value!r}' for key, value in self.params.items())
+        return f'{self.__class__.__name__}({params})'
+
+
+class CosmicRayStage(ProcessingStage):
+    """
+    Removes cosmic ray spikes, see SpectrumProcessor.remove_cosmic_rays_batch
+    """
+    name = 'cosmic_rays'
+
+    def __init__(self, threshold: float = 8.0, window: int = 5) -> None:
+        super().__init__(threshold=threshold, window=window)
+
+    def apply(self, spectra, processor, reference=None):
+        cleaned, spike_count = processor.remove_cosmic_rays_batch(spectra, reference=reference, **self.params)
+        processor.cosmic_rays_removed += spike_count
+        return cleaned
+
+
+class BaselineStage(ProcessingStage):
+    """
+    Subtracts an airPLS baseline, see SpectrumProcessor.correct_baseline_batch
+    """
+    name = 'baseline'
+
+    def __init__(self, lambda_: float = 200, porder: int = 1, itermax: int = 30) -> None:
+        super().__init__(lambda_=lambda_, porder=porder, itermax=itermax)
+
+    def apply(self, spectra, processor, reference=None):
+        return processor.correct_baseline_batch(spectra, **self.params)
+
+
+class SmoothingStage(ProcessingStage):
+    """
+    Whittaker smoothing, see SpectrumProcessor.smooth_spectrum_batch
+    """
+    name = 'smoothing'
+
+    def __init__(self, lambda_: float = 10, porder: int = 1) -> None:
+        super().__init__(lambda_=lambda_, porder=porder)
+
+    def apply(self, spectra, processor, reference=None):
+        return processor.smooth_spectrum_batch(spectra, **self.params)
+
+
+class NormalizeStage(ProcessingStage):
+    """
+    Normalizes the area under each spectrum to 1, see SpectrumProcessor.normalize_batch
+    """
+    name = 'normalize'
+
+    def apply(self, spectra, processor, reference=None):
+        return processor.normalize_batch(spectra)
+
+
+STAGES = {stage.name: stage for stage in (CosmicRayStage, BaselineStage, SmoothingStage, NormalizeStage)}
+
+
+class StageTiming:
+    """
+    Wall time and call counts collected for a single stage
+    """
+    def __init__(self) -> None:
+        self.calls = 0
+        self.spectra = 0
+        self.seconds = 0.0
+
+    def record(self, seconds: float, n_spectra: int, calls: int = 1) -> None:
+        self.calls += calls
+        self.spectra += n_spectra
+        self.seconds += seconds
+
+
+class ProcessingPipeline(ABCSpecProcessor):
+    """
+    A spectrum processor made of an ordered list of stages. It can be used in place of a
+    SpectrumProcessor (e.g. in SpotBuilder or SampleBuilder) and records the wall time spent in each stage.
+    """
+    def __init__(self, laser_wavelength: float, stages: Optional[List[ProcessingStage]] = None,
+                 solver: Union[str, WhittakerSolver] = 'sparse') -> None:
+        """
+        Initilization function
+        :param laser_wavelength: the laser wavelength
+        :type laser_wavelength: float
+        :param stages: the stages in the order they are applied, if None the same chain as
+        SpectrumProcessor.correct_spectrum is used (cosmic rays, baseline, smoothing)
+        :type stages: Optional[List[ProcessingStage]]
+        :param solver: the solver used for Whittaker smoothing, see SpectrumProcessor
+        :type solver: Union[str, WhittakerSolver]
+        """
+        self.laser_wavelength = laser_wavelength
+        self.processor = SpectrumProcessor(laser_wavelength, solver)
+        if stages is None:
+            stages = [CosmicRayStage(), BaselineStage(), SmoothingStage()]
+        self.stages = list(stages)
+        self.timings = [StageTiming() for _ in self.stages]
+
+    @classmethod
+    def from_config(cls, laser_wavelength: float, config: List[Dict],
+                    solver: Union[str, WhittakerSolver] = 'sparse') -> "ProcessingPipeline":
+        """
+        Build a pipeline from a declarative list of stages, e.g.
+        [{'stage': 'cosmic_rays'}, {'stage': 'baseline', 'lambda_': 100}, {'stage': 'smoothing', 'lambda_': 5}]
+        :param laser_wavelength: the laser wavelength
+        :type laser_wavelength: float
+        :param config: list of dictionaries with a stage name under 'stage' and the stage parameters
+        :type config: List[Dict]
+        :param solver: the solver used for Whittaker smoothing, see SpectrumProcessor
+        :type solver: Union[str, WhittakerSolver]
+        :return: a new pipeline
+        :rtype: ProcessingPipeline
+        """
+        stages = []
+        for stage_config in config:
+            params = dict(stage_config)
+            name = params.pop('stage')
+            assert name in STAGES, f'unknown stage {name}, must be one of {list(STAGES)}'
+            stages.append(STAGES[name](**params))
+        return cls(laser_wavelength, stages, solver)
+
+    def to_config(self) -> List[Dict]:
+        """
+        Returns the declarative form of the pipeline, see from_config
+        :return: list of stage dictionaries
+        :rtype: List[Dict]
+        """
+        return [stage.to_dict() for stage in self.stages]
+
+    @property
+    def cosmic_rays_removed(self) -> int:
+        """
+        Running count of the cosmic ray spikes replaced by this pipeline
+        :return: number of spikes
+        :rtype: int
+        """
+        return self.processor.cosmic_rays_removed
+
+    @property
+    def airpls_spectra(self) -> int:
+        """
+        Running count of the baselines fitted by this pipeline
+        :return: number of baselines
+        :rtype: int
+        """
+        return self.processor.airpls_spectra
+
+    @property
+    def airpls_iterations(self) -> int:
+        """
+        Running sum of the airPLS iterations each baseline fitted by this pipeline took
+        :return: number of iterations
+        :rtype: int
+        """
+        return self.processor.airpls_iterations
+
+    @property
+    def airpls_max_reached(self) -> int:
+        """
+        Running count of the baselines that stopped at the iteration limit
+        :return: number of baselines
+        :rtype: int
+        """
+        return self.processor.airpls_max_reached
+
+    def get_wavenumber(self, positions: np.array, input_type: PositionType) -> np.array:
+        """
+        Calculates the wavenumbers and returns them, see SpectrumProcessor.get_wavenumber
+        :param positions: position array to convert to wavenumbers
+        :type positions: np.array
+        :param input_type: position type (wavenumber, wavelength, frequency)
+        :type input_type: PositionType
+        :return: wavenumbers
+        :rtype: np.array
+        """
+        return self.processor.get_wavenumber(positions, input_type)
+
+    def correct_spectrum(self, spectrum_array: np.array) -> np.array:
+        """
+        Apply every stage to the inputted spectrum
+        :param spectrum_array: uncorrected spectrum
+        :type spectrum_array: np.array
+        :return: corrected spectrum
+        :rtype: np.array
+        """
+        return self.correct_spectrum_batch(spectrum_array)[0]
+
+    def correct_spectrum_batch(self, spectra: np.array, reference: Optional[np.array] = None) -> np.array:
+        """
+        Apply every stage to every spectrum (row) of a 2d array, recording the time spent in each stage
+        :param spectra: uncorrected spectra with shape (n_spectra, n_points)
+        :type spectra: np.array
+        :param reference: the cosmic_ray_reference of the whole spot or raster, used by the first cosmic ray
+        stage, if None it is computed from spectra
+        :type reference: Optional[np.array]
+        :return: corrected spectra
+        :rtype: np.array
+        """
+        spectra = np.atleast_2d(np.asarray(spectra, dtype=float))
+        first_cosmic_ray_stage = self._first_cosmic_ray_stage()
+        for index, (stage, timing) in enumerate(zip(self.stages, self.timings)):
+            start = time.perf_counter()
+            spectra = stage.apply(spectra, self.processor, reference if index == first_cosmic_ray_stage else None)
+            timing.record(time.perf_counter() - start, len(spectra))
+        return spectra
+
+    def cosmic_ray_reference(self, spectra: np.array) -> Optional[np.array]:
+        """
+        The median the first cosmic ray stage compares spectra with, computed from what that stage receives
+        (the stages before it are applied to spectra first), see ABCSpecProcessor.cosmic_ray_reference
+        :param spectra: every uncorrected spectrum of the spot or raster, with shape (n_spectra, n_points)
+        :type spectra: np.array
+        :return: the reference, None if there is no cosmic ray stage or fewer than three spectra
+        :rtype: Optional[np.array]
+        """
+        first_cosmic_ray_stage = self._first_cosmic_ray_stage()
+        if first_cosmic_ray_stage is None:
+            return None
+        spectra = np.atleast_2d(np.asarray(spectra, dtype=float))
+        for stage in self.stages[:first_cosmic_ray_stage]:
+            spectra = stage.apply(spectra, self.processor)
+        return self.processor.cosmic_ray_reference(spectra)
+
+    def _first_cosmic_ray_stage(self) -> Optional[int]:
+        return next((index for index, stage in enumerate(self.stages) if isinstance(stage, CosmicRayStage)), None)
+
+    def stats(self) -> Dict:
+        """
+        The counters of the underlying SpectrumProcessor and the stage timings, see ABCSpecProcessor.stats
+        :return: dictionary with the processor stats under 'processor' and (calls, spectra, seconds) of
+        every stage under 'timings'
+        :rtype: Dict
+        """
+        return {'processor': self.processor.stats(),
+                'timings': [(timing.calls, timing.spectra, timing.seconds) for timing in self.timings]}
+
+    def reset_stats(self) -> None:
+        self.processor.reset_stats()
+        self.reset_timings()
+
+    def merge_stats(self, stats: Dict) -> None:
+        """
+        Adds the counters and stage timings of a copy of this pipeline (e.g. from a worker process), so
+        timing_report covers work done in parallel. The seconds of the workers are summed, so they can add up
+        to more than the wall time of a parallel run.
+        :param stats: the stats of the copy
+        :type stats: Dict
+        :return: None
+        :rtype: None
+        """
+        self.processor.merge_stats(stats['processor'])
+        for timing, (calls, spectra, seconds) in zip(self.timings, stats['timings']):
+            timing.record(seconds, spectra, calls)
+
+    def reset_timings(self) -> None:
+        """
+        Clears the collected timings
+        :return: None
+        :rtype: None
+        """
+        self.timings = [StageTiming() for _ in self.stages]
+
+    def timing_report(self) -> pd.DataFrame:
+        """
+        Summarize the wall time spent in each stage since the pipeline was created (or reset)
+        :return: one row per stage with its parameters, calls, spectra processed, total seconds,
+        milliseconds per spectrum and fraction of the total time
+        :rtype: pd.DataFrame
+        """
+        total = sum(timing.seconds for timing in self.timings)
+        rows = []
+        for stage, timing in zip(self.stages, self.timings):
+            rows.append({'stage': stage.name,
+                         'params': stage.params,
+                         'calls': timing.calls,
+                         'spectra': timing.spectra,
+                         'seconds': timing.seconds,
+                         'ms_per_spectrum': 1e3 * timing.seconds / timing.spectra if timing.spectra else np.nan,
+                         'fraction': timing.seconds / total if total else np.nan})
+        return pd.DataFrame(rows)
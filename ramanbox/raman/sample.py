@@ -1,17 +1,135 @@
-from typing import List, Optional, Dict
-from ramanbox.raman.spot import Spot
+from typing import Iterable, List, Optional, Dict, Tuple
+from functools import partial
+from ramanbox.raman.spot import CubeSpots, Spot, SpotConsistencyError
 from ramanbox.raman.processing import DefaultSpotParser
 import glob
+import json
 from ramanbox.raman.builders import SpotBuilder
 import os
+import netCDF4
 import xarray as xr
 from ramanbox.raman.constants import PositionType, Label
-from ramanbox.raman.processing import DataSpecProcessor
+from ramanbox.raman.processing import ABCSpecProcessor, DataSpecProcessor
 from ramanbox.raman.spectrum import Spectrum
+from ramanbox.raman.spectral_cube import LazySpectralCube, SpectralCube, _position_array, intern_axis
+from ramanbox.raman.parallel import map_spot_files
+from concurrent.futures import Executor
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 
+LAYOUT_VERSION = 2  # on disk layout written by Sample.save_dataset, files without a layout_version are 1
+SPECTRA_PER_CHUNK = 64  # netcdf chunk length along the spectrum dimension
+_LAYOUT_ATTRS = ('layout_version', 'laser_wavelength', 'spectrum_length')
+BACKENDS = ('netcdf', 'zarr')  # single netcdf file or zarr directory store, see Sample.save_dataset
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError as error:
+        raise ImportError('the zarr backend requires zarr (pip install zarr)') from error
+    return zarr
+
+
+def _zarr_compressors(compression: Optional[str], compression_level: int, shuffle: bool) -> Optional[Tuple]:
+    """
+    Translates a netcdf style compression name (zlib, zstd or blosc_<cname>) into zarr codecs,
+    shuffle is only applied by the blosc compressors
+    """
+    if compression is None:
+        return None
+    codecs = _import_zarr().codecs
+    if compression == 'zstd':
+        return codecs.ZstdCodec(level=compression_level),
+    if compression == 'zlib':
+        return codecs.GzipCodec(level=compression_level),
+    if compression.startswith('blosc_'):
+        return codecs.BloscCodec(cname=compression[len('blosc_'):], clevel=compression_level,
+                                 shuffle='shuffle' if shuffle else 'noshuffle'),
+    raise ValueError(f'compression {compression} is not supported by the zarr backend')
+
+
+def _value_range(*arrays: np.array) -> Tuple[float, float]:
+    arrays = [array for array in arrays if array.size]
+    if not arrays:
+        return 0.0, 0.0
+    return min(float(np.nanmin(array)) for array in arrays), max(float(np.nanmax(array)) for array in arrays)
+
+
+def _packing(value_range: Tuple[float, float], dtype: str) -> Dict:
+    """
+    CF packing of data into a signed integer dtype, values are stored as round((value - add_offset) / scale_factor)
+    and the most negative integer is kept free as the fill value
+    :param value_range: the smallest and largest value to pack
+    :type value_range: Tuple[float, float]
+    :param dtype: 'int16' or 'int32'
+    :type dtype: str
+    :return: encoding entries
+    :rtype: Dict
+    """
+    info = np.iinfo(dtype)
+    low, high = value_range
+    scale_factor = (high - low) / (int(info.max) - int(info.min) - 1) or 1.0
+    return {'dtype': dtype, 'scale_factor': scale_factor, 'add_offset': (high + low) / 2, '_FillValue': info.min}
+
+
+def _spectra_encoding(data: np.array, backend: str, compression: Optional[str], compression_level: int,
+                      shuffle: bool, dtype: Optional[str], chunk_spectra: int) -> Dict:
+    """
+    Encoding of the (spectrum, type, wavenumber) spectra variable, see Sample.save_dataset
+    """
+    n_spectra, n_types, n_points = data.shape
+    chunks = (max(min(n_spectra, chunk_spectra), 1), n_types, n_points)
+    encoding = {}
+    if dtype in ('int16', 'int32'):
+        encoding.update(_packing(_value_range(data), dtype))
+    elif dtype is not None:
+        assert dtype in ('float32', 'float64'), f'unknown dtype {dtype}, must be float32, float64, int16 or int32'
+        encoding['dtype'] = dtype
+    if backend == 'zarr':
+        encoding.update(chunks=chunks, compressors=_zarr_compressors(compression, compression_level, shuffle))
+        return encoding
+    encoding['chunksizes'] = chunks
+    if compression is not None:
+        encoding.update(compression=compression, complevel=compression_level, shuffle=shuffle)
+    return encoding
+
+
+def _write_dataset(dataset: xr.Dataset, filename: str, backend: str, encoding: Dict) -> None:
+    """
+    Writes a dataset to a netcdf file or a zarr directory store, replacing an existing one
+    """
+    assert backend in BACKENDS, f'unknown backend {backend}, must be one of {BACKENDS}'
+    if backend == 'zarr':
+        _import_zarr()
+        # fixed width unicode has no zarr v3 data type, variable length strings do
+        strings = {name: dataset[name].astype(object) for name in dataset.variables if dataset[name].dtype.kind == 'U'}
+        dataset.assign_coords(strings).to_zarr(filename, mode='w', encoding=encoding, consolidated=False)
+    else:
+        dataset.to_netcdf(filename, encoding=encoding)
+
+
+def _label_attrs() -> Dict:
+    """
+    CF style attributes describing the integer label codes
+    :return: attributes for the label variable
+    :rtype: Dict
+    """
+    labels = sorted(Label, key=lambda label: label.value)
+    return {'flag_values': [label.value for label in labels],
+            'flag_meanings': ' '.join(label.name for label in labels)}
+
+
+def _read_spectra_rows(spectra: xr.DataArray, raw_index: int, corrected_index: int, start: int,
+                       stop: int) -> Tuple[np.array, np.array]:
+    """
+    Reads the raw and corrected spectra of rows [start, stop) of a (spectrum, type, wavenumber) variable
+    """
+    block = spectra[start:stop].values
+    return block[:, raw_index], block[:, corrected_index]
+
+
 def convert_dict_labels_to_list(label_dict: Dict[int, Label]) -> List[str]:
     """
     Converts a dict to labels for the serialization
@@ -52,6 +170,230 @@ def convert_list_to_dict(my_list):
     return new_dict
 
 
+def _prepare_spot_attrs(data_array: xr.DataArray) -> None:
+    """
+    Makes the attributes of a spot DataArray serializable (has side effects)
+    :param data_array: DataArray built by Spot.build_DataArray
+    :type data_array: xr.DataArray
+    :return: None
+    :rtype: None
+    """
+    data_array.attrs.pop('metadata')  # metadata is not currently saved
+    data_array.attrs['labels'] = convert_dict_labels_to_list(data_array.attrs['labels'])
+
+
+class SpectraWriter:
+    """
+    Writes a netcdf file in the current layout (LAYOUT_VERSION, see Sample.build_columnar_Dataset) block by
+    block. The spectrum and spot dimensions are unlimited and every write appends to them, so only the block
+    being written is held in memory whatever the size of the sample. Use as a context manager or call close.
+    """
+    def __init__(self, filename: str, wavenumbers: np.array, laser_wavelength: float, name: Optional[str] = None,
+                 metadata: Optional[Dict] = None, compression: Optional[str] = None, compression_level: int = 4,
+                 shuffle: bool = True, dtype: Optional[str] = None,
+                 value_range: Optional[Tuple[float, float]] = None, chunk_spectra: int = SPECTRA_PER_CHUNK,
+                 spots_per_write: int = 64) -> None:
+        """
+        Initilization function, creates the file
+        :param filename: name of the output filename
+        :type filename: str
+        :param wavenumbers: wavenumbers shared by every spectrum
+        :type wavenumbers: np.array
+        :param laser_wavelength: the laser wavelength
+        :type laser_wavelength: float
+        :param name: name of the sample
+        :type name: Optional[str]
+        :param metadata: dictionary of metadata for the sample
+        :type metadata: Optional[Dict]
+        :param compression: compression, dtype and chunk_spectra are the encoding options of Sample.save_dataset
+        :type compression: Optional[str]
+        :param compression_level: compression level
+        :type compression_level: int
+        :param shuffle: if True bytes are shuffled before zlib compression (netCDF4 ignores it for the
+        other compressions)
+        :type shuffle: bool
+        :param dtype: storage type of the spectra, None, 'float64', 'float32', 'int16' or 'int32'
+        :type dtype: Optional[str]
+        :param value_range: smallest and largest value of the spectra, required by the integer dtypes
+        :type value_range: Optional[Tuple[float, float]]
+        :param chunk_spectra: number of spectra per chunk
+        :type chunk_spectra: int
+        :param spots_per_write: write_spot buffers spots until a chunk of spectra or this many spots are held
+        :type spots_per_write: int
+        """
+        self.wavenumbers = intern_axis(wavenumbers)
+        self.laser_wavelength = laser_wavelength
+        self.chunk_spectra = max(chunk_spectra, 1)
+        self.spots_per_write = spots_per_write
+        self.n_spectra = 0
+        self.n_spots = 0
+        self._buffer = []
+        n_points = len(self.wavenumbers)
+
+        spectra_options = {'chunksizes': (self.chunk_spectra, 2, n_points), 'fill_value': np.nan}
+        if compression is not None:
+            spectra_options.update(compression=compression, complevel=compression_level, shuffle=shuffle)
+        packing = {}
+        if dtype in ('int16', 'int32'):
+            assert value_range is not None, 'integer dtypes need the value_range of the spectra'
+            packing = _packing(value_range, dtype)
+            spectra_options['fill_value'] = packing.pop('_FillValue')
+        elif dtype is not None:
+            assert dtype in ('float32', 'float64'), f'unknown dtype {dtype}, must be float32, float64, int16 or int32'
+
+        self.dataset = netCDF4.Dataset(filename, 'w')
+        try:
+            attrs = dict(metadata) if metadata is not None else {}
+            attrs.update({'name': str(name),
+                          'layout_version': LAYOUT_VERSION,
+                          'laser_wavelength': laser_wavelength,
+                          'spectrum_length': n_points,
+                          'coordinates': 'filepath position'})
+            self.dataset.setncatts(attrs)
+            for dim, size in (('spectrum', None), ('type', 2), ('wavenumber', n_points), ('spot', None), ('xy', 2)):
+                self.dataset.createDimension(dim, size)
+            self.dataset.createVariable('type', str, ('type',))[:] = np.array(['raw', 'corrected'], dtype=object)
+            self.dataset.createVariable('wavenumber', 'f8', ('wavenumber',), fill_value=np.nan)[:] = self.wavenumbers
+            self.spectra = self.dataset.createVariable('spectra', packing.pop('dtype', dtype or 'f8'),
+                                                       ('spectrum', 'type', 'wavenumber'), **spectra_options)
+            self.spectra.setncatts({'coordinates': 'label spot_index', **packing})
+            self.spot_index = self.dataset.createVariable('spot_index', 'i8', ('spectrum',), fill_value=False)
+            self.labels = self.dataset.createVariable('label', 'i1', ('spectrum',), fill_value=False)
+            self.labels.setncatts(_label_attrs())
+            self.filepaths = self.dataset.createVariable('filepath', str, ('spot',))
+            self.positions = None  # created by the first write_spots, integer if the first positions are
+        except BaseException:
+            self.dataset.close()
+            raise
+
+    def write_spectra(self, raw: np.array, corrected: np.array, labels: np.array, spot_index: np.array) -> None:
+        """
+        Appends a block of spectra
+        :param raw: raw spectra with shape (n_spectra, n_points)
+        :type raw: np.array
+        :param corrected: corrected spectra with shape (n_spectra, n_points)
+        :type corrected: np.array
+        :param labels: integer Label values
+        :type labels: np.array
+        :param spot_index: spot of each spectrum, counted over the whole file
+        :type spot_index: np.array
+        :return: None
+        :rtype: None
+        """
+        start, stop = self.n_spectra, self.n_spectra + len(raw)
+        if stop == start:
+            return
+        self.spectra[start:stop] = np.stack((raw, corrected), axis=1)
+        self.labels[start:stop] = labels
+        self.spot_index[start:stop] = spot_index
+        self.n_spectra = stop
+
+    def write_spots(self, positions: List[Optional[Tuple[float, float]]], filepaths: List[str]) -> None:
+        """
+        Appends the position and filepath of spots
+        :param positions: spot positions, None for a missing position
+        :type positions: List[Optional[Tuple[float, float]]]
+        :param filepaths: spot filepaths
+        :type filepaths: List[str]
+        :return: None
+        :rtype: None
+        """
+        start, stop = self.n_spots, self.n_spots + len(filepaths)
+        if stop == start:
+            return
+        positions = _position_array(positions)
+        if self.positions is None:
+            self.positions = self.dataset.createVariable('position', 'i8' if positions.dtype.kind in 'iu' else 'f8',
+                                                         ('spot', 'xy'), fill_value=False)
+        elif self.positions.dtype.kind == 'i' and positions.dtype.kind not in 'iu':
+            raise ValueError('the first spots written had integer positions, later spots must too')
+        self.positions[start:stop] = positions
+        self.filepaths[start:stop] = np.array([str(filepath) for filepath in filepaths], dtype=object)
+        self.n_spots = stop
+
+    def write_spot(self, spot: Spot) -> None:
+        """
+        Buffers a spot and writes the buffer once it holds a chunk of spectra or spots_per_write spots
+        :param spot: the spot, its spectra must have the wavenumbers of the writer
+        :type spot: Spot
+        :return: None
+        :rtype: None
+        """
+        report = spot.validate()
+        if not report['consistent'].all():
+            raise SpotConsistencyError(report)
+        wavenumbers = spot.spectrum_list[0].wavenumbers
+        if wavenumbers is not self.wavenumbers and (len(wavenumbers) != len(self.wavenumbers) or
+                                                   np.abs(wavenumbers - self.wavenumbers).max() >= 1.5e-3):
+            raise ValueError('all spectra must have same wavenumbers')
+        if spot.spectrum_list[0].laser_wavelength != self.laser_wavelength:
+            raise ValueError('all spectra must use same laser wavelength')
+
+        rows = spot._cube_rows()
+        if rows is not None:
+            raw, corrected = spot.cube.block(rows, use_corrected=False), spot.cube.block(rows)
+            labels = spot.cube.labels[rows]
+        else:
+            spot.materialize()
+            raw = np.array([spectrum.raw_data for spectrum in spot.spectrum_list])
+            corrected = np.array([spectrum.corrected_data for spectrum in spot.spectrum_list])
+            labels = np.array([spectrum.label.value for spectrum in spot.spectrum_list], dtype=np.int8)
+        self._buffer.append((raw, corrected, labels, spot.position, spot.filepath))
+        if len(self._buffer) >= self.spots_per_write or \
+                sum(len(item[0]) for item in self._buffer) >= self.chunk_spectra:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the spots buffered by write_spot
+        :return: None
+        :rtype: None
+        """
+        if not self._buffer:
+            return
+        raw, corrected, labels, positions, filepaths = zip(*self._buffer)
+        spot_index = np.repeat(np.arange(self.n_spots, self.n_spots + len(raw)), [len(block) for block in raw])
+        self.write_spectra(np.concatenate(raw), np.concatenate(corrected), np.concatenate(labels), spot_index)
+        self.write_spots(list(positions), list(filepaths))
+        self._buffer = []
+
+    def write_cube(self, cube: SpectralCube, filepaths: List[str]) -> None:
+        """
+        Appends every spot of a cube, one chunk of spectra at a time (spectra are corrected as they are written)
+        :param cube: the cube
+        :type cube: SpectralCube
+        :param filepaths: filepath of each spot of the cube
+        :type filepaths: List[str]
+        :return: None
+        :rtype: None
+        """
+        self.flush()
+        offset = self.n_spots
+        self.write_spots(_position_array(cube.spot_positions), filepaths)
+        for start in range(0, cube.n_spectra, self.chunk_spectra):
+            rows = slice(start, min(start + self.chunk_spectra, cube.n_spectra))
+            self.write_spectra(cube.block(rows, use_corrected=False), cube.block(rows), cube.labels[rows],
+                               cube.spot_index[rows] + offset)
+
+    def close(self) -> None:
+        """
+        Writes any buffered spots and closes the file
+        :return: None
+        :rtype: None
+        """
+        if self.dataset.isopen():
+            try:
+                self.flush()
+            finally:
+                self.dataset.close()
+
+    def __enter__(self) -> "SpectraWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
 class Sample:
     def __init__(self, spot_list: List[Spot], metadata: Optional[Dict] = None, filepath: Optional[str] = None,
                  name=None) -> None:
@@ -70,6 +412,8 @@ class Sample:
         self.metadata = metadata
         self.filepath = filepath
         self.name = name
+        self._labels_file = None  # file in the current layout that holds _saved_labels, see save_labels
+        self._saved_labels = None
 
     def plot(self, axis=None, plot_raw=False, break_after=10, subplots_shape=(3,3)) -> None:
         fig, axes = plt.subplots(*subplots_shape, dpi=300, figsize=(8,8))
@@ -77,8 +421,63 @@ class Sample:
             spot.plot(axis=axis, plot_raw=plot_raw, break_after=break_after)
         fig.show()
 
+    def materialize(self) -> int:
+        """
+        Corrects all of the spectra in the sample that have not been corrected yet (see Spectrum lazy mode).
+        Spectra sharing a processor are corrected in a single batch.
+        :return: number of spectra that were corrected
+        :rtype: int
+        """
+        return Spectrum.materialize_all([spectrum for spot in self.spot_list for spectrum in spot.spectrum_list])
+
+    @property
+    def cube(self) -> SpectralCube:
+        """
+        The SpectralCube holding every spectrum of the sample, with one cube spot per spot of the sample.
+        If the spots are not already views onto a single cube (e.g. a sample built from a folder of spot
+        files), the spectra are copied into a new cube and every spot and spectrum is rebound to it.
+        Spectra whose processor differs from the first spot's are corrected before they are copied.
+        :return: the cube
+        :rtype: SpectralCube
+        """
+        assert len(self.spot_list) != 0, 'spot list empty, cannot build a cube'
+        if isinstance(self.spot_list, CubeSpots):
+            return self.spot_list.cube
+        cube = self.spot_list[0].cube
+        if cube is not None and cube.n_spots == len(self.spot_list) and \
+                all(spot.cube is cube and spot.spot_index == index for index, spot in enumerate(self.spot_list)):
+            return cube
+
+        spectra = [spectrum for spot in self.spot_list for spectrum in spot.spectrum_list]
+        first = spectra[0]
+        Spectrum.materialize_all([spectrum for spectrum in spectra if spectrum.processor is not first.processor])
+        for source in {id(spectrum.cube): spectrum.cube for spectrum in spectra}.values():
+            assert source.laser_wavelength == first.laser_wavelength, 'all spectra must use same laser wavelength'
+            assert source.n_points == first.data_length, 'all spectra must be same length'
+            np.testing.assert_almost_equal(first.wavenumbers, source.wavenumbers, 3,
+                                           err_msg='all spectra must have same wavenumbers')
+
+        spot_index = np.repeat(np.arange(len(self.spot_list)), [len(spot.spectrum_list) for spot in self.spot_list])
+        cube = SpectralCube(np.array([spectrum.raw_data for spectrum in spectra]), first.raw_positions,
+                            first.processor, first.laser_wavelength, first.position_type,
+                            labels=[spectrum.label for spectrum in spectra], spot_index=spot_index,
+                            spot_positions=[spot.position for spot in self.spot_list])
+        cube.wavenumbers = first.wavenumbers
+        is_corrected = np.array([spectrum.is_corrected for spectrum in spectra])
+        if is_corrected.any():
+            cube.corrected[is_corrected] = [spectrum.corrected_data for spectrum in spectra if spectrum.is_corrected]
+            cube.is_corrected[:] = is_corrected
+
+        for index, spectrum in enumerate(spectra):
+            spectrum._bind(cube, index)
+        for index, spot in enumerate(self.spot_list):
+            spot._bind(cube, index)
+        return cube
+
     @staticmethod
-    def build_sample(folder_path: str, parser_class=DefaultSpotParser, metadata=None, name=None) -> "Sample":
+    def build_sample(folder_path: str, parser_class=DefaultSpotParser, metadata=None, name=None,
+                     processor: Optional[ABCSpecProcessor] = None, lazy: bool = False, n_jobs: Optional[int] = 1,
+                     executor: Optional[Executor] = None) -> "Sample":
         """
         This builds a sample from a folder containing .txt files
         :param folder_path: folder path
@@ -89,14 +488,30 @@ class Sample:
         :type metadata: Dict
         :param name: The name of the sample
         :type name: str
+        :param processor: processor used to correct the spectra (e.g. a ProcessingPipeline), if None
+        every spot uses the shared SpectrumProcessor for its laser wavelength
+        :type processor: Optional[ABCSpecProcessor]
+        :param lazy: if True the spectra are not corrected until they are accessed or materialized
+        :type lazy: bool
+        :param n_jobs: number of worker processes used to parse and correct the files (-1 for all cores)
+        :type n_jobs: Optional[int]
+        :param executor: an existing executor to parse and correct the files on instead of creating a process pool
+        :type executor: Optional[Executor]
         :return: A newly created sample
         :rtype: "Sample"
         """
         assert os.path.isdir(folder_path), 'folder_path must point to a directory and not a single file'
-        file_list = glob.glob(os.path.join(folder_path, '*.txt'))
+        file_list = sorted(glob.glob(os.path.join(folder_path, '*.txt')))
         spot_list = []
-        for file in file_list:
-            spot_list.append(SpotBuilder(file, parser_class).build_spot())
+        if executor is None and n_jobs == 1:
+            for file in file_list:
+                spot_list.append(SpotBuilder(file, parser_class, processor, lazy).build_spot())
+        else:
+            # workers send back the parsed arrays and the corrected arrays, the spectra are built here
+            results = map_spot_files(file_list, parser_class, processor, not lazy, n_jobs, executor)
+            for file, (parser, corrected) in zip(file_list, results):
+                spot_builder = SpotBuilder(file, parser_class, processor, lazy, parser=parser)
+                spot_list.append(spot_builder.build_spot(corrected))
 
         return Sample(spot_list, metadata=metadata, filepath=folder_path, name=name)
 
@@ -114,6 +529,31 @@ class Sample:
 
         return xr.Dataset(dict_vars, attrs=self.metadata)
 
+    def build_columnar_Dataset(self) -> xr.Dataset:
+        """
+        Build a Dataset in the current on disk layout (LAYOUT_VERSION). Every spectrum is stored in a single
+        (spectrum, type, wavenumber) variable named spectra. The spot of each spectrum and its label
+        (integer Label values) are coordinates along the spectrum dimension, the position and filepath of
+        each spot are coordinates along the spot dimension.
+        :return: an xr.Dataset object containing all of the information in this class
+        :rtype: xr.Dataset
+        """
+        cube = self.cube
+        cube.correct()
+        attrs = dict(self.metadata) if self.metadata is not None else {}
+        attrs.update({'name': str(self.name),
+                      'layout_version': LAYOUT_VERSION,
+                      'laser_wavelength': cube.laser_wavelength,
+                      'spectrum_length': cube.n_points})
+        coords = {'type': ['raw', 'corrected'],
+                  'wavenumber': cube.wavenumbers,
+                  'spot_index': ('spectrum', cube.spot_index),
+                  'label': xr.Variable('spectrum', cube.labels, attrs=_label_attrs()),
+                  'position': (('spot', 'xy'), cube.spot_positions),
+                  'filepath': ('spot', [spot.filepath for spot in self.spot_list])}
+        data = np.stack((cube.raw, cube.corrected), axis=1)
+        return xr.Dataset({'spectra': (('spectrum', 'type', 'wavenumber'), data)}, coords=coords, attrs=attrs)
+
     def buildFlatDataset(self):
         dict_vars = {}
         i = 0
@@ -124,68 +564,324 @@ class Sample:
 
         return xr.Dataset(dict_vars, attrs=self.metadata)
 
-    def save_dataset(self, filename: str) -> None:
+    def save_dataset(self, filename: str, layout_version: int = LAYOUT_VERSION, backend: str = 'netcdf',
+                     compression: Optional[str] = None, compression_level: int = 4, shuffle: bool = True,
+                     dtype: Optional[str] = None, chunk_spectra: int = SPECTRA_PER_CHUNK) -> None:
         """
-        Save the current dataset as a netcdf file
-        :param filename: name of the output filename
+        Save the current dataset as a netcdf file or a zarr directory store. The encoding options apply to
+        the spectra variable of layout 2, see ramanbox.pipeline.benchmarks.benchmark_save_options for their
+        effect on file size and speed.
+        :param filename: name of the output filename (a directory for the zarr backend)
         :type filename: str
+        :param layout_version: 2 (default) writes build_columnar_Dataset chunked by spectrum,
+        1 writes the legacy layout of build_Dataset with one variable per spot
+        :type layout_version: int
+        :param backend: 'netcdf' writes a single file, 'zarr' writes a directory store with one file per chunk,
+        so chunks are written concurrently and can be read by several processes without a shared lock
+        :type backend: str
+        :param compression: compression of the spectra, e.g. 'zlib', 'zstd' or 'blosc_lz4', None for no compression
+        :type compression: Optional[str]
+        :param compression_level: compression level
+        :type compression_level: int
+        :param shuffle: if True bytes are shuffled before compression (only for zlib with the netcdf backend,
+        netCDF4 ignores it for the other compressions, and only by blosc for the zarr backend)
+        :type shuffle: bool
+        :param dtype: storage type of the spectra, None or 'float64' (lossless), 'float32', or 'int16' / 'int32'
+        scaled integers (CF scale_factor and add_offset over the range of the data, the step is
+        (max - min) / (2 ** bits - 2)). Spectra are always read back as floats.
+        :type dtype: Optional[str]
+        :param chunk_spectra: number of spectra per chunk
+        :type chunk_spectra: int
         :return: None
         :rtype: None
         """
-        dataset = self.build_Dataset()
-        dataset.attrs['name'] = str(self.name)
-        for index in dataset:
-            dataset[index].attrs.pop('metadata')  # metadata is not currently saved
-            dataset[index].attrs['labels'] = convert_dict_labels_to_list(dataset[index].attrs['labels'])
+        if layout_version == 1:
+            dataset = self.build_Dataset()
+            dataset.attrs['name'] = str(self.name)
+            for index in dataset:
+                _prepare_spot_attrs(dataset[index])
+            _write_dataset(dataset, filename, backend, {})
+            return
+
+        assert layout_version == LAYOUT_VERSION, f'unknown layout version {layout_version}'
+        if backend == 'zarr':
+            dataset = self.build_columnar_Dataset()
+            encoding = {'spectra': _spectra_encoding(dataset['spectra'].values, backend, compression,
+                                                     compression_level, shuffle, dtype, chunk_spectra)}
+            _write_dataset(dataset, filename, backend, encoding)
+        else:
+            assert backend == 'netcdf', f'unknown backend {backend}, must be one of {BACKENDS}'
+            # written chunk by chunk from the cube, without building the dataset in memory
+            cube = self.cube
+            value_range = None
+            if dtype in ('int16', 'int32'):
+                cube.correct()
+                value_range = _value_range(cube.raw, cube.corrected)
+            with SpectraWriter(filename, cube.wavenumbers, cube.laser_wavelength, self.name, self.metadata,
+                               compression, compression_level, shuffle, dtype, value_range,
+                               chunk_spectra) as writer:
+                writer.write_cube(cube, [spot.filepath for spot in self.spot_list])
+        self._mark_labels_saved(filename)
+
+    def _mark_labels_saved(self, filename: str) -> None:
+        """
+        Records the labels as they are in filename, so that save_labels only has to write the changes
+        """
+        self._labels_file = os.path.abspath(filename)
+        self._saved_labels = self.cube.labels.copy()
+
+    def save_labels(self, filename: Optional[str] = None) -> int:
+        """
+        Save the labels of the sample. If filename is the file the sample was loaded from or last saved to
+        (in the current layout), only the labels that changed since then are written into the integer label
+        variable of the existing file, so the cost does not depend on the size of the sample. Otherwise the
+        whole sample is saved with save_dataset.
+        :param filename: name of the output filename, if None the filepath of the sample is used
+        :type filename: Optional[str]
+        :return: the number of labels written
+        :rtype: int
+        """
+        if filename is None:
+            filename = self.filepath
+        cube = self.cube
+        if self._labels_file != os.path.abspath(filename) or len(self._saved_labels) != cube.n_spectra:
+            self.save_dataset(filename)
+            return cube.n_spectra
 
-        dataset.to_netcdf(filename)
+        changed = np.flatnonzero(cube.labels != self._saved_labels)
+        if len(changed) == 0:
+            return 0
+        start, stop = changed[0], changed[-1] + 1
+        if os.path.isdir(filename):  # zarr store, only the chunks holding the span are rewritten
+            _import_zarr().open_group(filename, mode='r+')['label'][start:stop] = cube.labels[start:stop]
+        else:
+            self.close()  # a lazy sample holds the file open read only, its reads reopen the file when needed
+            with netCDF4.Dataset(filename, 'r+') as dataset:
+                dataset.variables['label'][start:stop] = cube.labels[start:stop]
+        self._saved_labels[start:stop] = cube.labels[start:stop]
+        return len(changed)
 
+    @staticmethod
+    def save_spots(spots: Iterable[Spot], filename: str, name: Optional[str] = None,
+                   metadata: Optional[Dict] = None, spots_per_write: int = 64, **encoding) -> int:
+        """
+        Save spots to a netcdf file as they are produced (e.g. by SampleBuilder.iter_spots), so that the
+        whole sample never has to be held in memory. The file is created from the first spot and the spots are
+        appended to it by a SpectraWriter a chunk of spectra at a time. The file has the same layout as
+        save_dataset.
+        :param spots: iterable of spots
+        :type spots: Iterable[Spot]
+        :param filename: name of the output filename
+        :type filename: str
+        :param name: name of the sample
+        :type name: Optional[str]
+        :param metadata: dictionary of metadata for the sample
+        :type metadata: Optional[Dict]
+        :param spots_per_write: largest number of spots held in memory before they are appended to the file
+        :type spots_per_write: int
+        :param encoding: compression, compression_level, shuffle, dtype ('float32' or 'float64', the integer
+        dtypes need the range of the whole sample) and chunk_spectra, see save_dataset
+        :return: the number of spots written
+        :rtype: int
+        """
+        spots = iter(spots)
+        first = next(spots, None)
+        if first is None:
+            attrs = dict(metadata) if metadata is not None else {}
+            attrs['name'] = str(name)
+            xr.Dataset(attrs=attrs).to_netcdf(filename)
+            return 0
 
+        with SpectraWriter(filename, first.spectrum_list[0].wavenumbers, first.spectrum_list[0].laser_wavelength,
+                           name, metadata, spots_per_write=spots_per_write, **encoding) as writer:
+            writer.write_spot(first)
+            for spot in spots:
+                writer.write_spot(spot)
+            writer.flush()
+            return writer.n_spots
 
     @staticmethod
-    def build_from_netcdf(filepath: str, engine='netcdf4') -> "Sample":
+    def build_from_netcdf(filepath: str, engine: Optional[str] = None, lazy: bool = False) -> "Sample":
         """
-       Build a Sample object from a netcdf file
+        Build a Sample object from a netcdf file or a zarr directory store, files in the legacy layout
+        (one variable per spot) are detected and still loaded
         :param filepath: filepath to the netcdf object
         :type filepath: str
+        :param engine: xarray engine, if None 'zarr' is used for directories and 'netcdf4' otherwise
+        :type engine: Optional[str]
+        :param lazy: if True (and the file is in the current layout) the file is kept open, spectra are
+        read chunk by chunk and spots are built when they are accessed (spot_list is a read only CubeSpots).
+        Call Sample.close when done.
+        :type lazy: bool
         :return: None
         :rtype: None
         """
-        dataset = xr.open_dataset(filepath, engine=engine)
+        if engine is None:
+            engine = 'zarr' if os.path.isdir(filepath) else 'netcdf4'
+        kwargs = {}
+        if engine == 'zarr':
+            _import_zarr()
+            kwargs['consolidated'] = False
+        dataset = xr.open_dataset(filepath, engine=engine, **kwargs)
+        if dataset.attrs.get('layout_version', 1) >= 2:
+            return Sample._from_columnar_dataset(dataset, filepath, lazy)
+        dataset.load()
         dataset.close()
-        name = dataset.attrs['name']
-        spot_list = []
+        return Sample._from_legacy_dataset(dataset, filepath)
+
+    @staticmethod
+    def _from_legacy_dataset(dataset: xr.Dataset, filepath: str) -> "Sample":
+        """
+        Build a Sample from a Dataset in the legacy layout, with one (index, type, wavenumber) variable per spot.
+        Each variable is read as a single array, and if every spot has the same wavenumbers and laser the
+        spectra are stacked into a single SpectralCube.
+        :param dataset: the loaded dataset
+        :type dataset: xr.Dataset
+        :param filepath: filepath to the netcdf file
+        :type filepath: str
+        :return: the sample
+        :rtype: Sample
+        """
+        raw, corrected, labels, spot_sizes, positions, spot_filepaths, axes = [], [], [], [], [], [], []
         for index in dataset:
-            # build a spot
-            spectrum_list = []
-            position = dataset[index].attrs['position']
-            metadata = None
-            filepath = dataset[index].attrs['filepath']
-            dataset[index].attrs['labels'] = convert_list_to_dict(dataset[index].attrs['labels'])
-            for spec_index, spec_data in enumerate(dataset[index]):
-                raw_data = np.zeros((len(spec_data.loc['raw']), 2))
-                raw_data[:, 1] = spec_data.loc['raw']
-                corrected_data = spec_data.loc['corrected']
-                wavenumbers = spec_data.wavenumber.values
-                raw_data[:, 0] = wavenumbers
-                laser_wavelength = spec_data.attrs['laser_wavelength']
-                label = spec_data.attrs['labels'][spec_index]
-                position_type = PositionType.WAVENUMBER
-                processor = DataSpecProcessor(laser_wavelength, corrected_data, wavenumbers)
-                new_spectrum = Spectrum(raw_data, processor, laser_wavelength, label, position_type)
-                spectrum_list.append(new_spectrum)
-
-            new_spot = Spot(spectrum_list, position, metadata, filepath)
-            spot_list.append(new_spot)
-
-        return Sample(spot_list, dataset.attrs, filepath, name)
-
-    def to_pandas(self, use_corrected=True):
-        complete_df = pd.DataFrame()
-        for spot in self.spot_list:
-            spot_df = spot.to_pandas(use_corrected)
-            spot_df['name'] = self.name
-            complete_df = complete_df.append(spot_df, ignore_index=True)
-
-        assert complete_df is not None, 'complete df is none, spot list must be empty!'
-        return complete_df
+            spot_data = dataset[index].transpose('index', 'type', 'wavenumber')
+            types = list(spot_data['type'].values)
+            data = spot_data.values
+            raw.append(data[:, types.index('raw')])
+            corrected.append(data[:, types.index('corrected')])
+            spot_labels = convert_list_to_dict(spot_data.attrs['labels'])
+            labels.extend(spot_labels[spec_index].value for spec_index in range(len(data)))
+            spot_sizes.append(len(data))
+            positions.append(spot_data.attrs['position'])
+            spot_filepaths.append(spot_data.attrs['filepath'])
+            axes.append((spot_data.attrs['laser_wavelength'], intern_axis(spot_data['wavenumber'].values)))
+
+        processors = {}  # spots with the same wavenumbers share a processor
+        for laser_wavelength, wavenumbers in axes:
+            key = (laser_wavelength, id(wavenumbers))
+            if key not in processors:
+                processors[key] = DataSpecProcessor(laser_wavelength, None, wavenumbers)
+
+        labels = np.array(labels, dtype=np.int8)
+        if len(processors) == 1:
+            laser_wavelength, wavenumbers = axes[0]
+            cube = SpectralCube(np.concatenate(raw), wavenumbers, next(iter(processors.values())), laser_wavelength,
+                                PositionType.WAVENUMBER, corrected=np.concatenate(corrected), labels=labels,
+                                spot_index=np.repeat(np.arange(len(spot_sizes)), spot_sizes),
+                                spot_positions=positions)
+            spot_list = Spot.list_from_cube(cube, None, spot_filepaths)
+        else:
+            spot_list = []
+            bounds = np.cumsum([0] + spot_sizes)
+            for spot_index, (laser_wavelength, wavenumbers) in enumerate(axes):
+                processor = processors[(laser_wavelength, id(wavenumbers))]
+                cube = SpectralCube(raw[spot_index], wavenumbers, processor, laser_wavelength,
+                                    PositionType.WAVENUMBER, corrected=corrected[spot_index],
+                                    labels=labels[bounds[spot_index]:bounds[spot_index + 1]],
+                                    spot_positions=[positions[spot_index]])
+                spot_list.append(Spot.from_cube(cube, 0, None, spot_filepaths[spot_index]))
+
+        return Sample(spot_list, dataset.attrs, filepath, dataset.attrs['name'])
+
+    @staticmethod
+    def _from_columnar_dataset(dataset: xr.Dataset, filepath: str, lazy: bool = False) -> "Sample":
+        """
+        Build a Sample from a Dataset in the layout written by build_columnar_Dataset
+        :param dataset: the dataset, closed here unless lazy
+        :type dataset: xr.Dataset
+        :param filepath: filepath to the netcdf file
+        :type filepath: str
+        :param lazy: if True the spectra are read when they are accessed, see LazySpectralCube
+        :type lazy: bool
+        :return: the sample
+        :rtype: Sample
+        """
+        layout_version = dataset.attrs['layout_version']
+        assert layout_version <= LAYOUT_VERSION, f'file layout version {layout_version} is newer than this reader'
+        laser_wavelength = dataset.attrs['laser_wavelength']
+        wavenumbers = intern_axis(dataset['wavenumber'].values)
+        processor = DataSpecProcessor(laser_wavelength, None, wavenumbers)
+        spectra = dataset['spectra'].transpose('spectrum', 'type', 'wavenumber')
+        types = list(dataset['type'].values)
+        index_coords = dict(labels=dataset['label'].values, spot_index=dataset['spot_index'].values,
+                            spot_positions=dataset['position'].values)
+        if lazy:
+            chunk_size = (spectra.encoding.get('chunksizes') or spectra.encoding.get('chunks')
+                          or (SPECTRA_PER_CHUNK,))[0]
+            read_rows = partial(_read_spectra_rows, spectra, types.index('raw'), types.index('corrected'))
+            cube = LazySpectralCube(read_rows, len(spectra), wavenumbers, processor, laser_wavelength,
+                                    PositionType.WAVENUMBER, chunk_size=chunk_size, close=dataset.close,
+                                    **index_coords)
+        else:
+            data = spectra.values
+            dataset.close()
+            cube = SpectralCube(data[:, types.index('raw')], wavenumbers, processor, laser_wavelength,
+                                PositionType.WAVENUMBER, corrected=data[:, types.index('corrected')],
+                                **index_coords)
+        filepaths = [str(path) for path in dataset['filepath'].values.tolist()]
+        spot_list = CubeSpots(cube, None, filepaths) if lazy else Spot.list_from_cube(cube, None, filepaths)
+        metadata = {key: value for key, value in dataset.attrs.items() if key not in _LAYOUT_ATTRS}
+        sample = Sample(spot_list, metadata, filepath, metadata.get('name'))
+        sample._mark_labels_saved(filepath)
+        return sample
+
+    def close(self) -> None:
+        """
+        Closes the files of a sample opened with build_from_netcdf(lazy=True), spectra that have not been
+        read can't be accessed afterwards
+        :return: None
+        :rtype: None
+        """
+        if isinstance(self.spot_list, CubeSpots):
+            self.spot_list.cube.close()
+            return
+        for cube in {id(spot.cube): spot.cube for spot in self.spot_list if spot.cube is not None}.values():
+            cube.close()
+
+    def to_pandas(self, use_corrected=True) -> pd.DataFrame:
+        """
+        Builds a DataFrame with one row per spectrum. The columns are filled in one go from the sample's
+        SpectralCube, each spectrum cell is a view onto a row of the cube.
+        :param use_corrected: if False the raw spectra are used
+        :type use_corrected: bool
+        :return: DataFrame with spectrum, label, x_pos, y_pos and name columns
+        :rtype: pd.DataFrame
+        """
+        cube = self.cube
+        data = cube.data(use_corrected)
+        positions = cube.spot_positions[cube.spot_index]
+        return pd.DataFrame({'spectrum': list(data),
+                             'label': cube.label_array(),
+                             'x_pos': positions[:, 0],
+                             'y_pos': positions[:, 1],
+                             'name': [self.name] * cube.n_spectra})
+
+    def to_arrow(self, use_corrected=True) -> "pyarrow.Table":
+        """
+        Builds an Apache Arrow table with one row per spectrum (requires pyarrow). The spectrum column is a
+        fixed size list column backed by the sample's SpectralCube without a copy, so
+        table['spectrum'].chunk(0).flatten().to_numpy().reshape(-1, n_points) gives back the spectra.
+        The wavenumbers are stored as json in the schema metadata.
+        :param use_corrected: if False the raw spectra are used
+        :type use_corrected: bool
+        :return: table with spectrum, label (dictionary encoded label names), x_pos, y_pos and name columns
+        :rtype: pyarrow.Table
+        """
+        try:
+            import pyarrow as pa
+        except ImportError as error:
+            raise ImportError('Sample.to_arrow requires pyarrow (pip install pyarrow)') from error
+
+        cube = self.cube
+        data = np.ascontiguousarray(cube.data(use_corrected))
+        positions = cube.spot_positions[cube.spot_index].astype(float)
+        label_names = [None] * (max(label.value for label in Label) + 1)
+        for label in Label:
+            label_names[label.value] = label.name
+        spectrum = pa.FixedSizeListArray.from_arrays(pa.array(data.reshape(-1)), cube.n_points)
+        label = pa.DictionaryArray.from_arrays(pa.array(cube.labels), pa.array(label_names))
+        name = pa.DictionaryArray.from_arrays(pa.array(np.zeros(cube.n_spectra, dtype=np.int8)),
+                                              pa.array([str(self.name)]))
+        table = pa.table({'spectrum': spectrum, 'label': label, 'x_pos': positions[:, 0],
+                          'y_pos': positions[:, 1], 'name': name})
+        return table.replace_schema_metadata({'wavenumbers': json.dumps(np.asarray(cube.wavenumbers).tolist())})
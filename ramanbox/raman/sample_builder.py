@@ -1,21 +1,35 @@
-from ramanbox.raman.spot import Spot
-from ramanbox.raman.spectrum import Spectrum
-from ramanbox.raman.processing import SpectrumProcessor, DefaultSpotParser
+from ramanbox.raman.spot import Spot, shared_raw_positions
+from ramanbox.raman.spectral_cube import SpectralCube
+from ramanbox.raman.processing import ABCSpecProcessor, SpectrumProcessor, DefaultSpotParser
 from ramanbox.raman.sample import Sample
+from ramanbox.raman.parallel import correct_spectra
+from concurrent.futures import Executor
 from pathlib import Path
+import numpy as np
+from typing import Iterator, Optional
 
 class SampleBuilder:
     """
     This function is useful for the case where each spectrum in a file is its own spot.
     """
     def __init__(self, filepath: str, parser_class=DefaultSpotParser, row_size: int = 20, row_step: int = 1,
-                 col_step:int = 1, start_iter: int = 0):
+                 col_step:int = 1, start_iter: int = 0, processor: Optional[ABCSpecProcessor] = None,
+                 lazy: bool = False, stream: bool = False):
         self.filepath = filepath
-        self.parser = parser_class(filepath)
+        if stream:  # only the metadata is read now, the spectra are streamed by iter_spots
+            self.parser = parser_class(filepath, load=False)
+        else:
+            self.parser = parser_class(filepath)
         self.row_size = row_size
         self.row_step = row_step
         self.col_step = col_step
         self.iter = start_iter
+        if processor is None:  # e.g. a ProcessingPipeline, by default a SpectrumProcessor
+            processor = SpectrumProcessor.shared(self.parser.laser_wavelength)
+        self.processor = processor
+        self.cosmic_rays_removed = 0  # spikes replaced in the spectra this builder corrected (not lazy ones)
+        self.lazy = lazy  # if True the spectra are not corrected until they are accessed or materialized
+        self._raw_positions = None  # position axis of the first streamed block, later blocks must match it
 
     def get_position(self):  # maybe encoded in filepath at some point
         """
@@ -27,21 +41,80 @@ class SampleBuilder:
         self.iter += 1
         return result
 
-    def build_sample(self) -> Sample:
+    @property
+    def name(self) -> str:
+        """
+        The name of the sample, taken from the filename
+        :return: name
+        :rtype: str
+        """
+        return str(Path(self.filepath).stem)
+
+    def iter_spots(self, block_size: int = 64) -> Iterator[Spot]:
+        """
+        Streams the spots of the file. The spectra are parsed and corrected one block at a time, so memory
+        stays bounded by the block size (use with stream=True so the parser doesn't load the whole file).
+        Cosmic rays are found within each block.
+        :param block_size: number of spectra parsed and corrected at a time
+        :type block_size: int
+        :return: iterator of spots, each holding a single spectrum
+        :rtype: Iterator[Spot]
+        """
+        for block in self.parser.iter_spectra_blocks(block_size):
+            before = self._spikes_counted()
+            corrected = self.processor.correct_spectrum_batch(block[:, :, 1])
+            self.cosmic_rays_removed += self._spikes_counted() - before
+            cube = self._build_cube(block, corrected)
+            yield from Spot.list_from_cube(cube, self.parser.metadata, [self.filepath] * cube.n_spots)
+
+    def _build_cube(self, spectra: np.array, corrected: Optional[np.array] = None) -> SpectralCube:
+        """
+        Builds a cube with one spot per spectrum, sharing the position axis of the first spectrum (or of
+        the first streamed block)
+        :param spectra: parsed spectra with shape (n_spectra, n_points, 2)
+        :type spectra: np.array
+        :param corrected: corrected spectra with shape (n_spectra, n_points), if None they are corrected later
+        :type corrected: Optional[np.array]
+        :return: the cube
+        :rtype: SpectralCube
+        :raises SpotConsistencyError: if the spectra don't share a position axis (e.g. a data line is missing)
+        """
+        raw_positions = shared_raw_positions(spectra, self.parser.laser_wavelength, self._raw_positions)
+        if len(spectra):
+            self._raw_positions = raw_positions
+        return SpectralCube(spectra[:, :, 1], raw_positions, self.processor, self.parser.laser_wavelength,
+                            corrected=corrected, spot_index=np.arange(len(spectra)),
+                            spot_positions=[self.get_position() for _ in range(len(spectra))])
+
+    def build_sample(self, n_jobs: Optional[int] = 1, executor: Optional[Executor] = None) -> Sample:
         """
         This builds a spot from a filepath
+        :param n_jobs: number of worker processes used to correct the spectra (-1 for all cores). The raster
+        is split into one contiguous block of spectra per worker. Cosmic rays are found against a reference
+        computed over the whole raster and sent to every worker (see ramanbox.raman.parallel.correct_spectra),
+        so the corrected spectra are the same whatever n_jobs is.
+        :type n_jobs: Optional[int]
+        :param executor: an existing executor to correct the spectra on instead of creating a process pool
+        :type executor: Optional[Executor]
         :return: A sample created from a .txt file where each spectrum is its own spot
         :rtype: Sample
         """
-        metadata = self.parser.metadata
         spectra = self.parser.spectra
-        spot_list = []
-        for spectrum in spectra:
-            new_spectrum_list = [Spectrum(spectrum, SpectrumProcessor(self.parser.laser_wavelength),
-                                          self.parser.laser_wavelength)]
+        if spectra is None:  # streaming parser
+            spectra = np.concatenate(list(self.parser.iter_spectra_blocks()))
+        spectra = np.asarray(spectra).reshape(-1, self.parser.spectrum_length, 2)
+        corrected = None
+        before = self._spikes_counted()
+        if not self.lazy and (executor is not None or n_jobs != 1):
+            corrected = correct_spectra(self.processor, spectra[:, :, 1], n_jobs, executor)
+        cube = self._build_cube(spectra, corrected)
+        spot_list = Spot.list_from_cube(cube, self.parser.metadata, [self.filepath] * cube.n_spots)
+        new_sample = Sample(spot_list, name=self.name)
+        if not self.lazy:
+            # the whole raster is corrected together, so cosmic rays are found using the neighbouring spectra
+            new_sample.materialize()
+        self.cosmic_rays_removed += self._spikes_counted() - before
+        return new_sample
 
-            new_spot = Spot(spectrum_list=new_spectrum_list, position=self.get_position(), metadata=metadata,
-                            filepath=self.filepath)
-            spot_list.append(new_spot)
-        name = str(Path(self.filepath).stem)
-        return Sample(spot_list, name=name)
+    def _spikes_counted(self) -> int:
+        return getattr(self.processor, 'cosmic_rays_removed', 0)
@@ -0,0 +1,381 @@
+import hashlib
+import weakref
+import numpy as np
+from ramanbox.raman.processing import ABCSpecProcessor
+from ramanbox.raman.constants import PositionType, Label
+from typing import Callable, List, Optional, Sequence, Tuple
+
+
+_AXES = weakref.WeakValueDictionary()
+
+
+def intern_axis(axis: np.array) -> np.array:
+    """
+    Returns a shared read only copy of a position or wavenumber axis, so that cubes built from files
+    with the same axis hold a single array. Axes are dropped once no cube uses them anymore.
+    :param axis: the axis
+    :type axis: np.array
+    :return: an equal, read only array shared with every other caller passing the same values
+    :rtype: np.array
+    """
+    axis = np.ascontiguousarray(axis, dtype=float)
+    key = (axis.shape, hashlib.blake2b(axis.tobytes(), digest_size=16).digest())
+    shared = _AXES.get(key)
+    if shared is None or not np.array_equal(shared, axis):
+        shared = axis.copy()
+        shared.setflags(write=False)
+        _AXES[key] = shared
+    return shared
+
+
+def _position_array(positions: List[Optional[Tuple[float, float]]]) -> np.array:
+    """
+    Stacks spot positions into an (n_spots, 2) array. Missing positions are stored as nan, integer
+    positions keep an integer dtype if no position is missing.
+    """
+    if isinstance(positions, np.ndarray):
+        return np.array(positions).reshape(-1, 2)
+    if any(position is None for position in positions):
+        return np.array([(np.nan, np.nan) if position is None else position for position in positions],
+                        dtype=float).reshape(-1, 2)
+    return np.array(positions).reshape(-1, 2)
+
+
+class SpectralCube:
+    """
+    Columnar storage for a set of spectra that share a position axis, a processor and a laser wavelength.
+    Raw and corrected spectra are stored as contiguous (n_spectra, n_points) blocks and the label, spot and
+    spot position of each spectrum are kept in parallel arrays. Spectrum and Spot objects built with
+    from_cube are views onto a cube, so operations over a whole sample can work on the blocks directly.
+    """
+    def __init__(self, raw: np.array, raw_positions: np.array, processor: ABCSpecProcessor,
+                 laser_wavelength: float, position_type: PositionType = PositionType.WAVELENGTH,
+                 corrected: Optional[np.array] = None, labels: Optional[Sequence[Label]] = None,
+                 spot_index: Optional[np.array] = None,
+                 spot_positions: Optional[List[Optional[Tuple[float, float]]]] = None) -> None:
+        """
+        Initilization function
+        :param raw: raw spectra with shape (n_spectra, n_points), not copied if it is a contiguous float array
+        :type raw: np.array
+        :param raw_positions: position axis shared by every spectrum with shape (n_points,)
+        :type raw_positions: np.array
+        :param processor: processor used to compute the wavenumbers and to correct the spectra
+        :type processor: ABCSpecProcessor
+        :param laser_wavelength: laser wavelength
+        :type laser_wavelength: float
+        :param position_type: The type of the position vector
+        :type position_type: PositionType
+        :param corrected: corrected spectra computed ahead of time with the same shape as raw,
+        if None the spectra are corrected by correct. Like raw, it is not copied if it is a contiguous float array.
+        :type corrected: Optional[np.array]
+        :param labels: label of each spectrum (or an integer array of Label values), if None every
+        spectrum is Label.UNCAT
+        :type labels: Optional[Sequence[Label]]
+        :param spot_index: the spot each spectrum belongs to, spectra of a spot must be consecutive.
+        If None every spectrum belongs to spot 0.
+        :type spot_index: Optional[np.array]
+        :param spot_positions: position of each spot (None if the spot has no position), or an
+        (n_spots, 2) array with nan for missing positions
+        :type spot_positions: Optional[List[Optional[Tuple[float, float]]]]
+        """
+        raw = np.ascontiguousarray(raw, dtype=float).reshape(-1, len(raw_positions))
+        self.raw = raw
+        self.raw_positions = intern_axis(raw_positions)
+        self.processor = processor
+        self.laser_wavelength = laser_wavelength
+        self.position_type = position_type
+        n_spectra = len(raw)
+
+        self.is_corrected = np.zeros(n_spectra, dtype=bool)
+        if corrected is None:
+            self.corrected = np.empty_like(raw)
+        else:  # used as is if it is already a contiguous float block
+            self.corrected = np.ascontiguousarray(corrected, dtype=float).reshape(raw.shape)
+            self.is_corrected[:] = True
+
+        if labels is None:
+            self.labels = np.full(n_spectra, Label.UNCAT.value, dtype=np.int8)
+        elif isinstance(labels, np.ndarray) and labels.dtype.kind in 'iu':  # already Label values
+            self.labels = labels.astype(np.int8)
+        else:
+            self.labels = np.array([Label(label).value for label in labels], dtype=np.int8)
+
+        if spot_index is None:
+            spot_index = np.zeros(n_spectra, dtype=int)
+        self.spot_index = np.asarray(spot_index, dtype=int)
+        assert len(self.spot_index) == n_spectra, 'spot_index must have one entry per spectrum'
+        assert np.all(np.diff(self.spot_index) >= 0), 'the spectra of a spot must be consecutive'
+
+        n_spots = int(self.spot_index[-1]) + 1 if n_spectra else 0
+        if spot_positions is None:
+            spot_positions = [None] * n_spots
+        assert len(spot_positions) >= n_spots, 'spot_positions must have one entry per spot'
+        self.spot_positions = _position_array(spot_positions)
+        self._wavenumbers = None
+        self._cosmic_ray_reference = None
+
+    @property
+    def n_spectra(self) -> int:
+        return len(self.spot_index)
+
+    @property
+    def n_points(self) -> int:
+        return len(self.raw_positions)
+
+    @property
+    def n_spots(self) -> int:
+        return len(self.spot_positions)
+
+    @property
+    def wavenumbers(self) -> np.array:
+        """
+        The wavenumber axis shared by every spectrum, computed by the processor on first access
+        :return: wavenumbers
+        :rtype: np.array
+        """
+        if self._wavenumbers is None:
+            self.wavenumbers = self.processor.get_wavenumber(self.raw_positions, self.position_type)
+        return self._wavenumbers
+
+    @wavenumbers.setter
+    def wavenumbers(self, value: np.array) -> None:
+        self._wavenumbers = intern_axis(value)
+
+    def position(self, spot: int) -> Optional[Tuple[float, float]]:
+        """
+        The position of a spot
+        :param spot: spot index
+        :type spot: int
+        :return: the position, None if the spot has no position
+        :rtype: Optional[Tuple[float, float]]
+        """
+        position = self.spot_positions[spot]
+        if position.dtype.kind == 'f' and np.isnan(position).any():
+            return None
+        return tuple(position.tolist())
+
+    def set_position(self, spot: int, position: Optional[Tuple[float, float]]) -> None:
+        """
+        Sets the position of a spot
+        :param spot: spot index
+        :type spot: int
+        :param position: the position, None if the spot has no position
+        :type position: Optional[Tuple[float, float]]
+        :return: None
+        :rtype: None
+        """
+        if position is None or np.asarray(position).dtype.kind == 'f':
+            self.spot_positions = self.spot_positions.astype(float, copy=False)
+        self.spot_positions[spot] = (np.nan, np.nan) if position is None else position
+
+    def spot_slice(self, spot: int) -> slice:
+        """
+        The rows holding the spectra of a spot
+        :param spot: spot index
+        :type spot: int
+        :return: slice into the spectrum axis
+        :rtype: slice
+        """
+        start, stop = np.searchsorted(self.spot_index, [spot, spot + 1])
+        return slice(int(start), int(stop))
+
+    def correct(self, indices: Optional[np.array] = None) -> int:
+        """
+        Corrects the spectra that have not been corrected yet with a single processor.correct_spectrum_batch call.
+        The cube is one spot or raster: a part of it is corrected against the processor's cosmic_ray_reference
+        of all of its spectra, so the result doesn't depend on which spectra are corrected together.
+        :param indices: the spectra to correct, if None every spectrum
+        :type indices: Optional[np.array]
+        :return: number of spectra that were corrected
+        :rtype: int
+        """
+        if indices is None:
+            pending = np.flatnonzero(~self.is_corrected)
+        else:
+            indices = np.asarray(indices, dtype=int)
+            pending = indices[~self.is_corrected[indices]]
+        if len(pending):
+            reference = None
+            if len(pending) < self.n_spectra:
+                if self._cosmic_ray_reference is None:
+                    self._cosmic_ray_reference = (self.processor.cosmic_ray_reference(self.raw),)
+                reference = self._cosmic_ray_reference[0]
+            self.corrected[pending] = self.processor.correct_spectrum_batch(self.raw[pending], reference)
+            self.is_corrected[pending] = True
+        return len(pending)
+
+    def raw_row(self, index: int) -> np.array:
+        """
+        The raw data of a single spectrum
+        :param index: row of the spectrum
+        :type index: int
+        :return: raw spectrum
+        :rtype: np.array
+        """
+        return self.raw[index]
+
+    def corrected_row(self, index: int) -> np.array:
+        """
+        The corrected data of a single spectrum, corrected first if needed
+        :param index: row of the spectrum
+        :type index: int
+        :return: corrected spectrum
+        :rtype: np.array
+        """
+        if not self.is_corrected[index]:
+            self.correct([index])
+        return self.corrected[index]
+
+    def set_corrected_row(self, index: int, value: np.array) -> None:
+        """
+        Overwrites the corrected data of a single spectrum
+        :param index: row of the spectrum
+        :type index: int
+        :param value: corrected spectrum
+        :type value: np.array
+        :return: None
+        :rtype: None
+        """
+        self.corrected[index] = value
+        self.is_corrected[index] = True
+
+    def block(self, rows: slice, use_corrected: bool = True) -> np.array:
+        """
+        A range of consecutive spectra (e.g. a spot_slice), corrected first if needed
+        :param rows: the rows to return
+        :type rows: slice
+        :param use_corrected: if False the raw spectra are returned
+        :type use_corrected: bool
+        :return: spectra with shape (n_rows, n_points)
+        :rtype: np.array
+        """
+        if not use_corrected:
+            return self.raw[rows]
+        self.correct(np.arange(*rows.indices(self.n_spectra)))
+        return self.corrected[rows]
+
+    def close(self) -> None:
+        """
+        Releases any file the cube reads from, a cube held in memory has nothing to release
+        :return: None
+        :rtype: None
+        """
+        pass
+
+    def data(self, use_corrected: bool = True) -> np.array:
+        """
+        The spectra as a single block, corrected first if needed
+        :param use_corrected: if False the raw spectra are returned
+        :type use_corrected: bool
+        :return: spectra with shape (n_spectra, n_points)
+        :rtype: np.array
+        """
+        if not use_corrected:
+            return self.raw
+        self.correct()
+        return self.corrected
+
+    def label_array(self) -> np.array:
+        """
+        The labels of every spectrum as Label members
+        :return: object array with shape (n_spectra,)
+        :rtype: np.array
+        """
+        lookup = np.empty(max(label.value for label in Label) + 1, dtype=object)
+        for label in Label:
+            lookup[label.value] = label
+        return lookup[self.labels]
+
+
+class LazySpectralCube(SpectralCube):
+    """
+    A SpectralCube of corrected spectra that are read from a file chunk by chunk as they are accessed,
+    e.g. by Sample.build_from_netcdf(lazy=True). Accessing a spectrum reads the chunk holding it, accessing
+    raw, corrected or data reads everything that has not been read yet.
+    """
+    def __init__(self, read_rows: Callable[[int, int], Tuple[np.array, np.array]], n_spectra: int,
+                 raw_positions: np.array, processor: ABCSpecProcessor, laser_wavelength: float,
+                 position_type: PositionType = PositionType.WAVELENGTH, labels: Optional[Sequence[Label]] = None,
+                 spot_index: Optional[np.array] = None,
+                 spot_positions: Optional[List[Optional[Tuple[float, float]]]] = None, chunk_size: int = 64,
+                 close: Optional[Callable[[], None]] = None) -> None:
+        """
+        Initilization function, see SpectralCube for the parameters that are not listed here
+        :param read_rows: function reading the raw and corrected spectra of rows [start, stop)
+        :type read_rows: Callable[[int, int], Tuple[np.array, np.array]]
+        :param n_spectra: number of spectra in the file
+        :type n_spectra: int
+        :param chunk_size: number of spectra read at a time, ideally the chunk length of the file
+        :type chunk_size: int
+        :param close: function closing the file
+        :type close: Optional[Callable[[], None]]
+        """
+        self._read_rows = read_rows
+        self._close = close
+        self.chunk_size = chunk_size
+        self.loaded = np.zeros(-(-n_spectra // chunk_size), dtype=bool)
+        # np.empty only reserves the memory, pages are committed as chunks are read into them
+        super().__init__(np.empty((n_spectra, len(raw_positions))), raw_positions, processor, laser_wavelength,
+                         position_type, labels=labels, spot_index=spot_index, spot_positions=spot_positions)
+        self.is_corrected[:] = True
+
+    @property
+    def raw(self) -> np.array:
+        self.load()
+        return self._raw
+
+    @raw.setter
+    def raw(self, value: np.array) -> None:
+        self._raw = value
+
+    @property
+    def corrected(self) -> np.array:
+        self.load()
+        return self._corrected
+
+    @corrected.setter
+    def corrected(self, value: np.array) -> None:
+        self._corrected = value
+
+    def load(self, indices: Optional[np.array] = None) -> int:
+        """
+        Reads the chunks holding the given spectra if they have not been read yet
+        :param indices: rows to read, if None every row
+        :type indices: Optional[np.array]
+        :return: number of chunks read
+        :rtype: int
+        """
+        if indices is None:
+            chunks = np.flatnonzero(~self.loaded)
+        else:
+            chunks = np.unique(np.asarray(indices, dtype=int) // self.chunk_size)
+            chunks = chunks[~self.loaded[chunks]]
+        for chunk in chunks:
+            start = chunk * self.chunk_size
+            stop = min(start + self.chunk_size, self.n_spectra)
+            self._raw[start:stop], self._corrected[start:stop] = self._read_rows(start, stop)
+            self.loaded[chunk] = True
+        return len(chunks)
+
+    def raw_row(self, index):
+        self.load([index])
+        return self._raw[index]
+
+    def corrected_row(self, index):
+        self.load([index])
+        return self._corrected[index]
+
+    def set_corrected_row(self, index, value):
+        self.load([index])
+        self._corrected[index] = value
+
+    def block(self, rows, use_corrected=True):
+        self.load(np.arange(*rows.indices(self.n_spectra)))
+        return (self._corrected if use_corrected else self._raw)[rows]
+
+    def correct(self, indices=None):
+        return 0  # the spectra in the file are already corrected
+
+    def close(self):
+        if self._close is not None:
+            self._close()
@@ -1,18 +1,22 @@
 import numpy as np
 from ramanbox.raman.processing import ABCSpecProcessor
 from ramanbox.raman.constants import PositionType, Label
+from ramanbox.raman.spectral_cube import SpectralCube
 import xarray as xr
-from typing import Optional
+from typing import Dict, List, Optional
 
 
 class Spectrum:
     """
-    Class Spectrum represents a single spectrum
+    Class Spectrum represents a single spectrum. The data lives in a row of a SpectralCube, a spectrum
+    built directly from a raw data array gets a cube of its own.
     """
+    __slots__ = ('cube', 'index')
 
     def __init__(self, raw_data: np.array, processor: ABCSpecProcessor,
                  laser_wavelength: float, label: Label = Label.UNCAT,
-                 position_type: PositionType = PositionType.WAVELENGTH) -> None:
+                 position_type: PositionType = PositionType.WAVELENGTH,
+                 corrected_data: Optional[np.array] = None, lazy: bool = False) -> None:
         """
         Initilizes a spectrum
         :param raw_data: Raw data (2d array [positions, raw_spectrum]
@@ -25,17 +29,126 @@ class Spectrum:
         :type label: Label
         :param position_type: The type of the position vector
         :type position_type: PositionType
+        :param corrected_data: corrected data computed ahead of time (e.g. by processor.correct_spectrum_batch),
+        if None the processor corrects raw_data
+        :type corrected_data: Optional[np.array]
+        :param lazy: if True the wavenumbers and corrected data are only computed when they are first accessed
+        (or in bulk by Spectrum.materialize_all)
+        :type lazy: bool
         """
-        self.data_length = len(raw_data)
-        self.raw_data = raw_data[:, 1]
-        self.raw_positions = raw_data[:, 0]
-        self.processor = processor
-        self.laser_wavelength = laser_wavelength
-        self.position_type = position_type
-        # actually do the processing here
-        self.wavenumbers = processor.get_wavenumber(self.raw_positions, position_type)
-        self.corrected_data = processor.correct_spectrum(self.raw_data)
-        self.label = label
+        cube = SpectralCube(raw_data[:, 1], raw_data[:, 0], processor, laser_wavelength, position_type,
+                            corrected=None if corrected_data is None else np.atleast_2d(corrected_data),
+                            labels=[label])
+        self._bind(cube, 0)
+        if not lazy:  # actually do the processing here
+            self.wavenumbers
+            self.corrected_data
+
+    @classmethod
+    def from_cube(cls, cube: SpectralCube, index: int) -> "Spectrum":
+        """
+        Builds a spectrum that is a view onto a row of a SpectralCube, nothing is copied
+        :param cube: the cube holding the data
+        :type cube: SpectralCube
+        :param index: the row of the spectrum in the cube
+        :type index: int
+        :return: the spectrum
+        :rtype: Spectrum
+        """
+        spectrum = cls.__new__(cls)
+        spectrum._bind(cube, index)
+        return spectrum
+
+    def _bind(self, cube: SpectralCube, index: int) -> None:
+        self.cube = cube
+        self.index = index
+
+    @property
+    def data_length(self) -> int:
+        return self.cube.n_points
+
+    @property
+    def raw_data(self) -> np.array:
+        return self.cube.raw_row(self.index)
+
+    @property
+    def raw_positions(self) -> np.array:
+        return self.cube.raw_positions
+
+    @property
+    def processor(self) -> ABCSpecProcessor:
+        return self.cube.processor
+
+    @property
+    def laser_wavelength(self) -> float:
+        return self.cube.laser_wavelength
+
+    @property
+    def position_type(self) -> PositionType:
+        return self.cube.position_type
+
+    @property
+    def label(self) -> Label:
+        return Label(int(self.cube.labels[self.index]))
+
+    @label.setter
+    def label(self, value: Label) -> None:
+        self.cube.labels[self.index] = Label(value).value
+
+    @property
+    def wavenumbers(self) -> np.array:
+        """
+        The wavenumbers of the spectrum, computed by the processor on first access. The wavenumbers
+        are shared by every spectrum of the cube.
+        :return: wavenumbers
+        :rtype: np.array
+        """
+        return self.cube.wavenumbers
+
+    @wavenumbers.setter
+    def wavenumbers(self, value: np.array) -> None:
+        self.cube.wavenumbers = value
+
+    @property
+    def corrected_data(self) -> np.array:
+        """
+        The corrected spectrum, computed by the processor on first access
+        :return: corrected spectrum
+        :rtype: np.array
+        """
+        return self.cube.corrected_row(self.index)
+
+    @corrected_data.setter
+    def corrected_data(self, value: np.array) -> None:
+        self.cube.set_corrected_row(self.index, value)
+
+    @property
+    def is_corrected(self) -> bool:
+        """
+        Whether the corrected data has been computed yet
+        :return: True if corrected_data is available without running the processor
+        :rtype: bool
+        """
+        return bool(self.cube.is_corrected[self.index])
+
+    @staticmethod
+    def materialize_all(spectrum_list: List["Spectrum"]) -> int:
+        """
+        Computes the corrected data of every spectrum that has not been corrected yet. Spectra in the same
+        cube are corrected together with a single processor.correct_spectrum_batch call.
+        :param spectrum_list: spectra to correct
+        :type spectrum_list: List[Spectrum]
+        :return: number of spectra that were corrected
+        :rtype: int
+        """
+        pending: Dict[int, List[Spectrum]] = {}
+        for spectrum in spectrum_list:
+            if not spectrum.is_corrected:
+                pending.setdefault(id(spectrum.cube), []).append(spectrum)
+
+        for group in pending.values():
+            group[0].cube.correct([spectrum.index for spectrum in group])
+        return sum(len(group) for group in pending.values())
 
     def build_DataArray(self, spot: Optional[int] = None) -> xr.DataArray:
         """
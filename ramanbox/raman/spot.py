@@ -1,12 +1,61 @@
 import matplotlib.pyplot as plt
 import numpy as np
+from collections.abc import Sequence
 from itertools import count
-from typing import List, Optional, Tuple, Dict
+from typing import List, Optional, Tuple, Dict, Union
 from ramanbox.raman.spectrum import Spectrum
+from ramanbox.raman.spectral_cube import SpectralCube
 import xarray as xr
 import pandas as pd
 
+
+class SpotConsistencyError(ValueError):
+    """
+    Raised when the spectra of a spot can't be stored together, report is the DataFrame of Spot.validate
+    """
+    def __init__(self, report: pd.DataFrame) -> None:
+        self.report = report
+        bad = report.index[~report['consistent']].tolist()
+        super().__init__(f'{len(bad)} of {len(report)} spectra in spot differ from the first spectrum in length, '
+                         f'laser wavelength or wavenumbers, indices: {bad[:10]}{"..." if len(bad) > 10 else ""}')
+
+
+
+def shared_raw_positions(spectra: np.array, laser_wavelength: float, reference: Optional[np.array] = None,
+                         decimal: int = 3) -> np.array:
+    """
+    The position axis shared by parsed spectra, which are stored in a cube with a single axis
+    :param spectra: parsed spectra with shape (n_spectra, n_points, 2), positions in [:, :, 0]
+    :type spectra: np.array
+    :param laser_wavelength: the laser wavelength of the spectra (reported on error)
+    :type laser_wavelength: float
+    :param reference: axis the spectra must match, if None the first spectrum's axis
+    :type reference: Optional[np.array]
+    :param decimal: positions match if they differ by less than 1.5 * 10 ** -decimal
+    :type decimal: int
+    :return: the shared axis with shape (n_points,)
+    :rtype: np.array
+    :raises SpotConsistencyError: if a spectrum has a different axis (e.g. a data line is missing from the
+    file, so the following spectra are shifted), the report is laid out as Spot.validate's
+    """
+    if reference is None:
+        if not len(spectra):
+            return np.zeros(spectra.shape[1])
+        reference = spectra[0, :, 0]
+    errors = np.abs(spectra[:, :, 0] - reference).max(axis=1, initial=0)
+    consistent = errors < 1.5 * 10.0 ** -decimal
+    if not consistent.all():
+        report = pd.DataFrame({'data_length': np.full(len(spectra), spectra.shape[1]),
+                               'laser_wavelength': np.full(len(spectra), laser_wavelength, dtype=float),
+                               'max_wavenumber_error': errors, 'consistent': consistent})
+        report.index.name = 'index'
+        raise SpotConsistencyError(report)
+    return reference
+
+
 class Spot:
+    __slots__ = ('spectrum_list', 'metadata', 'filepath', 'cube', 'spot_index', '_position')
+
     def __init__(self, spectrum_list: List[Spectrum], position: Optional[Tuple[float, float]] = None,
                  metadata: Optional[Dict] = None, filepath: Optional[str] = None):
         """
@@ -21,49 +70,178 @@ class Spot:
         :type filepath: str
         """
         self.spectrum_list = spectrum_list
-        self.position = position
         self.metadata = metadata
         self.filepath = str(filepath)
+        self.cube = None
+        self.spot_index = None
+        self.position = position
+
+    @classmethod
+    def from_cube(cls, cube: SpectralCube, spot_index: int, metadata: Optional[Dict] = None,
+                  filepath: Optional[str] = None) -> "Spot":
+        """
+        Builds a spot that is a view onto the spectra of a spot in a SpectralCube, nothing is copied
+        :param cube: the cube holding the data
+        :type cube: SpectralCube
+        :param spot_index: index of the spot in the cube
+        :type spot_index: int
+        :param metadata: Dictionary of metadata
+        :type metadata: Optional[Dict]
+        :param filepath: filepath to the spot .txt file
+        :type filepath: str
+        :return: the spot
+        :rtype: Spot
+        """
+        rows = cube.spot_slice(spot_index)
+        spot = cls([Spectrum.from_cube(cube, index) for index in range(rows.start, rows.stop)],
+                   metadata=metadata, filepath=filepath)
+        spot._bind(cube, spot_index)
+        return spot
+
+    @classmethod
+    def list_from_cube(cls, cube: SpectralCube, metadata: Optional[Dict] = None,
+                       filepaths: Optional[List[str]] = None) -> List["Spot"]:
+        """
+        Builds a view for every spot of a SpectralCube, faster than calling from_cube for each spot
+        :param cube: the cube holding the data
+        :type cube: SpectralCube
+        :param metadata: Dictionary of metadata shared by the spots
+        :type metadata: Optional[Dict]
+        :param filepaths: filepath of each spot, if None every spot has filepath None
+        :type filepaths: Optional[List[str]]
+        :return: the spots, in order
+        :rtype: List[Spot]
+        """
+        bounds = np.searchsorted(cube.spot_index, np.arange(cube.n_spots + 1)).tolist()
+        if filepaths is None:
+            filepaths = [None] * cube.n_spots
+        missing = np.isnan(cube.spot_positions).any(axis=1) if cube.spot_positions.dtype.kind == 'f' \
+            else np.zeros(cube.n_spots, dtype=bool)
+        spectra = [Spectrum.from_cube(cube, index) for index in range(cube.n_spectra)]
+        spot_list = []
+        for spot_index, (position, is_missing) in enumerate(zip(cube.spot_positions.tolist(), missing.tolist())):
+            spot = cls(spectra[bounds[spot_index]:bounds[spot_index + 1]], metadata=metadata,
+                       filepath=filepaths[spot_index])
+            spot.cube = cube
+            spot.spot_index = spot_index
+            spot._position = None if is_missing else tuple(position)
+            spot_list.append(spot)
+        return spot_list
+
+    def _bind(self, cube: SpectralCube, spot_index: int) -> None:
+        self.cube = cube
+        self.spot_index = spot_index
+        self._position = cube.position(spot_index)
+
+    @property
+    def position(self) -> Optional[Tuple[float, float]]:
+        return self._position
+
+    @position.setter
+    def position(self, value: Optional[Tuple[float, float]]) -> None:
+        self._position = value
+        if self.cube is not None:  # keep the position column of the cube in sync
+            self.cube.set_position(self.spot_index, value)
+
+    def materialize(self) -> int:
+        """
+        Corrects all of the spectra in the spot that have not been corrected yet (see Spectrum lazy mode)
+        in as few batches as possible
+        :return: number of spectra that were corrected
+        :rtype: int
+        """
+        return Spectrum.materialize_all(self.spectrum_list)
+
+    def _cube_rows(self) -> Optional[slice]:
+        """
+        The rows of the spot in its cube, or None if the spectrum list is not exactly those rows
+        (e.g. spectra were added to or removed from spectrum_list)
+        """
+        if self.cube is None:
+            return None
+        rows = self.cube.spot_slice(self.spot_index)
+        if len(self.spectrum_list) != rows.stop - rows.start or \
+                any(spectrum.cube is not self.cube or spectrum.index != index
+                    for index, spectrum in enumerate(self.spectrum_list, rows.start)):
+            return None
+        return rows
+
+    def validate(self, decimal: int = 3) -> pd.DataFrame:
+        """
+        Checks that every spectrum has the length, laser wavelength and wavenumbers of the first spectrum.
+        Each distinct wavenumber axis is compared once, so spectra sharing an axis cost nothing extra.
+        :param decimal: wavenumbers match if they differ by less than 1.5 * 10 ** -decimal
+        (as in np.testing.assert_almost_equal)
+        :type decimal: int
+        :return: one row per spectrum with data_length, laser_wavelength, max_wavenumber_error
+        (NaN if the length differs) and consistent columns
+        :rtype: pd.DataFrame
+        """
+        n_spectra = len(self.spectrum_list)
+        rows = self._cube_rows()
+        if rows is not None:  # views onto a single cube share one axis
+            lengths = np.full(n_spectra, self.cube.n_points)
+            laser_wavelengths = np.full(n_spectra, self.cube.laser_wavelength, dtype=float)
+            errors = np.zeros(n_spectra)
+        else:
+            lengths = np.array([spectrum.data_length for spectrum in self.spectrum_list])
+            laser_wavelengths = np.array([spectrum.laser_wavelength for spectrum in self.spectrum_list], dtype=float)
+            axes = {}
+            axis_ids = []
+            for spectrum in self.spectrum_list:
+                axis = spectrum.wavenumbers
+                axes.setdefault(id(axis), axis)
+                axis_ids.append(id(axis))
+            reference = np.asarray(self.spectrum_list[0].wavenumbers)
+            same_length = [key for key, axis in axes.items() if len(axis) == len(reference)]
+            axis_errors = dict.fromkeys(axes, np.nan)
+            if same_length:
+                stacked = np.array([axes[key] for key in same_length], dtype=float)
+                axis_errors.update(zip(same_length, np.abs(stacked - reference).max(axis=1, initial=0).tolist()))
+            errors = np.array([axis_errors[key] for key in axis_ids])
+
+        consistent = (lengths == lengths[0]) & (laser_wavelengths == laser_wavelengths[0]) & \
+            (errors < 1.5 * 10.0 ** -decimal)
+        report = pd.DataFrame({'data_length': lengths, 'laser_wavelength': laser_wavelengths,
+                               'max_wavenumber_error': errors, 'consistent': consistent})
+        report.index.name = 'index'
+        return report
 
     def build_DataArray(self):
         """
-        Build a DataArray object from a spot
+        Build a DataArray object from a spot. The (index, type, wavenumber) data is assembled with a single
+        stack, straight from the cube when the spot is a view onto one.
         :return: a DataArray object
         :rtype: xr.DataArray
+        :raises SpotConsistencyError: if the spectra differ in length, laser wavelength or wavenumbers,
+        the error holds the validate report
         """
         assert len(self.spectrum_list) != 0, 'Spectra list empty, cannot build xarray'
-        spectrum_length = self.spectrum_list[0].data_length
-        laser_wavelength = self.spectrum_list[0].laser_wavelength
-
-        dims = ['index', 'type', 'wavenumber']
-        shape = (len(self.spectrum_list), 2, spectrum_length)
-        wavenumbers = self.spectrum_list[0].wavenumbers
-        data = np.zeros(shape)
-        attributes = {"laser_wavelength": laser_wavelength,
-                      "spectrum_length": spectrum_length,
+        report = self.validate()
+        if not report['consistent'].all():
+            raise SpotConsistencyError(report)
+
+        first = self.spectrum_list[0]
+        rows = self._cube_rows()
+        if rows is not None:
+            raw = self.cube.block(rows, use_corrected=False)
+            corrected = self.cube.block(rows)
+            labels = self.cube.label_array()[rows]
+        else:
+            self.materialize()
+            raw = [spectrum.raw_data for spectrum in self.spectrum_list]
+            corrected = [spectrum.corrected_data for spectrum in self.spectrum_list]
+            labels = [spectrum.label for spectrum in self.spectrum_list]
+
+        attributes = {"laser_wavelength": first.laser_wavelength,
+                      "spectrum_length": first.data_length,
                       "position": self.position,
                       "metadata": self.metadata,
                       "filepath": self.filepath,
-                      "labels": {}}
-
-        spectra_indices = []
-        for index, spectrum in enumerate(self.spectrum_list):
-            # key assumptions to building a spot
-            assert spectrum.data_length == spectrum_length, 'all spectra must be same length'
-            assert spectrum.laser_wavelength == laser_wavelength, 'all spectra must use same laser wavelength'
-            # assert np.testing.assert_array_equal(wavenumbers, spectrum.wavenumbers, err_msg='all spectra in spot must have same wavenumbers', verbose=True)
-            np.testing.assert_almost_equal(wavenumbers, spectrum.wavenumbers, 3,
-                                           err_msg='all spectra in spot must have same wavenumbers')
-
-            data[index, 0, :] = spectrum.raw_data
-            data[index, 1, :] = spectrum.corrected_data
-            attributes["labels"][index] = spectrum.label
-            spectra_indices.append(index)
-
-        spectrum_type = ['raw', 'corrected']
-        coords = [spectra_indices, spectrum_type, wavenumbers]
-        return xr.DataArray(data, coords=coords,
-                            dims=dims, attrs=attributes)
+                      "labels": dict(enumerate(labels))}
+        coords = [np.arange(len(self.spectrum_list)), ['raw', 'corrected'], first.wavenumbers]
+        return xr.DataArray(np.stack((raw, corrected), axis=1), coords=coords,
+                            dims=['index', 'type', 'wavenumber'], attrs=attributes)
 
     def plot(self, axis=None, plot_raw=False, break_after=10) -> None:
         """
@@ -96,25 +274,58 @@ class Spot:
         if axis is None:
             fig.show()
 
-    def to_pandas(self, use_corrected=True):
-        spec_list = []
-        label_list = []
-        x_pos_list = []
-        y_pos_list = []
-        for spectrum in self.spectrum_list:
-            spec = spectrum.to_numpy(use_corrected)
-            label = spectrum.label
-
-            if self.position is not None:
-                x_pos, y_pos = self.position
-            else:
-                x_pos = None
-                y_pos = None
-            spec_list.append(spec)
-            label_list.append(label)
-            x_pos_list.append(x_pos)
-            y_pos_list.append(y_pos)
+    def to_pandas(self, use_corrected=True) -> pd.DataFrame:
+        """
+        Builds a DataFrame with one row per spectrum of the spot
+        :param use_corrected: if False the raw spectra are used
+        :type use_corrected: bool
+        :return: DataFrame with spectrum, label, x_pos and y_pos columns
+        :rtype: pd.DataFrame
+        """
+        if self.cube is not None:
+            rows = self.cube.spot_slice(self.spot_index)
+            spectra = list(self.cube.block(rows, use_corrected))
+            labels = self.cube.label_array()[rows]
+        else:
+            spectra = [spectrum.corrected_data if use_corrected else spectrum.raw_data
+                       for spectrum in self.spectrum_list]
+            labels = [spectrum.label for spectrum in self.spectrum_list]
+        x_pos, y_pos = self.position if self.position is not None else (None, None)
+        return pd.DataFrame({'spectrum': spectra, 'label': labels,
+                             'x_pos': [x_pos] * len(spectra), 'y_pos': [y_pos] * len(spectra)})
+
+
+class CubeSpots(Sequence):
+    """
+    A read only list of the spots of a SpectralCube where each Spot view is only built the first time it
+    is accessed, so creating it costs the same for any number of spots (see Sample.build_from_netcdf lazy mode)
+    """
+    def __init__(self, cube: SpectralCube, metadata: Optional[Dict] = None,
+                 filepaths: Optional[List[str]] = None) -> None:
+        """
+        :param cube: the cube holding the data
+        :type cube: SpectralCube
+        :param metadata: Dictionary of metadata shared by the spots
+        :type metadata: Optional[Dict]
+        :param filepaths: filepath of each spot, if None every spot has filepath None
+        :type filepaths: Optional[List[str]]
+        """
+        self.cube = cube
+        self.metadata = metadata
+        self.filepaths = filepaths
+        self._spots: Dict[int, Spot] = {}
 
-        dict_list = {'spectrum': spec_list, 'label': label_list, 'x_pos': x_pos_list, 'y_pos': y_pos_list}
+    def __len__(self) -> int:
+        return self.cube.n_spots
 
-        return pd.DataFrame(dict_list)
+    def __getitem__(self, index: Union[int, slice]) -> Union[Spot, List[Spot]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('spot index out of range')
+        if index not in self._spots:
+            filepath = None if self.filepaths is None else self.filepaths[index]
+            self._spots[index] = Spot.from_cube(self.cube, index, self.metadata, filepath)
+        return self._spots[index]
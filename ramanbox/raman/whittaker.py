@@ -0,0 +1,170 @@
+from abc import ABC
+from abc import abstractmethod
+from functools import lru_cache
+import numpy as np
+from scipy.sparse import csc_matrix, eye, diags
+from scipy.sparse.linalg import spsolve
+from scipy.linalg import solve_banded, solveh_banded
+from typing import Union
+
+
+def difference_penalty(m: int, lambda_: float, differences: int = 1) -> csc_matrix:
+    """
+    Builds the penalty matrix lambda * D.T * D used by the Whittaker smoother
+    :param m: number of points in the spectrum
+    :type m: int
+    :param lambda_: smoothing parameter
+    :type lambda_: float
+    :param differences: order of the differences
+    :type differences: int
+    :return: sparse penalty matrix with shape (m, m)
+    :rtype: csc_matrix
+    """
+    D = eye(m, format='csc')
+    for _ in range(differences):
+        D = D[1:] - D[:-1]  # numpy.diff() does not work with sparse matrix. This is a workaround.
+    return csc_matrix(lambda_ * D.T * D)
+
+
+@lru_cache(maxsize=32)
+def penalty_bands(m: int, lambda_: float, differences: int = 1) -> np.array:
+    """
+    Returns the penalty matrix lambda * D.T * D in lapack upper banded storage. The result is cached
+    (least recently used entries are evicted first) and is read only, so copy it before adding weights.
+    :param m: number of points in the spectrum
+    :type m: int
+    :param lambda_: smoothing parameter
+    :type lambda_: float
+    :param differences: order of the differences
+    :type differences: int
+    :return: array with shape (differences + 1, m) where ab[differences + i - j, j] = P[i, j]
+    :rtype: np.array
+    """
+    penalty = difference_penalty(m, lambda_, differences)
+    ab = np.zeros((differences + 1, m))
+    for k in range(differences + 1):
+        ab[differences - k, k:] = penalty.diagonal(k)
+    ab.setflags(write=False)
+    return ab
+
+
+def tile_bands(ab: np.array, n: int) -> np.array:
+    """
+    Tiles upper banded storage for a single spectrum into the storage of the block diagonal system
+    holding n independent spectra
+    :param ab: upper banded storage with shape (u + 1, m)
+    :type ab: np.array
+    :param n: number of spectra
+    :type n: int
+    :return: upper banded storage with shape (u + 1, n * m)
+    :rtype: np.array
+    """
+    u, m = ab.shape[0] - 1, ab.shape[1]
+    tiled = np.tile(ab, n)
+    for k in range(1, u + 1):
+        # row u - k couples point j - k with point j, so the first k entries of each block must be
+        # zero to keep the spectra from coupling to each other
+        tiled[u - k].reshape(n, m)[:, :k] = 0
+    return tiled
+
+
+class WhittakerSolver(ABC):
+    """
+    Solves the weighted penalized least squares system (W + lambda * D.T * D) z = W x
+    that is at the core of Whittaker smoothing and airPLS
+    """
+    @abstractmethod
+    def smooth(self, x: np.array, w: np.array, lambda_: float, differences: int = 1) -> np.array:
+        """
+        Smooth a single spectrum
+        :param x: spectrum with shape (n_points,)
+        :type x: np.array
+        :param w: weights with shape (n_points,)
+        :type w: np.array
+        :param lambda_: smoothing parameter
+        :type lambda_: float
+        :param differences: order of the differences
+        :type differences: int
+        :return: smoothed spectrum
+        :rtype: np.array
+        """
+        pass
+
+    @abstractmethod
+    def smooth_batch(self, X: np.array, W: np.array, lambda_: float, differences: int = 1) -> np.array:
+        """
+        Smooth every row of a 2d array
+        :param X: spectra with shape (n_spectra, n_points)
+        :type X: np.array
+        :param W: weights with the same shape as X
+        :type W: np.array
+        :param lambda_: smoothing parameter
+        :type lambda_: float
+        :param differences: order of the differences
+        :type differences: int
+        :return: smoothed spectra with the same shape as X
+        :rtype: np.array
+        """
+        pass
+
+
+class SparseWhittakerSolver(WhittakerSolver):
+    """
+    The original solver. Single spectra are solved by building sparse matrices on every call and
+    using the general sparse solver, batches are solved with a banded LU factorization.
+    """
+    def smooth(self, x, w, lambda_, differences=1):
+        x = np.asarray(x, dtype=float)
+        m = x.size
+        W = diags(w, 0, shape=(m, m))
+        A = csc_matrix(W + difference_penalty(m, lambda_, differences))
+        return spsolve(A, w * x)
+
+    def smooth_batch(self, X, W, lambda_, differences=1):
+        n, m = X.shape
+        upper = tile_bands(penalty_bands(m, lambda_, differences), n)
+        u = differences
+        ab = np.zeros((2 * u + 1, n * m))  # general lapack banded storage, ab[u + i - j, j] = A[i, j]
+        ab[:u + 1] = upper
+        for k in range(1, u + 1):
+            ab[u + k, :n * m - k] = upper[u - k, k:]
+        ab[u] += W.ravel()
+        background = solve_banded((u, u), ab, (W * X).ravel(), check_finite=False)
+        return background.reshape(n, m)
+
+
+class BandedWhittakerSolver(WhittakerSolver):
+    """
+    Solves the symmetric positive definite banded system with a banded Cholesky factorization.
+    The penalty bands are cached per (length, lambda, differences), so each call only adds the weights
+    to the main diagonal.
+    """
+    def smooth(self, x, w, lambda_, differences=1):
+        ab = np.array(penalty_bands(len(x), lambda_, differences))
+        ab[-1] += w
+        return solveh_banded(ab, w * x, check_finite=False)
+
+    def smooth_batch(self, X, W, lambda_, differences=1):
+        n, m = X.shape
+        ab = tile_bands(penalty_bands(m, lambda_, differences), n)
+        ab[-1] += W.ravel()
+        background = solveh_banded(ab, (W * X).ravel(), check_finite=False)
+        return background.reshape(n, m)
+
+
+SOLVERS = {'sparse': SparseWhittakerSolver(),
+           'banded': BandedWhittakerSolver()}
+
+
+def get_solver(solver: Union[str, WhittakerSolver]) -> WhittakerSolver:
+    """
+    Look up a solver by name, or pass through a solver instance
+    :param solver: 'sparse', 'banded' or a WhittakerSolver
+    :type solver: Union[str, WhittakerSolver]
+    :return: the solver
+    :rtype: WhittakerSolver
+    """
+    if isinstance(solver, WhittakerSolver):
+        return solver
+    assert solver in SOLVERS, f'unknown solver {solver}, must be one of {list(SOLVERS)}'
+    return SOLVERS[solver]
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+
+def write_multi_spectrum_file(path, n_spectra=3, n_points=1024, seed=0):
+    """
+    A spot file with several spectra, a non data line and a blank line in the data section and a last
+    spectrum that stops part way through
+    """
+    rng = np.random.default_rng(seed)
+    positions = np.linspace(797.49231, 1001.3, n_points)
+    lines = ['Date and Time:                Wed Feb 26 23:17:06.291 2020',
+             'Exposure Time (sec):          1.000',
+             'Laser Power (mW):             10',
+             'Grid Size:                    1x1',
+             '', '', '']
+    for index in range(n_spectra):
+        intensities = rng.poisson(450, n_points)
+        lines += [f'{position:.5f}\t{intensity}\t' for position, intensity in zip(positions, intensities)]
+        if index == 0:
+            lines += ['not a data line', '']
+    lines += [f'{position:.5f}\t{intensity}\t' for position, intensity in zip(positions[:100], range(100))]
+    path.write_text('\n'.join(lines) + '\n')
+    return path
+
+
+@pytest.fixture
+def multi_spectrum_file(tmp_path):
+    return write_multi_spectrum_file(tmp_path / 'spot.txt')
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from ramanbox.raman.builders import SpotBuilder
+from ramanbox.raman.processing import DefaultSpotParser
+from ramanbox.raman.sample_builder import SampleBuilder
+from ramanbox.raman.spot import SpotConsistencyError
+
+
+def test_builders_drop_a_partial_last_spectrum(multi_spectrum_file):
+    spot = SpotBuilder(str(multi_spectrum_file), DefaultSpotParser).build_spot()
+    assert spot.cube.n_spectra == 3
+    assert np.isfinite(spot.cube.data()).all()
+    sample = SampleBuilder(str(multi_spectrum_file)).build_sample()
+    assert sample.cube.n_spectra == 3
+    streamed = list(SampleBuilder(str(multi_spectrum_file), stream=True).iter_spots(block_size=2))
+    assert len(streamed) == 3
+
+
+def test_spot_builder_raises_on_a_shifted_position_axis(multi_spectrum_file):
+    lines = multi_spectrum_file.read_text().split('\n')
+    data_lines = [index for index, line in enumerate(lines) if line.count('\t') == 2]
+    del lines[data_lines[1500]]  # a missing data line shifts the axis of the second spectrum
+    multi_spectrum_file.write_text('\n'.join(lines))
+    with pytest.raises(SpotConsistencyError):
+        SpotBuilder(str(multi_spectrum_file), DefaultSpotParser).build_spot()
@@ -0,0 +1,58 @@
+import numpy as np
+from ramanbox.raman.parallel import correct_spectra
+from ramanbox.raman.processing import SpectrumProcessor
+from ramanbox.raman.processing_pipeline import ProcessingPipeline
+from ramanbox.raman.spectral_cube import SpectralCube
+
+
+def make_raster(n_spectra=40, n_points=400, seed=0):
+    """
+    Spectra with a broad background, a real peak, a narrow peak in two thirds of the spectra and a few spikes
+    """
+    rng = np.random.default_rng(seed)
+    x = np.arange(n_points)
+    background = 500 + 0.5 * x + 100 * np.sin(x / 80)
+    spectra = background + 300 * np.exp(-0.5 * ((x - 120) / 6) ** 2) + rng.normal(0, 5, (n_spectra, n_points))
+    spectra[: 2 * n_spectra // 3] += 800 * np.exp(-0.5 * ((x - 250) / 0.8) ** 2)
+    spectra[[5, 17, 30], [60, 300, 200]] += 3000
+    return spectra
+
+
+def test_parallel_correction_matches_serial():
+    spectra = make_raster()
+    processor = SpectrumProcessor(785.0)
+    serial = correct_spectra(processor, spectra)
+    for n_jobs in (2, 20):
+        np.testing.assert_allclose(correct_spectra(processor, spectra, n_jobs=n_jobs), serial, rtol=0, atol=1e-8)
+
+
+def test_pipeline_parallel_correction_matches_serial():
+    spectra = make_raster()
+    pipeline = ProcessingPipeline(785.0)
+    serial = correct_spectra(pipeline, spectra)
+    np.testing.assert_allclose(correct_spectra(pipeline, spectra, n_jobs=20), serial, rtol=0, atol=1e-8)
+
+
+def test_single_row_correction_matches_batch():
+    spectra = make_raster()
+    processor = SpectrumProcessor(785.0)
+    batch = SpectralCube(spectra, np.arange(spectra.shape[1]), processor, 785.0)
+    batch.correct()
+    lazy = SpectralCube(spectra, np.arange(spectra.shape[1]), processor, 785.0)
+    for index in (0, 5, 39):
+        np.testing.assert_allclose(lazy.corrected_row(index), batch.corrected[index], rtol=0, atol=1e-8)
+    lazy.correct()
+    np.testing.assert_allclose(lazy.corrected, batch.corrected, rtol=0, atol=1e-8)
+
+
+def test_parallel_correction_merges_pipeline_stats():
+    spectra = make_raster()
+    serial = ProcessingPipeline(785.0)
+    correct_spectra(serial, spectra)
+    parallel = ProcessingPipeline(785.0)
+    correct_spectra(parallel, spectra, n_jobs=4)
+    assert parallel.cosmic_rays_removed == serial.cosmic_rays_removed > 0
+    assert parallel.airpls_iterations == serial.airpls_iterations
+    report = parallel.timing_report()
+    assert (report['spectra'] == len(spectra)).all()
+    assert (report['calls'] == 4).all()
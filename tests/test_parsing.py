@@ -0,0 +1,20 @@
+import numpy as np
+from ramanbox.raman.processing import DefaultSpotParser, parse_header_values
+
+
+def test_fast_parser_matches_line_by_line_parser(multi_spectrum_file):
+    filepath = str(multi_spectrum_file)
+    slow = DefaultSpotParser(filepath, fast=False)
+    fast = DefaultSpotParser(filepath)
+    assert fast.metadata == slow.metadata
+    assert len(fast.spectra) == len(slow.spectra) == 3  # the partial last spectrum is dropped
+    np.testing.assert_array_equal(fast.spectra, np.array(slow.spectra))
+    streamed = np.concatenate(list(DefaultSpotParser(filepath, load=False).iter_spectra_blocks(block_size=3)))
+    np.testing.assert_array_equal(streamed, fast.spectra)
+
+
+def test_header_values_skip_unknown_units():
+    values = parse_header_values({'Exposure Time (ms)': '250', 'Laser Power (kW)': '1', 'Grid Size': '20x30'})
+    assert values == {'exposure_time_s': 0.25, 'grid_size': (20, 30)}
+    assert parse_header_values({'Exposure Time (min)': '2', 'Laser Power': '10'}) == {'exposure_time_s': 120,
+                                                                                      'laser_power_mw': 10}
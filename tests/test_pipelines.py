@@ -0,0 +1,129 @@
+import os
+import time
+from concurrent.futures import wait
+import numpy as np
+import pandas as pd
+import pytest
+from ramanbox.pipeline import pipelines
+from ramanbox.pipeline.benchmarks import make_synthetic_sample, write_spot_file
+from ramanbox.pipeline.pipelines import (_ConversionPool, _raw_raster_to_unlabeled_netcdf, SampleBuilder,
+                                         raw_raster_to_unlabeled_netcdf, raw_sample_to_unlabeled_netcdf,
+                                         stream_raster_to_unlabeled_netcdf)
+from ramanbox.raman.sample import Sample
+
+
+def convert_or_crash(file, *args):
+    """
+    Stands in for _convert_file, kills the worker process on files named crash*.txt
+    """
+    if os.path.basename(str(file)).startswith('crash'):
+        os._exit(1)
+    time.sleep(0.05)
+    return {'file': str(file), 'output': f'{file}.nc', 'n_spectra': 1, 'seconds': 0.05, 'skipped': False,
+            'error': None}
+
+
+def test_pipeline_reports_every_file_once_when_a_worker_dies(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipelines, '_convert_file', convert_or_crash)
+    names = [f'ok_{index}.txt' for index in range(8)]
+    names[3] = 'crash_3.txt'
+    for name in names:
+        (tmp_path / name).write_text('')
+    report = _raw_raster_to_unlabeled_netcdf(str(tmp_path), str(tmp_path), SampleBuilder, n_jobs=2,
+                                             max_in_flight=3, incremental=False)
+    assert sorted(report['file']) == sorted(str(tmp_path / name) for name in names)
+    failed = report[report['error'].notna()]
+    assert list(failed['file']) == [str(tmp_path / 'crash_3.txt')]
+
+
+def test_conversion_pool_keeps_rows_and_isolates_files_submitted_to_a_broken_pool(monkeypatch):
+    monkeypatch.setattr(pipelines, '_convert_file', convert_or_crash)
+    with _ConversionPool(2, ()) as pool:
+        pool.submit('ok_0.txt')
+        wait(list(pool.in_flight))  # finished before the pool breaks, its row must not be lost
+        pool.submit('crash_1.txt')
+        wait(list(pool.in_flight))
+        pool.submit('ok_2.txt')  # the pool is broken, the file waits to be rerun on its own
+        assert not pool.in_flight
+        assert list(pool.suspects) == ['crash_1.txt', 'ok_2.txt']
+        rows = []
+        while len(pool):
+            assert len(pool.in_flight) <= 1
+            rows.extend(pool.collect())
+    assert sorted(row['file'] for row in rows) == ['crash_1.txt', 'ok_0.txt', 'ok_2.txt']
+    assert [row['file'] for row in rows if row['error'] is not None] == ['crash_1.txt']
+
+
+def write_raster(path, n_spectra=12, seed=0):
+    spectra = make_synthetic_sample(n_spectra, 1024, seed=seed).cube.raw
+    write_spot_file(str(path), np.linspace(797, 1000, 1024), spectra)
+    return path
+
+
+def test_streamed_conversion_is_atomic_and_recorded(tmp_path, monkeypatch):
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    input_dir.mkdir()
+    output_dir.mkdir()
+    write_raster(input_dir / 'raster.txt')
+
+    def interrupted(spots, filename, **kwargs):
+        with open(filename, 'w') as outfile:
+            outfile.write('truncated')
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as patch:
+        patch.setattr(pipelines.Sample, 'save_spots', staticmethod(interrupted))
+        with pytest.raises(KeyboardInterrupt):
+            stream_raster_to_unlabeled_netcdf(str(input_dir), str(output_dir), block_size=5, incremental=True)
+    assert not any(output_dir.iterdir())  # neither a truncated output nor its temporary file
+
+    report = stream_raster_to_unlabeled_netcdf(str(input_dir), str(output_dir), block_size=5, incremental=True)
+    assert report['error'].isna().all() and list(report['n_spectra']) == [12]
+    sample = Sample.build_from_netcdf(str(output_dir / 'raster.nc'))
+    assert sample.cube.n_spectra == 12
+    again = stream_raster_to_unlabeled_netcdf(str(input_dir), str(output_dir), block_size=5, incremental=True)
+    assert again['skipped'].all()
+    rebuilt = stream_raster_to_unlabeled_netcdf(str(input_dir), str(output_dir), block_size=6, incremental=True)
+    assert not rebuilt['skipped'].any()
+
+
+@pytest.mark.parametrize('folders', [False, True])
+def test_profile_counts_airpls_iterations(tmp_path, folders):
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    (input_dir / 'sample').mkdir(parents=True)
+    output_dir.mkdir()
+    for index in range(2):
+        write_raster(input_dir / 'sample' / f'spot_{index}.txt', n_spectra=4, seed=index)
+    convert = raw_sample_to_unlabeled_netcdf if folders else raw_raster_to_unlabeled_netcdf
+    convert(str(input_dir), str(output_dir), incremental=False, profile=str(tmp_path / 'profile.csv'))
+    profile = pd.read_csv(tmp_path / 'profile.csv')
+    correct = profile[profile['stage'] == 'correct']
+    assert len(correct) == (1 if folders else 2)
+    assert (correct['airpls_spectra'] == (8 if folders else 4)).all()
+    assert (correct['airpls_iterations'] > 0).all()
+
+
+def test_incremental_run_skips_only_unchanged_inputs(tmp_path):
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    input_dir.mkdir()
+    output_dir.mkdir()
+    for index in range(2):
+        write_raster(input_dir / f'raster_{index}.txt', n_spectra=4, seed=index)
+
+    report = raw_raster_to_unlabeled_netcdf(str(input_dir), str(output_dir))
+    assert not report['skipped'].any() and not (output_dir / pipelines.MANIFEST_NAME).exists()
+
+    first = raw_raster_to_unlabeled_netcdf(str(input_dir), str(output_dir), incremental=True)
+    assert not first['skipped'].any() and first['error'].isna().all()
+    again = raw_raster_to_unlabeled_netcdf(str(input_dir), str(output_dir), incremental=True)
+    assert again['skipped'].all()
+
+    write_raster(input_dir / 'raster_1.txt', n_spectra=5, seed=7)
+    changed = raw_raster_to_unlabeled_netcdf(str(input_dir), str(output_dir), incremental=True).set_index('file')
+    assert changed.loc[str(input_dir / 'raster_0.txt'), 'skipped']
+    assert not changed.loc[str(input_dir / 'raster_1.txt'), 'skipped']
+    assert changed.loc[str(input_dir / 'raster_1.txt'), 'n_spectra'] == 5
+
+    new_params = raw_raster_to_unlabeled_netcdf(str(input_dir), str(output_dir), incremental=True,
+                                                save_options={'dtype': 'float32'})
+    assert not new_params['skipped'].any()
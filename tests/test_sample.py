@@ -0,0 +1,98 @@
+import netCDF4
+import numpy as np
+import pytest
+import xarray as xr
+from ramanbox.pipeline.benchmarks import SAVE_SETTINGS, make_synthetic_sample
+from ramanbox.raman.constants import Label
+from ramanbox.raman.sample import SPECTRA_PER_CHUNK, Sample
+
+
+def read_variable(filename, name):
+    with netCDF4.Dataset(filename) as dataset:
+        dataset.set_auto_mask(False)
+        return dataset[name][:]
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_save_labels_writes_only_the_changed_labels(tmp_path, monkeypatch, lazy):
+    filename = str(tmp_path / 'sample.nc')
+    make_synthetic_sample(120, 64, spectra_per_spot=4).save_dataset(filename)
+    spectra = read_variable(filename, 'spectra')
+
+    sample = Sample.build_from_netcdf(filename, lazy=lazy)
+    edits = [(3, 1), (10, 0), (11, 3)]  # (spot, spectrum in spot)
+    for spot, index in edits:
+        spectrum = sample.spot_list[spot].spectrum_list[index]
+        spectrum.label = Label((spectrum.label.value + 1) % len(Label))
+    expected = sample.cube.labels.copy()
+
+    def rewrite(*args, **kwargs):
+        raise AssertionError('save_labels rewrote the whole sample')
+
+    monkeypatch.setattr(Sample, 'save_dataset', rewrite)
+    assert sample.save_labels(filename) == len(edits)
+    assert sample.save_labels(filename) == 0
+    sample.close()
+
+    for reload_lazy in (False, True):
+        reloaded = Sample.build_from_netcdf(filename, lazy=reload_lazy)
+        np.testing.assert_array_equal(reloaded.cube.labels, expected)
+        reloaded.close()
+    np.testing.assert_array_equal(read_variable(filename, 'spectra'), spectra)
+
+
+@pytest.mark.parametrize('layout_version, lazy', [(1, False), (2, False), (2, True)])
+def test_saved_sample_round_trips(tmp_path, layout_version, lazy):
+    filename = str(tmp_path / 'sample.nc')
+    sample = make_synthetic_sample(60, 64, spectra_per_spot=3)
+    sample.save_dataset(filename, layout_version=layout_version)
+    with netCDF4.Dataset(filename) as dataset:  # picks the legacy or the columnar reader
+        assert getattr(dataset, 'layout_version', 1) == layout_version
+    loaded = Sample.build_from_netcdf(filename, lazy=lazy)
+    assert len(loaded.spot_list) == len(sample.spot_list) == 20
+    for original, spot in zip(sample.spot_list, loaded.spot_list):
+        assert tuple(spot.position) == tuple(original.position)
+        assert len(spot.spectrum_list) == 3
+        for expected, spectrum in zip(original.spectrum_list, spot.spectrum_list):
+            np.testing.assert_allclose(spectrum.raw_data, expected.raw_data)
+            np.testing.assert_allclose(spectrum.corrected_data, expected.corrected_data)
+            np.testing.assert_allclose(spectrum.wavenumbers, expected.wavenumbers)
+            assert spectrum.label == expected.label
+    np.testing.assert_array_equal(loaded.cube.labels, sample.cube.labels)
+    loaded.close()
+
+
+@pytest.mark.parametrize('setting', list(SAVE_SETTINGS))
+def test_save_options_round_trip(tmp_path, setting):
+    options = SAVE_SETTINGS[setting]
+    backend = options.get('backend', 'netcdf')
+    filename = str(tmp_path / ('sample.zarr' if backend == 'zarr' else 'sample.nc'))
+    sample = make_synthetic_sample(300, 128, spectra_per_spot=3)
+    cube = sample.cube
+    cube.correct()
+    expected = np.stack((cube.raw, cube.corrected), axis=1)
+    try:
+        sample.save_dataset(filename, **options)
+        kwargs = {'engine': 'zarr', 'consolidated': False} if backend == 'zarr' else {'engine': 'netcdf4'}
+        with xr.open_dataset(filename, **kwargs) as dataset:
+            encoding = dataset['spectra'].encoding
+    except ImportError as error:  # e.g. zarr is not installed
+        pytest.skip(f'{setting}: {error}')
+
+    loaded = Sample.build_from_netcdf(filename).cube
+    error = np.abs(np.stack((loaded.raw, loaded.corrected), axis=1) - expected).max()
+    dtype = options.get('dtype', 'float64')
+    assert encoding['dtype'] == np.dtype(dtype)
+    if backend == 'netcdf':
+        assert encoding['chunksizes'][0] == options.get('chunk_spectra', SPECTRA_PER_CHUNK)
+        if 'compression' in options:
+            assert encoding[options['compression']]
+            assert encoding['complevel'] == options['compression_level']
+            # netCDF4 only shuffles before zlib compression
+            assert encoding['shuffle'] == (options['compression'] == 'zlib' and options.get('shuffle', True))
+    if dtype.startswith('int'):
+        assert error <= encoding['scale_factor'] / 2 * (1 + 1e-9)
+    elif dtype == 'float32':
+        assert error <= np.finfo(np.float32).eps * np.abs(expected).max()
+    else:
+        assert error == 0
@@ -0,0 +1,27 @@
+import numpy as np
+from ramanbox.raman.whittaker import BandedWhittakerSolver, SparseWhittakerSolver
+
+
+def make_spectra(n_spectra=5, n_points=300, seed=0):
+    """
+    Noisy spectra with airPLS-like weights, zero where a peak sits above the baseline
+    """
+    rng = np.random.default_rng(seed)
+    x = np.arange(n_points)
+    spectra = 500 + 0.5 * x + 300 * np.exp(-0.5 * ((x - 120) / 6) ** 2) + rng.normal(0, 5, (n_spectra, n_points))
+    weights = rng.uniform(0.1, 1, (n_spectra, n_points))
+    weights[:, 100:140] = 0
+    return spectra, weights
+
+
+def test_banded_solver_matches_sparse():
+    spectra, weights = make_spectra()
+    sparse, banded = SparseWhittakerSolver(), BandedWhittakerSolver()
+    for lambda_ in (1, 200, 1e5):
+        for differences in (1, 2):
+            for x, w in zip(spectra, weights):
+                np.testing.assert_allclose(banded.smooth(x, w, lambda_, differences),
+                                           sparse.smooth(x, w, lambda_, differences), rtol=1e-8, atol=1e-8)
+            np.testing.assert_allclose(banded.smooth_batch(spectra, weights, lambda_, differences),
+                                       sparse.smooth_batch(spectra, weights, lambda_, differences),
+                                       rtol=1e-8, atol=1e-8)